@@ -0,0 +1,248 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import logging
+import argparse
+import platform
+import subprocess
+from statistics import median
+from unittest import mock
+
+from PIL import Image
+
+# Микробенчмарки CPU-путей, через которые проходит каждый пост, на фиксированном синтетическом корпусе:
+#   python -m bench.micro                          — прогон и таблица
+#   python -m bench.micro --save-baseline          — сохранить результат как базу (bench/micro_baseline.json)
+#   python -m bench.micro compare --threshold 15   — сравнить с базой, код выхода 1 при регрессии
+#   python -m bench.micro --filter compress        — только кейсы с подстрокой в имени
+# Запускать из корня проекта (vars.yaml). База зависит от машины, поэтому в git не хранится.
+# Время кейса — минимум из repeat повторов по number вызовов (number подбирается на ~0.2 сек).
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, "bench", "micro_baseline.json")
+REPEAT = 5
+SEED = 42
+
+# Оркестратор импортируется ради filter_tags: Bot API вместо отсутствующего в окружении USER API
+os.environ.setdefault("TELEGRAM_BACKEND", "bot")
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+
+def make_image(size: tuple, mode: str, fmt: str, seed: int, **save_args) -> bytes:
+    """Градиент с шумом: похоже на фото по сжимаемости, корпус одинаковый от прогона к прогону"""
+    rnd = random.Random(seed)
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    noise = Image.frombytes("RGB", size, rnd.randbytes(width * height * 3))
+    img = Image.blend(gradient, noise, 0.25)
+    if mode == "RGBA":
+        img.putalpha(Image.linear_gradient("L").resize(size))
+    elif mode == "P":
+        img = img.convert("P", palette=Image.Palette.ADAPTIVE)
+    out = io.BytesIO()
+    img.save(out, format=fmt, **save_args)
+    return out.getvalue()
+
+
+def make_listing(posts: int = 25, gallery_size: int = 20) -> list:
+    """Данные постов листинга Reddit: галереи, одиночные изображения, видео и текстовые посты"""
+    children = []
+    for i in range(posts):
+        post = {"name": f"t3_micro{i}", "title": f"Micro post {i} beach maid", "is_self": i % 5 == 4}
+        if i % 3 == 0:
+            media_ids = [f"m{i}_{n}" for n in range(gallery_size)]
+            post.update({
+                "is_gallery": True,
+                "gallery_data": {"items": [{"media_id": media_id, "id": n} for n, media_id in enumerate(media_ids)]},
+                "media_metadata": {media_id: {"status": "valid", "e": "Image", "m": "image/jpg",
+                                              "s": {"u": f"https://preview.redd.it/{media_id}.jpg?width=1080&amp;s=x",
+                                                    "x": 1080, "y": 1350},
+                                              "p": [{"u": f"https://preview.redd.it/{media_id}.jpg?width=108", "x": 108}]}
+                                   for media_id in media_ids},
+            })
+        elif i % 7 == 0:
+            post["url"] = f"https://v.redd.it/micro{i}.mp4"
+        else:
+            post["url"] = f"https://i.redd.it/micro{i}.jpg"
+        children.append(post)
+    return children
+
+
+def make_html(kind: str, filler_kb: int = 200) -> str:
+    """Страница в духе imgur/redgifs: много разметки, медиа ближе к концу"""
+    filler = "".join(f'<div class="c{i}"><a href="/p/{i}">ссылка {i}</a><span>текст</span></div>'
+                     for i in range(filler_kb * 1024 // 60))
+    media = ('<video><source src="https://cdn.example/v.mp4" type="video/mp4"></video>' if kind == "video"
+             else '<img src="https://cdn.example/i.jpg" alt="">')
+    return f"<!DOCTYPE html><html><head><title>media</title></head><body>{filler}{media}</body></html>"
+
+
+def make_tags(count: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    common = ["1girl", "solo", "looking_at_viewer", "highres", "absurdres", "sitting", "standing", "2girls"]
+    tags = [f"tag_{rnd.randrange(10000)}" for _ in range(count)]
+    for i in range(0, count, 4):
+        tags[i] = rnd.choice(common)
+    for i in range(2, count, 9):
+        tags[i] = f" #{tags[i]} "
+    return tags
+
+
+def make_text(length: int, sentences: bool, seed: int) -> str:
+    rnd = random.Random(seed)
+    words = ["нежно", "медленно", "горячее", "дыхание", "прикосновение", "шепот", "сердце", "тепло", "взгляд"]
+    text = []
+    while sum(len(word) + 1 for word in text) < length:
+        text.append(rnd.choice(words) + ("." if sentences and rnd.random() < 0.1 else ""))
+    return " ".join(text)
+
+
+def fake_download(url: str, folder: str = "downloads", index: int = 0) -> str:
+    # Без сети: только путь с расширением, по которому process_reddit_post_data определяет тип
+    return os.path.join(folder, os.path.basename(url.split("?")[0]))
+
+
+def build_cases() -> dict:
+    """Имя кейса → функция без аргументов"""
+    # Логи горячих путей не пишутся, но f-строки в вызовах логгера по-прежнему вычисляются
+    logging.disable(logging.INFO)
+    sys.path.insert(0, REPO_ROOT)
+    from orchestrator import filter_tags
+    from services.lm_service import smart_truncate
+    from services import reddit_service
+    from services.image_service import compress_image, validate_image_dimensions, prepare_image
+
+    images = {
+        "jpeg_2000x1500": make_image((2000, 1500), "RGB", "JPEG", SEED, quality=92),
+        "png_rgba_1500x1500": make_image((1500, 1500), "RGBA", "PNG", SEED + 1),
+        "png_palette_1200x1200": make_image((1200, 1200), "P", "PNG", SEED + 2),
+        "jpeg_12000x800": make_image((12000, 800), "RGB", "JPEG", SEED + 3, quality=80),
+    }
+    listing = make_listing()
+    html = {kind: make_html(kind) for kind in ("image", "video")}
+    tags = {count: make_tags(count, SEED + count) for count in (30, 300)}
+    texts = {
+        "short": make_text(200, True, SEED),
+        "sentences_600": make_text(600, True, SEED + 1),
+        "no_sentences_2000": make_text(2000, False, SEED + 2),
+    }
+
+    def process_listing():
+        with mock.patch.object(reddit_service, "download_media", fake_download):
+            for post in listing:
+                reddit_service.process_reddit_post_data(post, "micro")
+
+    cases = {}
+    for name, data in images.items():
+        cases[f"validate_image_dimensions[{name}]"] = lambda data=data: validate_image_dimensions(data)
+    for name in ("jpeg_2000x1500", "png_rgba_1500x1500", "png_palette_1200x1200"):
+        # Лимит ниже размера, чтобы пройти цикл качества/масштаба
+        cases[f"compress_image[{name}]"] = lambda data=images[name]: compress_image(data, max_size_mb=0.3)
+    cases["compress_image[fits_limit]"] = lambda: compress_image(images["jpeg_2000x1500"])
+    # Сторона больше 10000: уменьшение до ограничений Telegram без повторного декодирования
+    cases["prepare_image[jpeg_12000x800]"] = lambda: prepare_image(images["jpeg_12000x800"])
+    for count, tag_list in tags.items():
+        cases[f"filter_tags[{count}]"] = lambda tag_list=tag_list: filter_tags(tag_list)
+    for name, text in texts.items():
+        cases[f"smart_truncate[{name}]"] = lambda text=text: smart_truncate(text)
+    cases[f"process_reddit_post_data[listing_{len(listing)}]"] = process_listing
+    for kind, page in html.items():
+        cases[f"find_media_in_html[{kind}_{len(page) // 1024}kb]"] = lambda page=page: reddit_service.find_media_in_html(page)
+    return cases
+
+
+def measure(func) -> dict:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    runs = [total / number for total in timer.repeat(REPEAT, number)]
+    return {"min": min(runs), "median": median(runs), "number": number}
+
+
+def run(name_filter: str = "") -> dict:
+    results = {}
+    for name, func in build_cases().items():
+        if name_filter in name:
+            results[name] = measure(func)
+            print(f"  {name:<52} {format_seconds(results[name]['min']):>10}", file=sys.stderr)
+    return results
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds >= 1:
+        return f"{seconds:.2f} с"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} мс"
+    return f"{seconds * 1e6:.1f} мкс"
+
+
+def environment() -> dict:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = ""
+    return {"ts": int(time.time()), "revision": revision, "python": platform.python_version(),
+            "machine": platform.machine(), "node": platform.node()}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> tuple:
+    """Таблица сравнения и список кейсов, ставших медленнее базы больше чем на threshold процентов"""
+    lines = [f"База: ревизия {baseline['env'].get('revision') or '-'}, "
+             f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(baseline['env']['ts']))}, порог {threshold:.0f}%",
+             f"{'кейс':<52} {'база':>10} {'сейчас':>10} {'Δ':>7}"]
+    regressions = []
+    for name, row in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            lines.append(f"{name:<52} {'—':>10} {format_seconds(row['min']):>10}     new")
+            continue
+        delta = (row["min"] - base["min"]) / base["min"] * 100
+        mark = ""
+        if delta > threshold:
+            regressions.append(name)
+            mark = "  ⚠️ регрессия"
+        elif delta < -threshold:
+            mark = "  ✅ быстрее"
+        lines.append(f"{name:<52} {format_seconds(base['min']):>10} {format_seconds(row['min']):>10} "
+                     f"{delta:>+6.0f}%{mark}")
+    return "\n".join(lines), regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмарки CPU-путей обработки поста")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "compare"])
+    parser.add_argument("--filter", default="", help="только кейсы с подстрокой в имени")
+    parser.add_argument("--threshold", type=float, default=10, help="compare: допустимое замедление, %%")
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результат как базу")
+    args = parser.parse_args()
+
+    results = run(args.filter)
+
+    if args.command == "compare":
+        if not os.path.exists(BASELINE_PATH):
+            sys.exit(f"Нет базы {BASELINE_PATH}: сначала python -m bench.micro --save-baseline")
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            report, regressions = compare(results, json.load(f), args.threshold)
+        print(report)
+        if regressions:
+            print(f"\nРегрессии ({len(regressions)}): {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        print(f"{'кейс':<52} {'мин.':>10} {'медиана':>10} {'вызовов':>8}")
+        for name, row in results.items():
+            print(f"{name:<52} {format_seconds(row['min']):>10} {format_seconds(row['median']):>10} {row['number']:>8}")
+
+    if args.save_baseline:
+        baseline = {"env": environment(), "results": results}
+        if args.filter and os.path.exists(BASELINE_PATH):
+            # Частичный прогон обновляет только свои кейсы
+            with open(BASELINE_PATH, encoding="utf-8") as f:
+                stored = json.load(f)
+            baseline["results"] = {**stored["results"], **results}
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"База сохранена: {BASELINE_PATH}")
@@ -0,0 +1,223 @@
+import os
+import sys
+import glob
+import json
+import time
+import yaml
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+import multiprocessing
+
+from bench.standins import serve, load_scenario
+
+# Бенчмарк батча: настоящий orchestrator.schedule_batch_posts против стендов (bench/standins.py).
+#   python -m bench.run --scenario default --label "до оптимизации"
+#   python -m bench.run compare --last 10
+# Батч выполняется в чистом рабочем каталоге (своя БД, трассы, загрузки), стенды — в отдельном
+# процессе, чтобы не делить event loop и память с пайплайном. Итог каждого прогона дописывается
+# строкой в bench/results.jsonl: время батча, перцентили этапов и запросов по трассе, пиковый RSS и трафик.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_PATH = os.path.join(REPO_ROOT, "bench", "results.jsonl")
+
+
+def percentile(ordered: list, share: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def prepare_workdir(workdir: str):
+    """vars.yaml проекта с тихими логами, без порта метрик и с трассами в рабочем каталоге"""
+    with open(os.path.join(REPO_ROOT, "vars.yaml"), encoding="utf-8") as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    cfg["logging"] = {**cfg.get("logging", {}), "level": "WARNING", "file": "logs/tgposter.log",
+                      # telegram_service сам ставит DEBUG и предупреждает о каждой отправке без отложки
+                      "levels": {"telegram_service": "ERROR"}}
+    cfg["metrics"] = {**cfg.get("metrics", {}), "port": None}
+    cfg["tracing"] = {"dir": "traces", "keep": 0}
+    cfg["events"] = {"database": "events.db", "keep_hours": None}
+    # Стенд Telegram не ограничивает частоту: лимиты канала растянули бы прогон на минуты
+    cfg["telegram"] = {**cfg.get("telegram", {}), "global_rate": 1000, "chat_rate_per_minute": 60000,
+                       "chat_burst": 1000}
+    # Батч отправляет в стенд Telegram сразу, как до outbox: замеряется путь отправки
+    cfg["outbox"] = {**cfg.get("outbox", {}), "enabled": False}
+    with open(os.path.join(workdir, "vars.yaml"), "w", encoding="utf-8") as f:
+        yaml.dump(cfg, f, allow_unicode=True, sort_keys=False)
+
+
+def point_services_at(base_url: str, workdir: str):
+    """Переменные окружения сервисов до их импорта (адреса читаются при импорте модулей)"""
+    os.environ.update({
+        "REDDIT_BASE_URL": f"{base_url}/reddit",
+        "JSON_URL": f"{base_url}/waifu/images",
+        "SD_URL": f"{base_url}/sd",
+        "LM_STUDIO_URL": f"{base_url}/lm",
+        "LM_MODEL": "bench-model",
+        "TELEGRAM_API_URL": f"{base_url}/telegram",
+        "TELEGRAM_BACKEND": "bot",
+        "BOT_TOKEN": "123456:bench",
+        "CHANNEL_ID": "-1001000000001",
+        "DATABASE_PATH": os.path.join(workdir, "telegram_bot.db"),
+    })
+
+
+def trace_latencies(workdir: str) -> dict:
+    """Перцентили по спанам трассы батча: посты, этапы и запросы к внешним сервисам"""
+    paths = glob.glob(os.path.join(workdir, "traces", "*.json"))
+    if not paths:
+        return {}
+    with open(paths[0], encoding="utf-8") as f:
+        events = json.load(f)["traceEvents"]
+    by_name = {}
+    for event in events:
+        if event.get("ph") == "X" and event["cat"] in ("post", "stage", "upstream"):
+            by_name.setdefault(f"{event['cat']}:{event['name']}", []).append(event["dur"] / 1e6)
+    latencies = {}
+    for key, values in sorted(by_name.items()):
+        values.sort()
+        latencies[key] = {"count": len(values), "total": round(sum(values), 3), "p50": round(percentile(values, 0.5), 3),
+                          "p95": round(percentile(values, 0.95), 3), "max": round(values[-1], 3)}
+    return latencies
+
+
+def counter_total(metric) -> float:
+    return sum(series.value for series in metric._series.values())
+
+
+async def run_batch() -> dict:
+    # Импорт только здесь: сервисы читают vars.yaml и окружение при импорте
+    import orchestrator
+    from services.db_service import init_db
+    from services.events_service import init_events_db, close_events_db
+    from services.metrics_service import BATCH_SCHEDULED, DOWNLOADED_BYTES, UPLOADED_BYTES
+
+    await init_db()
+    await init_events_db()
+    started = time.perf_counter()
+    try:
+        await orchestrator.schedule_batch_posts()
+    finally:
+        await close_events_db()
+    return {
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "scheduled": int(counter_total(BATCH_SCHEDULED)),
+        "downloaded_bytes": int(counter_total(DOWNLOADED_BYTES)),
+        "uploaded_bytes": int(counter_total(UPLOADED_BYTES)),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run(scenario_name: str, label: str, keep_workdir: bool) -> dict:
+    load_scenario(scenario_name)  # ошибка в имени сценария — до запуска стендов
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    standins = context.Process(target=serve, args=(scenario_name, ready), daemon=True)
+    standins.start()
+    try:
+        base_url = ready.get(timeout=60)
+        workdir = tempfile.mkdtemp(prefix="tgposter-bench-")
+        prepare_workdir(workdir)
+        point_services_at(base_url, workdir)
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_ROOT)
+
+        from services.profiling_service import peak_rss_mb
+        result = asyncio.run(run_batch())
+        with urllib.request.urlopen(f"{base_url}/__stats", timeout=10) as resp:
+            upstreams = json.load(resp)
+    finally:
+        standins.terminate()
+
+    result.update({
+        "ts": int(time.time()),
+        "revision": git_revision(),
+        "label": label,
+        "scenario": scenario_name,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "latencies": trace_latencies(workdir),
+        "upstreams": upstreams,
+        "workdir": workdir if keep_workdir else None,
+    })
+    os.chdir(REPO_ROOT)
+    if not keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return result
+
+
+def format_result(result: dict) -> str:
+    lines = [
+        f"Сценарий: {result['scenario']}  ревизия: {result['revision'] or '-'}  {result['label'] or ''}",
+        f"Батч: {result['wall_seconds']:.1f} сек, запланировано {result['scheduled']}",
+        f"Пиковый RSS: {result['peak_rss_mb']:.1f} МБ",
+        f"Скачано: {result['downloaded_bytes'] / 1024 / 1024:.1f} МБ, "
+        f"отправлено в Telegram: {result['uploaded_bytes'] / 1024 / 1024:.1f} МБ",
+        "",
+        f"{'спан':<36} {'кол-во':>7} {'всего, с':>9} {'p50, с':>8} {'p95, с':>8} {'макс., с':>9}",
+    ]
+    for key, row in result["latencies"].items():
+        lines.append(f"{key[:36]:<36} {row['count']:>7} {row['total']:>9.2f} {row['p50']:>8.3f} "
+                     f"{row['p95']:>8.3f} {row['max']:>9.3f}")
+    lines += ["", f"{'стенд':<10} {'запросов':>9} {'ошибок':>7} {'принято, МБ':>12} {'отдано, МБ':>11}"]
+    for service, row in result["upstreams"].items():
+        lines.append(f"{service:<10} {row['requests']:>9} {row['errors']:>7} {row['bytes_in'] / 1024 / 1024:>12.1f} "
+                     f"{row['bytes_out'] / 1024 / 1024:>11.1f}")
+    return "\n".join(lines)
+
+
+def compare(last: int, scenario: str = None) -> str:
+    """Последние прогоны из results.jsonl и изменение времени батча к самому раннему из них"""
+    if not os.path.exists(RESULTS_PATH):
+        return "Результатов еще нет"
+    with open(RESULTS_PATH, encoding="utf-8") as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    if scenario:
+        results = [result for result in results if result["scenario"] == scenario]
+    results = results[-last:]
+    if not results:
+        return "Результатов еще нет"
+
+    baseline = results[0]["wall_seconds"]
+    lines = [f"{'когда':<16} {'ревизия':<9} {'сценарий':<15} {'батч, с':>8} {'Δ':>7} {'постов':>7} "
+             f"{'post p95, с':>12} {'RSS, МБ':>8}  метка"]
+    for result in results:
+        post = result["latencies"].get("post:post", {})
+        delta = (result["wall_seconds"] - baseline) / baseline * 100 if baseline else 0
+        lines.append(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(result['ts'])):<16} "
+                     f"{result['revision'] or '-':<9} {result['scenario'][:15]:<15} {result['wall_seconds']:>8.1f} "
+                     f"{delta:>+6.0f}% {result['scheduled']:>7} {post.get('p95', 0):>12.2f} "
+                     f"{result['peak_rss_mb']:>8.1f}  {result['label'] or ''}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк батча против локальных стендов")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "compare"])
+    parser.add_argument("--scenario", default=None, help="сценарий из bench/scenarios.yaml (по умолчанию default)")
+    parser.add_argument("--label", default="", help="метка прогона для сравнения")
+    parser.add_argument("--last", type=int, default=10, help="compare: сколько последних прогонов показать")
+    parser.add_argument("--keep-workdir", action="store_true", help="не удалять рабочий каталог (БД, трасса, логи)")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        print(compare(args.last, args.scenario))
+    else:
+        result = run(args.scenario or "default", args.label, args.keep_workdir)
+        print(format_result(result))
+        empty_uploads = result["upstreams"].get("telegram", {}).get("empty_uploads", 0)
+        if empty_uploads:
+            # Повтор запроса (после RetryAfter) отправил файл без содержимого — регрессия, а не медленный прогон
+            print(f"\n❌ Пустые загрузки в Telegram: {empty_uploads}")
+            sys.exit(1)
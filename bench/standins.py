@@ -0,0 +1,308 @@
+import io
+import os
+import json
+import time
+import zlib
+import yaml
+import random
+import asyncio
+import argparse
+import logging
+from aiohttp import web
+from PIL import Image
+
+logger = logging.getLogger('bench.standins')
+
+# Стенды внешних сервисов для бенчмарка: Reddit (листинг + медиа), waifu, SD WebUI,
+# LM Studio и Telegram Bot API на одном порту, каждый под своим префиксом:
+#   /reddit/r/<subreddit>.json, /reddit/media/<имя>
+#   /waifu/images, /waifu/media/<имя>
+#   /sd/sdapi/v1/interrogate, /sd/tagger/v1/interrogate
+#   /lm/v1/chat/completions (в том числе stream: true)
+#   /telegram/bot<token>/<метод>
+# Задержка, разброс, доля ошибок и размеры ответов задаются сценарием (bench/scenarios.yaml).
+# /__stats — число запросов, ошибок и байт по каждому сервису.
+
+SCENARIOS_PATH = os.path.join(os.path.dirname(__file__), "scenarios.yaml")
+IMAGE_POOL_SIZE = 4
+MAX_BODY_MB = 100
+
+TAGS = ["1girl", "solo", "long_hair", "smile", "blush", "looking_at_viewer", "thighhighs", "swimsuit", "bikini",
+        "beach", "maid", "school_uniform", "night", "indoors", "sitting", "open_mouth", "nude", "kimono",
+        "bed_sheet", "wet", "sweat", "collarbone", "stockings", "garter_belt", "pantyhose", "ponytail"]
+SYLLABLES = ["ла", "ми", "но", "ре", "ка", "ту", "со", "ве", "ни", "да", "жу", "ша", "ро", "лю", "зе", "пи"]
+
+
+def load_scenario(name: str) -> dict:
+    """Сценарий из scenarios.yaml поверх секции defaults"""
+    with open(SCENARIOS_PATH, encoding="utf-8") as f:
+        scenarios = yaml.load(f, Loader=yaml.FullLoader)
+    if name not in scenarios["scenarios"]:
+        raise ValueError(f"Нет сценария {name}, есть: {', '.join(scenarios['scenarios'])}")
+    merged = {}
+    for service, values in scenarios["defaults"].items():
+        merged[service] = {**values, **(scenarios["scenarios"][name] or {}).get(service, {})}
+    return merged
+
+
+def make_jpeg(target_kb: int, seed: int) -> bytes:
+    """JPEG из шума: почти не сжимается, поэтому размер близок к target_kb"""
+    rnd = random.Random(seed)
+    side = max(16, int((target_kb * 1024 / 1.6) ** 0.5))
+    img = Image.frombytes("RGB", (side, side), rnd.randbytes(side * side * 3))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+def behaviour_middleware(service: str, cfg: dict, stats: dict):
+    """Задержка ± разброс, доля ошибок и учет байт для одного сервиса"""
+    service_stats = stats.setdefault(service, {"requests": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0})
+
+    @web.middleware
+    async def middleware(request, handler):
+        service_stats["requests"] += 1
+        service_stats["bytes_in"] += request.content_length or 0
+        delay = cfg.get("latency_ms", 0) + random.uniform(-1, 1) * cfg.get("jitter_ms", 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if random.random() < cfg.get("error_rate", 0):
+            service_stats["errors"] += 1
+            if service == "telegram":
+                return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"},
+                                         status=500)
+            return web.Response(status=503, text="bench: injected error")
+        response = await handler(request)
+        if isinstance(response, web.Response) and response.body is not None:
+            service_stats["bytes_out"] += len(response.body)
+        return response
+
+    return middleware
+
+
+def media_response(pool: list, name: str, video_kb: int) -> web.Response:
+    if name.endswith(".mp4"):
+        # Содержимое видео стендам не важно — только объем
+        return web.Response(body=random.Random(name).randbytes(video_kb * 1024), content_type="video/mp4")
+    return web.Response(body=pool[zlib.crc32(name.encode()) % len(pool)], content_type="image/jpeg")
+
+
+def reddit_app(cfg: dict, stats: dict) -> web.Application:
+    app = web.Application(middlewares=[behaviour_middleware("reddit", cfg, stats)])
+    pool = [make_jpeg(cfg["image_kb"], seed) for seed in range(IMAGE_POOL_SIZE)]
+    # Новый набор id при каждом запуске стенда: свежая БД бенчмарка их еще не видела
+    nonce = f"{int(time.time()):x}"
+
+    async def listing(request):
+        subreddit = request.match_info["subreddit"]
+        limit = min(int(request.query.get("limit", 25)), cfg["posts"])
+        base = f"{request.url.origin()}/reddit/media"
+        rnd = random.Random(subreddit)
+        children = []
+        for i in range(limit):
+            post_id = f"{subreddit}_{nonce}_{i}"
+            post = {"name": f"t3_{post_id}", "title": f"Bench post {i} {rnd.choice(['beach', 'maid', 'school'])}",
+                    "is_self": False}
+            kind = rnd.random()
+            if kind < cfg["gallery_share"]:
+                media_ids = [f"{post_id}_{n}" for n in range(cfg["gallery_size"])]
+                post.update({
+                    "is_gallery": True,
+                    "gallery_data": {"items": [{"media_id": media_id} for media_id in media_ids]},
+                    "media_metadata": {media_id: {"s": {"u": f"{base}/{media_id}.jpg?width=1080&amp;s=bench"}}
+                                       for media_id in media_ids},
+                })
+            elif kind < cfg["gallery_share"] + cfg["video_share"]:
+                post["url"] = f"{base}/{post_id}.mp4"
+            else:
+                post["url"] = f"{base}/{post_id}.jpg"
+            children.append({"kind": "t3", "data": post})
+        return web.json_response({"kind": "Listing", "data": {"children": children}})
+
+    async def media(request):
+        return media_response(pool, request.match_info["name"], cfg["video_kb"])
+
+    app.router.add_get("/r/{subreddit}.json", listing)
+    app.router.add_get("/media/{name}", media)
+    return app
+
+
+def waifu_app(cfg: dict, stats: dict) -> web.Application:
+    app = web.Application(middlewares=[behaviour_middleware("waifu", cfg, stats)])
+    pool = [make_jpeg(cfg["image_kb"], 100 + seed) for seed in range(IMAGE_POOL_SIZE)]
+
+    async def images(request):
+        base = f"{request.url.origin()}/waifu/media"
+        return web.json_response({"images": [
+            {"url": f"{base}/waifu_{i}.jpg", "tags": [{"name": tag} for tag in random.sample(TAGS, 6)]}
+            for i in range(cfg["images"])
+        ]})
+
+    async def media(request):
+        return media_response(pool, request.match_info["name"], 0)
+
+    app.router.add_get("/images", images)
+    app.router.add_get("/media/{name}", media)
+    return app
+
+
+def sd_app(cfg: dict, stats: dict) -> web.Application:
+    app = web.Application(middlewares=[behaviour_middleware("sd", cfg, stats)])
+
+    async def interrogate(request):
+        await request.read()
+        return web.json_response({"caption": ", ".join(random.sample(TAGS, cfg["tags"]))})
+
+    async def tagger(request):
+        await request.read()
+        return web.json_response({"caption": {}, "tags": {tag: round(random.uniform(0.3, 1), 3)
+                                                          for tag in random.sample(TAGS, cfg["tags"])}})
+
+    app.router.add_post("/sdapi/v1/interrogate", interrogate)
+    app.router.add_post("/tagger/v1/interrogate", tagger)
+    return app
+
+
+def lm_app(cfg: dict, stats: dict) -> web.Application:
+    app = web.Application(middlewares=[behaviour_middleware("lm", cfg, stats)])
+
+    def description() -> str:
+        # Случайные слова из слогов: проверка на повторы (FTS) не должна отклонять описания
+        words = []
+        while sum(len(word) + 1 for word in words) < cfg["chars"]:
+            words.append("".join(random.choices(SYLLABLES, k=random.randint(2, 4))))
+        return " ".join(words).capitalize() + "."
+
+    async def completions(request):
+        payload = await request.json()
+        text = description()
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": "chatcmpl-bench", "object": "chat.completion", "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(text.split())},
+            })
+
+        # Поток SSE: один чанк на слово с паузой token_ms
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        sent = 0
+        for word in text.split(" "):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            data = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+            await response.write(data)
+            sent += len(data)
+            await asyncio.sleep(cfg.get("token_ms", 0) / 1000)
+        await response.write(b"data: [DONE]\n\n")
+        stats["lm"]["bytes_out"] += sent + 14
+        return response
+
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+
+def telegram_app(cfg: dict, stats: dict) -> web.Application:
+    app = web.Application(middlewares=[behaviour_middleware("telegram", cfg, stats)])
+    chat = {"id": -1001000000001, "type": "channel", "title": "bench"}
+    counter = {"message_id": 0, "sends": 0}
+
+    def message(media: str = None) -> dict:
+        counter["message_id"] += 1
+        result = {"message_id": counter["message_id"], "date": int(time.time()), "chat": chat}
+        if media:
+            # file_id, по которому сервис отправляет то же медиа повторно без загрузки
+            file = {"file_id": f"bench-{media}-{counter['message_id']}", "file_unique_id": f"u{counter['message_id']}",
+                    "width": 1280, "height": 720}
+            result[media] = [file] if media == "photo" else {**file, "duration": 1}
+        return result
+
+    async def method(request):
+        name = request.match_info["method"]
+        form = await request.post()
+        empty = [key for key, value in form.items() if isinstance(value, web.FileField) and not value.file.read(1)]
+        if empty:
+            # Как Bot API: пустой файл — обычно поток, дочитанный до конца прошлой попыткой (повтор после 429)
+            stats["telegram"]["errors"] += 1
+            stats["telegram"]["empty_uploads"] = stats["telegram"].get("empty_uploads", 0) + 1
+            return web.json_response({"ok": False, "error_code": 400,
+                                      "description": f"Bad Request: file must be non-empty ({', '.join(empty)})"},
+                                     status=400)
+        if name.startswith("send"):
+            counter["sends"] += 1
+            if cfg.get("flood_every") and counter["sends"] % cfg["flood_every"] == 0:
+                # Ответ Bot API при превышении лимитов; повтор — уже следующий запрос и проходит
+                stats["telegram"]["errors"] += 1
+                retry_after = cfg.get("flood_retry_after", 1)
+                return web.json_response({"ok": False, "error_code": 429,
+                                          "description": f"Too Many Requests: retry after {retry_after}",
+                                          "parameters": {"retry_after": retry_after}}, status=429)
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name == "getChat":
+            result = {**chat, "accent_color_id": 0, "max_reaction_count": 11,
+                      "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                              "unique_gifts": False, "premium_subscription": False}}
+        elif name == "sendMediaGroup":
+            result = [message("photo") for _ in json.loads(form.get("media", "[]"))]
+        elif name in ("sendPhoto", "sendVideo", "sendAnimation"):
+            result = message(name[4:].lower())
+        elif name.startswith("send"):
+            result = message()
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+
+def build_app(scenario: dict) -> web.Application:
+    stats = {}
+    # Размер тела задает корневое приложение: base64 изображения для SD и загрузки в Telegram
+    app = web.Application(client_max_size=MAX_BODY_MB * 1024 * 1024)
+    app.add_subapp("/reddit", reddit_app(scenario["reddit"], stats))
+    app.add_subapp("/waifu", waifu_app(scenario["waifu"], stats))
+    app.add_subapp("/sd", sd_app(scenario["sd"], stats))
+    app.add_subapp("/lm", lm_app(scenario["lm"], stats))
+    app.add_subapp("/telegram", telegram_app(scenario["telegram"], stats))
+
+    async def stats_handler(request):
+        return web.json_response(stats)
+
+    app.router.add_get("/__stats", stats_handler)
+    return app
+
+
+async def start(scenario: dict, host: str = "127.0.0.1", port: int = 0) -> tuple:
+    """Поднимает стенды, возвращает (runner, базовый URL). port=0 — свободный порт"""
+    runner = web.AppRunner(build_app(scenario), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def serve(scenario_name: str, ready, port: int = 0):
+    """Точка входа отдельного процесса стендов: базовый URL отдается через ready (Queue)"""
+    async def main():
+        _, base_url = await start(load_scenario(scenario_name), port=port)
+        ready.put(base_url)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Стенды внешних сервисов для бенчмарка")
+    parser.add_argument("--scenario", default="default")
+    parser.add_argument("--port", type=int, default=8790)
+    args = parser.parse_args()
+
+    async def main():
+        _, base_url = await start(load_scenario(args.scenario), port=args.port)
+        print(f"Стенды ({args.scenario}) на {base_url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
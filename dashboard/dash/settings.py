@@ -10,11 +10,19 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import sys
+import time
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Корень бота: общие модули services/ (без побочных эффектов) доступны дашборду
+BOT_ROOT = BASE_DIR.parent
+if str(BOT_ROOT) not in sys.path:
+    sys.path.append(str(BOT_ROOT))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -53,6 +61,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'dbd.context_processors.dashboard',
             ],
         },
     },
@@ -80,6 +89,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'dbd.context_processors.dashboard',
             ],
         },
     },
@@ -158,4 +168,29 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
-}
\ No newline at end of file
+}
+
+# Смещение часового пояса (в часах) для группировки статистики по дням.
+# Время в БД бота хранится в UTC epoch, по умолчанию берется локальный пояс сервера
+DASHBOARD_UTC_OFFSET_HOURS = float(
+    os.getenv("DASHBOARD_UTC_OFFSET_HOURS", time.localtime().tm_gmtoff / 3600)
+)
+
+# БД бота (telegram_bot.db в корне проекта); дашборд открывает ее только на чтение
+BOT_DATABASE_PATH = os.getenv("BOT_DATABASE_PATH", str(BOT_ROOT / "telegram_bot.db"))
+
+# Сколько секунд главная страница отдается из кеша без запросов к БД
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", 5))
+
+# Превью изображений: кеш на диске по digest содержимого и пул генерации
+THUMBNAIL_CACHE_DIR = Path(os.getenv("THUMBNAIL_CACHE_DIR", BASE_DIR / "thumbnails"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+# Сколько секунд запрос ждет генерацию превью; дольше — заглушка, превью дописывается в фоне
+THUMBNAIL_WAIT = float(os.getenv("THUMBNAIL_WAIT", 0.2))
+
+# Живая лента событий бота (SSE, только под ASGI: dash/asgi.py).
+# События пишет services/events_service.py в отдельную БД
+EVENTS_DATABASE_PATH = os.getenv("EVENTS_DATABASE_PATH", str(BOT_ROOT / "events.db"))
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", 0.5))
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", 15))
+EVENTS_BACKLOG = int(os.getenv("EVENTS_BACKLOG", 50))
@@ -0,0 +1,308 @@
+import base64
+import html
+import json
+import sqlite3
+from datetime import date
+
+from django.http import JsonResponse
+
+from . import db
+from .views import DAY_SECONDS, utc_offset_seconds
+
+# JSON API с keyset-пагинацией: следующая страница продолжается с ключа
+# последней строки (created_at/scheduled_time, id; для поиска — (bm25, id)), поэтому глубокие страницы
+# стоят столько же, сколько первая. BLOB-колонки не выбираются никогда —
+# вместо media_data доступен только его размер.
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Поле API -> SQL-выражение
+POST_FIELDS = {
+    'id': 'p.id',
+    'image_url': 'p.image_url',
+    'description': 'p.description',
+    'published_at': 'p.published_at',
+    'created_at': 'p.created_at',
+    'marked': 'p.marked',
+    'reviewed_at': 'p.reviewed_at',
+    'description_model': 'p.description_model',
+    'description_prompt_id': 'p.description_prompt_id',
+    'interrogate_model': 'p.interrogate_model',
+    'interrogate_method': 'p.interrogate_method',
+    'image_digest': 'p.image_digest',
+}
+# Теги собираются отдельным запросом по post_tags
+POST_EXTRA_FIELDS = {'tags'}
+POST_DEFAULT_FIELDS = ['id', 'description', 'tags', 'created_at', 'marked', 'description_model', 'image_digest']
+
+SCHEDULED_FIELDS = {
+    'id': 's.id',
+    'post_id': 's.post_id',
+    'title': 's.title',
+    'media_type': 's.media_type',
+    'caption': 's.caption',
+    'scheduled_time': 's.scheduled_time',
+    'status': 's.status',
+    'source': 's.source',
+    'error_message': 's.error_message',
+    'created_at': 's.created_at',
+    'sent_at': 's.sent_at',
+    'message_id': 's.message_id',
+    'media_size': 'LENGTH(s.media_data)',
+    'media_digest': 's.media_digest',
+}
+SCHEDULED_DEFAULT_FIELDS = ['id', 'post_id', 'title', 'media_type', 'scheduled_time', 'status',
+                            'source', 'error_message', 'sent_at', 'message_id', 'media_size', 'media_digest']
+
+# Поиск: колонка post_logs_fts -> номер для snippet() (-1 — лучшая из колонок)
+SEARCH_COLUMNS = {'all': -1, 'description': 0, 'tags': 1}
+SEARCH_DEFAULT_FIELDS = ['id', 'description', 'tags', 'created_at', 'marked', 'image_digest']
+SEARCH_MAX_TERMS = 16
+# Совпадение в описании весомее совпадения в тегах
+SEARCH_WEIGHTS = '2.0, 1.0'
+SNIPPET_TOKENS = 12
+# Маркеры совпадений в snippet(): управляющие символы не встречаются в тексте
+# и переживают html.escape, после которого заменяются на <mark>
+SNIPPET_OPEN = '\x02'
+SNIPPET_CLOSE = '\x03'
+
+
+class ApiError(ValueError):
+    """Некорректные параметры запроса (ответ 400)"""
+
+
+def encode_cursor(sort_value: int, row_id: int) -> str:
+    raw = json.dumps([sort_value, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, sort_type=int) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        return sort_type(sort_value), int(row_id)
+    except (ValueError, TypeError):
+        raise ApiError('Некорректный cursor')
+
+
+def parse_limit(request) -> int:
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit должен быть числом')
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def parse_fields(request, allowed: set, default: list) -> list:
+    """Разреженная выборка: ?fields=id,description (id возвращается всегда)"""
+    raw = request.GET.get('fields')
+    if not raw:
+        return list(default)
+    fields = [field.strip() for field in raw.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ApiError(f"Неизвестные поля: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+def parse_day(value: str, end: bool = False) -> int:
+    """YYYY-MM-DD в часовом поясе дашборда -> UTC epoch начала (или конца) суток"""
+    try:
+        day = date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(f"Некорректная дата: {value}")
+    start = (day - date(1970, 1, 1)).days * DAY_SECONDS - utc_offset_seconds()
+    return start + DAY_SECONDS if end else start
+
+
+def add_date_range(request, column: str, where: list, params: list):
+    if request.GET.get('date_from'):
+        where.append(f"{column} >= ?")
+        params.append(parse_day(request.GET['date_from']))
+    if request.GET.get('date_to'):
+        where.append(f"{column} < ?")
+        params.append(parse_day(request.GET['date_to'], end=True))
+
+
+def keyset_page(cursor, table_sql: str, fields: dict, sort_column: str,
+                where: list, params: list, request, selected: list) -> dict:
+    """Одна страница по ключу (sort_column, id) по убыванию"""
+    limit = parse_limit(request)
+    if request.GET.get('cursor'):
+        sort_value, row_id = decode_cursor(request.GET['cursor'])
+        where.append(f"({sort_column}, {fields['id']}) < (?, ?)")
+        params.extend([sort_value, row_id])
+
+    columns = [name for name in selected if name in fields]
+    select = [f"{fields[name]} AS {name}" for name in columns]
+    select.append(f"{sort_column} AS _sort")
+    sql = f"SELECT {', '.join(select)} FROM {table_sql}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {sort_column} DESC, {fields['id']} DESC LIMIT ?"
+
+    rows = cursor.execute(sql, [*params, limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = [dict(zip(columns, row[:-1])) for row in rows]
+    next_cursor = encode_cursor(rows[-1][-1], rows[-1][columns.index('id')]) if has_more else None
+    return {'results': results, 'next_cursor': next_cursor, 'has_more': has_more}
+
+
+def attach_tags(cursor, results: list):
+    """Добавляет к постам списки тегов одним запросом по post_tags"""
+    if not results:
+        return
+    post_ids = [post['id'] for post in results]
+    qmarks = ", ".join("?" for _ in post_ids)
+    tags_by_post = {}
+    for post_id, name in cursor.execute(f"""
+        SELECT pt.post_id, t.name
+        FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+        WHERE pt.post_id IN ({qmarks})
+        ORDER BY pt.post_id, pt.position
+    """, post_ids):
+        tags_by_post.setdefault(post_id, []).append(name)
+    for post in results:
+        post['tags'] = tags_by_post.get(post['id'], [])
+
+
+def api_response(build):
+    """Общая обработка ошибок API"""
+    if db.schema_error:
+        return JsonResponse({'success': False, 'error': db.schema_error}, status=503)
+    try:
+        return JsonResponse({'success': True, **build(db.get_connection().cursor())})
+    except ApiError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except sqlite3.Error as e:
+        db.reset_connection()
+        return JsonResponse({'success': False, 'error': f"Ошибка базы данных: {e}"}, status=500)
+
+
+def posts(request):
+    """
+    GET api/posts/ — post_logs, новые первыми.
+    Фильтры: marked=0|1, reviewed=0|1, model, date_from, date_to (YYYY-MM-DD); fields, limit, cursor
+    """
+    def build(cursor):
+        selected = parse_fields(request, set(POST_FIELDS) | POST_EXTRA_FIELDS, POST_DEFAULT_FIELDS)
+        where, params = [], []
+        if request.GET.get('marked') in ('0', '1'):
+            # Пустое значение marked у старых строк считается непомеченным
+            where.append("p.marked = 1" if request.GET['marked'] == '1' else "COALESCE(p.marked, 0) != 1")
+        if request.GET.get('reviewed') in ('0', '1'):
+            where.append("p.reviewed_at IS NULL" if request.GET['reviewed'] == '0' else "p.reviewed_at IS NOT NULL")
+        if request.GET.get('model'):
+            where.append("p.description_model = ?")
+            params.append(request.GET['model'])
+        add_date_range(request, 'p.created_at', where, params)
+
+        page = keyset_page(cursor, "post_logs p", POST_FIELDS, 'p.created_at',
+                           where, params, request, selected)
+
+        if 'tags' in selected:
+            attach_tags(cursor, page['results'])
+        return page
+
+    return api_response(build)
+
+
+def scheduled(request):
+    """
+    GET api/scheduled/ — scheduled_posts, по убыванию scheduled_time.
+    Фильтры: status, source, date_from, date_to (YYYY-MM-DD); fields, limit, cursor
+    """
+    def build(cursor):
+        selected = parse_fields(request, set(SCHEDULED_FIELDS), SCHEDULED_DEFAULT_FIELDS)
+        where, params = [], []
+        for name in ('status', 'source'):
+            if request.GET.get(name):
+                where.append(f"s.{name} = ?")
+                params.append(request.GET[name])
+        add_date_range(request, 's.scheduled_time', where, params)
+
+        return keyset_page(cursor, "scheduled_posts s", SCHEDULED_FIELDS, 's.scheduled_time',
+                           where, params, request, selected)
+
+    return api_response(build)
+
+
+def search_query(text: str, field: str) -> str:
+    """
+    Запрос FTS5 из строки поиска: каждое слово в кавычках, поэтому операторы
+    и спецсимволы FTS5 из ввода не интерпретируются. Слова объединяются через AND
+    и ищутся как префиксы (окончания русских слов меняются)
+    """
+    words = "".join(ch if ch.isalnum() else " " for ch in text.lower()).split()[:SEARCH_MAX_TERMS]
+    if not words:
+        raise ApiError('Пустой поисковый запрос')
+    query = " ".join(f'"{word}"*' for word in words)
+    if field != 'all':
+        query = f"{field} : ({query})"
+    return query
+
+
+def highlight(snippet: str) -> str:
+    """Экранирует фрагмент и заменяет маркеры snippet() на <mark>"""
+    return html.escape(snippet or '').replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>')
+
+
+def search(request):
+    """
+    GET api/search/?q=... — полнотекстовый поиск по описаниям и тегам (post_logs_fts).
+    Сортировка по релевантности bm25, затем по id. Параметры: field=all|description|tags; fields, limit, cursor.
+    Каждый результат дополнительно содержит score и snippet (HTML с <mark>)
+    """
+    def build(cursor):
+        field = request.GET.get('field', 'all')
+        if field not in SEARCH_COLUMNS:
+            raise ApiError(f"field должен быть одним из: {', '.join(SEARCH_COLUMNS)}")
+        query = search_query(request.GET.get('q', ''), field)
+        selected = parse_fields(request, set(POST_FIELDS) | POST_EXTRA_FIELDS, SEARCH_DEFAULT_FIELDS)
+        limit = parse_limit(request)
+
+        # bm25 меньше — релевантнее; ключ страницы (score, id) по возрастанию
+        where, params = [], [query]
+        if request.GET.get('cursor'):
+            score, row_id = decode_cursor(request.GET['cursor'], float)
+            where.append("(m.score, m.id) > (?, ?)")
+            params.extend([score, row_id])
+        columns = [name for name in selected if name in POST_FIELDS]
+        select = [f"{POST_FIELDS[name]} AS {name}" for name in columns]
+        sql = f"""
+            SELECT m.score, {', '.join(select)}
+            FROM (
+                SELECT rowid AS id, bm25(post_logs_fts, {SEARCH_WEIGHTS}) AS score
+                FROM post_logs_fts WHERE post_logs_fts MATCH ?
+            ) m JOIN post_logs p ON p.id = m.id
+        """
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY m.score, m.id LIMIT ?"
+
+        rows = cursor.execute(sql, [*params, limit + 1]).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        results = [{**dict(zip(columns, row[1:])), 'score': -row[0]} for row in rows]
+
+        if results:
+            # snippet() считаем только для строк страницы, а не для всех совпадений
+            post_ids = [post['id'] for post in results]
+            qmarks = ", ".join("?" for _ in post_ids)
+            snippets = dict(cursor.execute(f"""
+                SELECT rowid, snippet(post_logs_fts, {SEARCH_COLUMNS[field]}, ?, ?, '…', {SNIPPET_TOKENS})
+                FROM post_logs_fts WHERE post_logs_fts MATCH ? AND rowid IN ({qmarks})
+            """, [SNIPPET_OPEN, SNIPPET_CLOSE, query, *post_ids]))
+            for post in results:
+                post['snippet'] = highlight(snippets.get(post['id']))
+        if 'tags' in selected:
+            attach_tags(cursor, results)
+
+        next_cursor = encode_cursor(rows[-1][0], rows[-1][1 + columns.index('id')]) if has_more else None
+        return {'results': results, 'next_cursor': next_cursor, 'has_more': has_more}
+
+    return api_response(build)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class DbdConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dbd'
+
+    def ready(self):
+        # Схему БД бота проверяем один раз при старте, а не на каждый запрос
+        from . import db
+        db.check_schema()
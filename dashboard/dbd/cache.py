@@ -0,0 +1,57 @@
+import hashlib
+import json
+import threading
+import time
+
+# Кеш вычисленных данных страниц в памяти воркера.
+# key -> {'value', 'expires', 'etag', 'last_modified'}
+_entries = {}
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(key: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _etag(value) -> str:
+    payload = json.dumps(value, default=str, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+
+def get_or_compute(key: str, ttl: float, compute) -> dict:
+    """
+    Возвращает запись кеша, пересчитывая ее через compute() не чаще раза в ttl секунд.
+    Защита от лавины запросов: пересчитывает один поток, остальные в это время
+    получают предыдущее значение (или ждут, если его еще нет).
+    last_modified меняется только когда меняется содержимое (etag)
+    """
+    entry = _entries.get(key)
+    now = time.time()
+    if entry and entry['expires'] > now:
+        return entry
+
+    lock = _lock_for(key)
+    if not lock.acquire(blocking=entry is None):
+        return entry
+    try:
+        entry = _entries.get(key)
+        if entry and entry['expires'] > time.time():
+            return entry
+
+        value = compute()
+        etag = _etag(value)
+        last_modified = entry['last_modified'] if entry and entry['etag'] == etag else int(time.time())
+        entry = {'value': value, 'expires': time.time() + ttl, 'etag': etag, 'last_modified': last_modified}
+        _entries[key] = entry
+        return entry
+    finally:
+        lock.release()
+
+
+def invalidate(key: str = None):
+    """Сбрасывает срок жизни записи (или всех записей), например после пометки поста"""
+    for name, entry in list(_entries.items()):
+        if key is None or name == key:
+            entry['expires'] = 0
@@ -0,0 +1,6 @@
+from .views import utc_offset_seconds
+
+
+def dashboard(request):
+    """Смещение пояса дашборда для formatDate в шаблонах: время в БД — UTC epoch"""
+    return {'utc_offset_seconds': utc_offset_seconds()}
@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from services.prompt_service import NEGATIVE_EXAMPLES_VERSION_KEY
+
+logger = logging.getLogger('dbd')
+
+# Таблицы и колонки, без которых страницы дашборда не работают.
+# Схему создает и мигрирует бот (services/db_service.init_db), дашборд ее только читает
+REQUIRED_SCHEMA = {
+    'post_logs': {'id', 'description', 'created_at', 'marked', 'description_model', 'description_prompt_id',
+                  'image_digest', 'reviewed_at'},
+    'scheduled_posts': {'id', 'status', 'scheduled_time', 'sent_at', 'media_digest'},
+    'post_tags': {'post_id', 'tag_id', 'position'},
+    'tags': {'id', 'name'},
+    'prompt_templates': {'id', 'hash', 'body'},
+    'stats_counters': {'name', 'value'},
+    'post_stats_hourly': {'hour', 'posts', 'marked'},
+    'post_stats_by_model': {'model', 'posts', 'marked'},
+    'post_stats_by_prompt': {'prompt_id', 'posts', 'marked'},
+    'scheduled_sent_hourly': {'hour', 'sent'},
+    'app_meta': {'key', 'value'},
+}
+
+# Результат проверки схемы при старте (None — схема в порядке)
+schema_error = None
+
+_local = threading.local()
+
+
+def db_path() -> str:
+    return str(settings.BOT_DATABASE_PATH)
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Read-only соединение с БД бота, одно на поток воркера.
+    mode=ro не дает дашборду взять блокировку записи, а в WAL-режиме
+    чтение не мешает оркестратору писать
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{db_path()}?mode=ro", uri=True)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        _local.conn = conn
+    return conn
+
+
+def reset_connection():
+    """Закрывает соединение потока (например, после ошибки или замены файла БД)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def write_connection():
+    """Короткое соединение на запись для редких действий пользователя (пометка постов)"""
+    conn = sqlite3.connect(db_path(), timeout=5)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def apply_mark_changes(changes: list) -> dict:
+    """
+    Применяет пачку пометок [(post_id, marked), ...] одной транзакцией:
+    ставит reviewed_at, один раз увеличивает версию негативных примеров
+    для lm_service и возвращает обновленные счетчики из stats_counters
+    """
+    now = int(time.time())
+    with write_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE post_logs SET marked = ?, reviewed_at = ? WHERE id = ?",
+            [(marked, now, post_id) for post_id, marked in changes]
+        )
+        conn.execute("""
+            INSERT INTO app_meta(key, value) VALUES (?, 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1
+        """, (NEGATIVE_EXAMPLES_VERSION_KEY,))
+        counters = dict(conn.execute("SELECT name, value FROM stats_counters WHERE name IN ('posts', 'marked')"))
+
+    total_posts = counters.get('posts', 0)
+    marked_posts = counters.get('marked', 0)
+    return {
+        'total_posts': total_posts,
+        'marked_posts': marked_posts,
+        'successful_posts': total_posts - marked_posts,
+        'success_rate': round((total_posts - marked_posts) / total_posts * 100 if total_posts else 0, 1),
+    }
+
+
+def check_schema():
+    """Однократная проверка схемы при старте приложения (см. DbdConfig.ready)"""
+    global schema_error
+    if not os.path.exists(db_path()):
+        schema_error = f"БД бота не найдена: {db_path()}. Запустите orchestrator.py для ее создания."
+        logger.warning(schema_error)
+        return
+
+    conn = sqlite3.connect(f"file:{db_path()}?mode=ro", uri=True)
+    try:
+        missing = []
+        for table, columns in REQUIRED_SCHEMA.items():
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if not existing:
+                missing.append(table)
+            elif columns - existing:
+                missing.append(f"{table}({', '.join(sorted(columns - existing))})")
+    finally:
+        conn.close()
+
+    if missing:
+        schema_error = ("Схема БД устарела, не найдено: " + "; ".join(missing) +
+                        ". Запустите бота или python -m services.db_service init для миграции.")
+        logger.warning(schema_error)
+    else:
+        schema_error = None
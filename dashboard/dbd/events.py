@@ -0,0 +1,101 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+logger = logging.getLogger('dbd')
+
+# Живая лента прогресса батча через Server-Sent Events.
+# События пишет оркестратор (services/events_service.py) в отдельную БД;
+# поток читает только ее и только когда PRAGMA data_version показывает
+# новую запись, поэтому открытая вкладка не нагружает telegram_bot.db.
+# Поток асинхронный и не занимает воркер — запускать под ASGI (dash/asgi.py).
+
+FETCH_LIMIT = 200
+
+
+def open_events() -> sqlite3.Connection:
+    # Соединение используется из пула потоков asyncio.to_thread, но всегда последовательно
+    conn = sqlite3.connect(f"file:{settings.EVENTS_DATABASE_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+def data_version(conn: sqlite3.Connection) -> int:
+    """Меняется, когда другое соединение закоммитило запись в БД событий"""
+    return conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def backlog_start(conn: sqlite3.Connection) -> int:
+    """id, после которого начинается показ: последние EVENTS_BACKLOG событий"""
+    return conn.execute("SELECT COALESCE(MAX(id), 0) - ? FROM pipeline_events", (settings.EVENTS_BACKLOG,)).fetchone()[0]
+
+
+def fetch_events(conn: sqlite3.Connection, after_id: int) -> list:
+    return conn.execute("""
+        SELECT id, ts, batch_id, post_id, kind, data FROM pipeline_events
+        WHERE id > ? ORDER BY id LIMIT ?
+    """, (after_id, FETCH_LIMIT)).fetchall()
+
+
+def format_event(row) -> str:
+    event_id, ts, batch_id, post_id, kind, data = row
+    payload = {'id': event_id, 'ts': ts, 'batch_id': batch_id, 'post_id': post_id, 'kind': kind,
+               'data': json.loads(data) if data else {}}
+    return f"id: {event_id}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def event_stream(last_id):
+    loop = asyncio.get_running_loop()
+    conn = None
+    version = None
+    last_sent = loop.time()
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                if conn is None and os.path.exists(settings.EVENTS_DATABASE_PATH):
+                    conn = await asyncio.to_thread(open_events)
+                    if last_id is None:
+                        last_id = await asyncio.to_thread(backlog_start, conn)
+                if conn is not None:
+                    current = await asyncio.to_thread(data_version, conn)
+                    if current != version:
+                        rows = await asyncio.to_thread(fetch_events, conn, last_id)
+                        # Полная порция — дочитываем на следующем шаге, не дожидаясь новой записи
+                        version = current if len(rows) < FETCH_LIMIT else None
+                        if rows:
+                            last_id = rows[-1][0]
+                            last_sent = loop.time()
+                            yield "".join(format_event(row) for row in rows)
+            except sqlite3.Error as e:
+                # БД событий еще не создана оркестратором или заменена — переоткрываем позже
+                logger.warning(f"⚠️ Лента событий: {e}")
+                if conn is not None:
+                    conn.close()
+                conn, version = None, None
+
+            if loop.time() - last_sent >= settings.EVENTS_HEARTBEAT:
+                last_sent = loop.time()
+                yield ": ping\n\n"
+            await asyncio.sleep(settings.EVENTS_POLL_INTERVAL)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+async def stream(request):
+    """GET events/stream/ — SSE-поток событий; после переподключения продолжает с Last-Event-ID"""
+    last_id = request.headers.get('Last-Event-ID') or request.GET.get('after')
+    try:
+        last_id = int(last_id) if last_id is not None else None
+    except ValueError:
+        last_id = None
+    response = StreamingHttpResponse(event_stream(last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx не должен буферизовать поток
+    return response
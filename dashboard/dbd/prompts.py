@@ -0,0 +1,57 @@
+import json
+
+from services.prompt_service import render_description_prompt
+
+
+def load_full_prompt(cursor, post_id: int) -> dict:
+    """
+    Пересобирает полный промпт описания поста из prompt_templates
+    и переменных частей, сохраненных в post_logs
+    """
+    row = cursor.execute("""
+        SELECT p.description_prompt_vars, d.id, d.body, i.body
+        FROM post_logs p
+        LEFT JOIN prompt_templates d ON d.id = p.description_prompt_id
+        LEFT JOIN prompt_templates i ON i.id = p.interrogate_prompt_id
+        WHERE p.id = ?
+    """, (post_id,)).fetchone()
+    if row is None:
+        return None
+
+    vars_json, template_id, template, interrogate_prompt = row
+    if template is None or not vars_json:
+        # Старые промпты сохранены целиком, без переменных
+        return {'template_id': template_id, 'prompt': template, 'interrogate_prompt': interrogate_prompt}
+
+    prompt_vars = json.loads(vars_json)
+    starter = cursor.execute(
+        "SELECT body FROM prompt_templates WHERE id = ?", (prompt_vars['starter_id'],)
+    ).fetchone()
+
+    tag_ids = prompt_vars.get('tag_ids', [])
+    tag_names = {}
+    if tag_ids:
+        qmarks = ", ".join("?" for _ in tag_ids)
+        tag_names = dict(cursor.execute(f"SELECT id, name FROM tags WHERE id IN ({qmarks})", tag_ids))
+
+    # Тексты негативных примеров — из prompt_templates (negative_prompt_ids); у старых записей только
+    # id постов в post_logs, и заархивированный пост уже не восстановить
+    negative_prompt_ids = prompt_vars.get('negative_prompt_ids')
+    negative_ids = negative_prompt_ids or prompt_vars.get('negative_ids', [])
+    source = "prompt_templates" if negative_prompt_ids else "post_logs"
+    column = "body" if negative_prompt_ids else "description"
+    negatives = {}
+    if negative_ids:
+        qmarks = ", ".join("?" for _ in negative_ids)
+        negatives = dict(cursor.execute(
+            f"SELECT id, {column} FROM {source} WHERE id IN ({qmarks})", negative_ids
+        ))
+
+    prompt = render_description_prompt(
+        template,
+        starter[0] if starter else '',
+        [tag_names[tag_id] for tag_id in tag_ids if tag_id in tag_names],
+        [negatives.get(neg_id) or f"[пример #{neg_id} удален]" for neg_id in negative_ids],
+        prompt_vars.get('note')
+    )
+    return {'template_id': template_id, 'prompt': prompt, 'interrogate_prompt': interrogate_prompt}
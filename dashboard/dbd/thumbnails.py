@@ -0,0 +1,151 @@
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from io import BytesIO
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.http import parse_etags
+from PIL import Image, UnidentifiedImageError
+
+from . import db
+
+logger = logging.getLogger('dbd')
+
+# Превью хранимых изображений. Файлы кешируются на диске по sha256 содержимого
+# (image_digest/media_digest пишет бот), поэтому повторный запрос не читает BLOB,
+# а превью переживает очистку медиа в retention.
+
+# Источник -> (таблица, BLOB-колонка, колонка с digest)
+SOURCES = {
+    'post': ('post_logs', 'image_data', 'image_digest'),
+    'scheduled': ('scheduled_posts', 'media_data', 'media_digest'),
+}
+# Отложенное видео превью не имеет — его BLOB даже не читаем
+SCHEDULED_IMAGE_TYPES = ('image', 'gallery', 'gif')
+
+SIZES = {'s': 160, 'm': 320, 'l': 640}
+FORMATS = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+QUALITY = 80
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+# Пока превью готовится в фоне — 503 с Retry-After без кеширования; страницы повторяют запрос (retryThumb)
+RETRY_AFTER = 1
+
+_executor = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def cache_path(digest: str, size: str, fmt: str) -> str:
+    return os.path.join(str(settings.THUMBNAIL_CACHE_DIR), digest[:2], f"{digest}-{size}.{fmt}")
+
+
+def render_thumbnail(data: bytes, size: str, fmt: str) -> bytes:
+    """Уменьшает изображение до SIZES[size] по большей стороне"""
+    with Image.open(BytesIO(data)) as img:
+        img.seek(0)  # для GIF берем первый кадр
+        img.thumbnail((SIZES[size], SIZES[size]))
+        if fmt == 'jpeg' and img.mode != 'RGB':
+            img = img.convert('RGB')
+        elif fmt == 'webp' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        output = BytesIO()
+        img.save(output, format=fmt.upper(), quality=QUALITY)
+        return output.getvalue()
+
+
+def generate(source: str, item_id: int, path: str, size: str, fmt: str) -> bool:
+    """Выполняется в пуле: читает BLOB, пишет превью атомарно. False — картинки нет"""
+    table, blob_column, _ = SOURCES[source]
+    row = db.get_connection().execute(f"SELECT {blob_column} FROM {table} WHERE id = ?", (item_id,)).fetchone()
+    if not row or not row[0]:
+        return False
+    try:
+        thumbnail = render_thumbnail(row[0], size, fmt)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"⚠️ Не удалось сделать превью {source} #{item_id}: {e}")
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(thumbnail)
+    os.replace(tmp_path, path)
+    return True
+
+
+def _generated(path: str, future):
+    _in_flight.pop(path, None)
+    if future.exception() is not None:
+        logger.error(f"❌ Ошибка генерации превью {path}: {future.exception()}")
+
+
+def ensure_thumbnail(source: str, item_id: int, path: str, size: str, fmt: str):
+    """
+    Генерирует превью в пуле; одновременные запросы одного превью используют одну задачу.
+    Ждет не дольше THUMBNAIL_WAIT: None — превью еще готовится, воркер дашборда не занимается ожиданием
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(path)
+        if future is None:
+            future = _executor.submit(generate, source, item_id, path, size, fmt)
+            _in_flight[path] = future
+            future.add_done_callback(lambda done, key=path: _generated(key, done))
+    try:
+        return future.result(timeout=settings.THUMBNAIL_WAIT)
+    except FutureTimeoutError:
+        return None
+
+
+def thumbnail(request, source, item_id, size):
+    """Превью изображения поста/отложенного поста: thumb/<source>/<id>/<s|m|l>/"""
+    if source not in SOURCES or size not in SIZES:
+        raise Http404
+    if db.schema_error:
+        return JsonResponse({'success': False, 'error': db.schema_error}, status=503)
+
+    table, _, digest_column = SOURCES[source]
+    try:
+        if source == 'scheduled':
+            row = db.get_connection().execute(
+                f"SELECT {digest_column}, media_type FROM {table} WHERE id = ?", (item_id,)
+            ).fetchone()
+            if row and row[1] not in SCHEDULED_IMAGE_TYPES:
+                raise Http404
+        else:
+            row = db.get_connection().execute(
+                f"SELECT {digest_column} FROM {table} WHERE id = ?", (item_id,)
+            ).fetchone()
+    except sqlite3.Error as e:
+        db.reset_connection()
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+    if not row or not row[0]:
+        raise Http404
+
+    digest = row[0]
+    fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    etag = f'"{digest}-{size}-{fmt}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={CACHE_MAX_AGE}, immutable',
+        'Vary': 'Accept',
+    }
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        path = cache_path(digest, size, fmt)
+        if not os.path.exists(path):
+            ready = ensure_thumbnail(source, item_id, path, size, fmt)
+            if ready is None:
+                response = HttpResponse(status=503)
+                response['Retry-After'] = str(RETRY_AFTER)
+                response['Cache-Control'] = 'no-store'
+                return response
+            if not ready:
+                raise Http404
+        response = FileResponse(open(path, 'rb'), content_type=FORMATS[fmt])
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -1,9 +1,19 @@
 from django.urls import path
 
-from . import views
+from . import api, events, thumbnails, views
 
 urlpatterns = [
     path("", views.index, name="index"),
     path("scheduled/", views.scheduled_posts, name="scheduled_posts"),
     path("mark_post/", views.mark_post, name="mark_post"),
+    path("mark_posts/", views.mark_posts, name="mark_posts"),
+    path("review/", views.review, name="review"),
+    path("search/", views.search, name="search"),
+    path("live/", views.live, name="live"),
+    path("events/stream/", events.stream, name="events_stream"),
+    path("post/<int:post_id>/prompt/", views.post_prompt, name="post_prompt"),
+    path("api/posts/", api.posts, name="api_posts"),
+    path("api/scheduled/", api.scheduled, name="api_scheduled"),
+    path("api/search/", api.search, name="api_search"),
+    path("thumb/<str:source>/<int:item_id>/<str:size>/", thumbnails.thumbnail, name="thumbnail"),
 ]
\ No newline at end of file
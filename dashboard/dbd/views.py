@@ -1,133 +1,163 @@
+from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
-from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
-from datetime import timedelta
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
+from datetime import datetime, timedelta, timezone
 import os
 import sqlite3
 import json
+import time
+import logging
+
+from . import cache, db
+from .prompts import load_full_prompt
+
+logger = logging.getLogger('dbd')
+
+INDEX_CACHE_KEY = 'index'
+
+DAY_SECONDS = 24 * 60 * 60
+# Сводные таблицы бота хранят часовые бакеты; для поясов со смещением,
+# не кратным часу, граница суток округляется до часа
+HOUR_SECONDS = 60 * 60
+
+
+def utc_offset_seconds() -> int:
+    """Смещение настроенного часового пояса дашборда в секундах"""
+    return int(settings.DASHBOARD_UTC_OFFSET_HOURS * 3600)
+
+
+def local_day_start(days_ago: int = 0) -> int:
+    """UTC epoch начала локальных суток (с учетом смещения)"""
+    offset = utc_offset_seconds()
+    today = (int(time.time()) + offset) // DAY_SECONDS
+    return (today - days_ago) * DAY_SECONDS - offset
+
+
+def from_epoch(value):
+    """Переводит UTC epoch из БД в наивный datetime настроенного пояса для шаблонов"""
+    if value is None:
+        return None
+    local_tz = timezone(timedelta(seconds=utc_offset_seconds()))
+    return datetime.fromtimestamp(value, local_tz).replace(tzinfo=None)
+
 
 def get_db_size():
-    # Поднимаемся на два уровня выше от папки dbd
-    db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "telegram_bot.db")
-    return os.path.getsize(db_path) / (1024 * 1024)  # Размер в МБ
+    path = db.db_path()
+    return os.path.getsize(path) / (1024 * 1024) if os.path.exists(path) else 0  # Размер в МБ
 
-def index(request):
-    # Подключение к БД в корневой папке TgPoster
-    db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "telegram_bot.db")
-    print(f"Путь к БД: {db_path}")
-    print(f"Файл существует: {os.path.exists(db_path)}")
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Проверяем существующие таблицы
-    tables = cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
-    print(f"Существующие таблицы: {tables}")
-    
+
+def empty_index_context(error: str) -> dict:
+    """Контекст главной страницы, когда данные недоступны"""
+    return {
+        'error': error,
+        'posts_today': 0,
+        'total_posts': 0,
+        'marked_posts': 0,
+        'successful_posts': 0,
+        'success_rate': 0,
+        'db_size': round(get_db_size(), 2),
+        'last_activity': 'Ошибка БД',
+        'chart_labels': json.dumps([]),
+        'chart_data': json.dumps([]),
+        'model_stats': [],
+        'tagged_posts': 0,
+        'avg_tags': 0,
+        'top_tags': [],
+        'prompt_stats': [],
+        'scheduled_pending': 0,
+        'scheduled_sent_today': 0,
+    }
+
+
+def build_index_context() -> dict:
+    """Данные главной страницы; схема проверяется при старте (DbdConfig.ready)"""
+    if db.schema_error:
+        # Повторяем проверку, пока бот не создаст/не смигрирует БД
+        db.check_schema()
+        if db.schema_error:
+            return empty_index_context(db.schema_error)
+
+    cursor = db.get_connection().cursor()
     try:
-        # Проверяем структуру таблицы post_logs
-        cursor.execute("PRAGMA table_info(post_logs)")
-        columns = cursor.fetchall()
-        print(f"Структура post_logs: {columns}")
+        # Счетчики и разрезы читаются из сводных таблиц, которые бот
+        # поддерживает триггерами (см. services/db_service.py)
+        counters = dict(cursor.execute("SELECT name, value FROM stats_counters").fetchall())
         
-        # Проверяем наличие поля marked и добавляем его если нет
-        column_names = [col[1] for col in columns]
-        if 'marked' not in column_names:
-            cursor.execute("ALTER TABLE post_logs ADD COLUMN marked INTEGER DEFAULT 0")
-            conn.commit()
-            print("Добавлено поле marked в таблицу post_logs")
-        
-        # Дальнейший код
-        today = timezone.now().date()
-        
-        # Посты за сутки
+        # Посты за сутки — по часовым бакетам с начала локальных суток
+        today_start = local_day_start()
+        hour_from = -(-today_start // HOUR_SECONDS)
         posts_today = cursor.execute(
-            "SELECT COUNT(*) FROM post_logs WHERE date(created_at) = date('now', 'localtime')"
+            "SELECT COALESCE(SUM(posts), 0) FROM post_stats_hourly WHERE hour >= ?", (hour_from,)
         ).fetchone()[0]
         
         # Общее количество постов
-        total_posts = cursor.execute("SELECT COUNT(*) FROM post_logs").fetchone()[0]
+        total_posts = counters.get('posts', 0)
         
         # Помеченные посты
-        marked_posts = cursor.execute("SELECT COUNT(*) FROM post_logs WHERE marked = 1").fetchone()[0]
+        marked_posts = counters.get('marked', 0)
         
         # Успешные посты (не помеченные)
         successful_posts = total_posts - marked_posts
         
         # Статистика по моделям
         model_stats = cursor.execute("""
-            SELECT description_model, COUNT(*) as count, 
-                   AVG(CASE WHEN marked = 1 THEN 1.0 ELSE 0.0 END) * 100 as fail_rate
-            FROM post_logs 
-            WHERE description_model IS NOT NULL 
-            GROUP BY description_model 
+            SELECT model, posts as count, marked * 100.0 / posts as fail_rate
+            FROM post_stats_by_model
+            WHERE posts > 0
             ORDER BY count DESC LIMIT 5
         """).fetchall()
         
-        # Статистика тегов
-        tag_stats = cursor.execute("""
-            SELECT COUNT(*) as tagged_posts, 
-                   AVG(LENGTH(tags)) as avg_tag_length
-            FROM post_logs WHERE tags IS NOT NULL AND tags != ''
-        """).fetchone()
+        # Статистика тегов: постов с тегами и связей пост-тег
+        tagged_posts = counters.get('tagged_posts', 0)
+        avg_tags = counters.get('tag_links', 0) / tagged_posts if tagged_posts else 0
+        
+        # Самые частые теги за неделю и доля помеченных постов с ними
+        top_tags = cursor.execute("""
+            SELECT t.name, COUNT(*) as count,
+                   AVG(CASE WHEN p.marked = 1 THEN 1.0 ELSE 0.0 END) * 100 as fail_rate
+            FROM post_logs p
+            JOIN post_tags pt ON pt.post_id = p.id
+            JOIN tags t ON t.id = pt.tag_id
+            WHERE p.created_at >= ?
+            GROUP BY pt.tag_id
+            ORDER BY count DESC LIMIT 10
+        """, (local_day_start(7),)).fetchall()
+        
+        # Сравнение шаблонов промптов (A/B): постов и доля помеченных на шаблон
+        prompt_stats = cursor.execute("""
+            SELECT t.id, substr(t.hash, 1, 8) as short_hash, s.posts as count,
+                   s.marked * 100.0 / s.posts as fail_rate
+            FROM post_stats_by_prompt s
+            JOIN prompt_templates t ON t.id = s.prompt_id
+            WHERE s.posts > 0
+            ORDER BY count DESC LIMIT 5
+        """).fetchall()
         
         # Последняя активность
         last_activity = cursor.execute(
             "SELECT created_at FROM post_logs ORDER BY created_at DESC LIMIT 1"
         ).fetchone()
         
-        # Статистика отложенных постов (если таблица существует)
-        scheduled_stats = {'pending': 0, 'sent_today': 0}
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scheduled_posts'")
-        if cursor.fetchone():
-            # Ожидающие отправки
-            pending_count = cursor.execute(
-                "SELECT COUNT(*) FROM scheduled_posts WHERE status = 'pending'"
-            ).fetchone()[0]
-            
-            # Отправленные сегодня
-            sent_today = cursor.execute(
-                "SELECT COUNT(*) FROM scheduled_posts WHERE status = 'sent' AND date(sent_at) = date('now', 'localtime')"
-            ).fetchone()[0]
-            
-            scheduled_stats = {'pending': pending_count, 'sent_today': sent_today}
-        
-        # Последние посты для маркировки
-        recent_posts_raw = cursor.execute("""
-            SELECT id, description, tags, created_at, marked
-            FROM post_logs 
-            ORDER BY created_at DESC 
-            LIMIT 20
-        """).fetchall()
-        
-        # Обрабатываем теги для отображения
-        recent_posts = []
-        for post in recent_posts_raw:
-            # Конвертируем теги из формата "tag1|tag2|tag3" в читаемый вид
-            tags_display = ""
-            if post[2]:  # если теги есть
-                if "|" in post[2]:  # новый формат с разделителем |
-                    tags_list = [tag.strip() for tag in post[2].split("|") if tag.strip()]
-                    tags_display = ", ".join(tags_list[:5])  # показываем первые 5 тегов
-                    if len(tags_list) > 5:
-                        tags_display += f" (+{len(tags_list) - 5})"
-                else:  # старый формат с запятыми
-                    tags_display = post[2]
-            
-            recent_posts.append((post[0], post[1], tags_display, post[3], post[4]))
+        # Статистика отложенных постов
+        sent_today = cursor.execute(
+            "SELECT COALESCE(SUM(sent), 0) FROM scheduled_sent_hourly WHERE hour >= ?", (hour_from,)
+        ).fetchone()[0]
+        scheduled_stats = {'pending': counters.get('scheduled:pending', 0), 'sent_today': sent_today}
         
-        # Данные для графика (последние 7 дней)
+        # Данные для графика (последние 7 дней), сутки считаются в настроенном поясе
+        offset = utc_offset_seconds()
         activity_data = cursor.execute("""
-            SELECT date(created_at, 'localtime') as date, COUNT(*) as count 
-            FROM post_logs 
-            WHERE created_at >= date('now', 'localtime', '-7 days')
-            GROUP BY date(created_at, 'localtime')
-            ORDER BY date
-        """).fetchall()
+            SELECT (hour * ? + ?) / ? as day, SUM(posts) as count 
+            FROM post_stats_hourly 
+            WHERE hour >= ?
+            GROUP BY day
+            ORDER BY day
+        """, (HOUR_SECONDS, offset, DAY_SECONDS, -(-local_day_start(7) // HOUR_SECONDS))).fetchall()
         
-        chart_labels = [str(row[0]) for row in activity_data]
+        chart_labels = [datetime.fromtimestamp(row[0] * DAY_SECONDS, timezone.utc).strftime('%Y-%m-%d') for row in activity_data]
         chart_data = [row[1] for row in activity_data]
         
         context = {
@@ -137,139 +167,153 @@ def index(request):
             'successful_posts': successful_posts,
             'success_rate': round((successful_posts / total_posts * 100) if total_posts > 0 else 0, 1),
             'db_size': round(get_db_size(), 2),
-            'last_activity': last_activity[0] if last_activity else 'Нет данных',
+            'last_activity': from_epoch(last_activity[0]) if last_activity else 'Нет данных',
             'chart_labels': json.dumps(chart_labels),
             'chart_data': json.dumps(chart_data),
             'model_stats': model_stats,
-            'tagged_posts': tag_stats[0] if tag_stats else 0,
-            'avg_tag_length': round(tag_stats[1], 1) if tag_stats and tag_stats[1] else 0,
-            'recent_posts': recent_posts,
+            'tagged_posts': tagged_posts,
+            'avg_tags': round(avg_tags, 1),
+            'top_tags': top_tags,
+            'prompt_stats': prompt_stats,
             'scheduled_pending': scheduled_stats['pending'],
             'scheduled_sent_today': scheduled_stats['sent_today'],
         }
         
-    except sqlite3.OperationalError as e:
-        print(f"Ошибка при работе с БД: {e}")
-        context = {
-            'error': f"Ошибка базы данных: {str(e)}",
-            'posts_today': 0,
-            'total_posts': 0,
-            'marked_posts': 0,
-            'successful_posts': 0,
-            'success_rate': 0,
-            'db_size': round(get_db_size(), 2),
-            'last_activity': 'Ошибка БД',
-            'chart_labels': json.dumps([]),
-            'chart_data': json.dumps([]),
-            'model_stats': [],
-            'tagged_posts': 0,
-            'avg_tag_length': 0,
-            'recent_posts': [],
-            'scheduled_pending': 0,
-            'scheduled_sent_today': 0,
-        }
-    finally:
-        conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка при работе с БД: {e}")
+        db.reset_connection()
+        context = empty_index_context(f"Ошибка базы данных: {str(e)}")
     
-    return render(request, "dbd/index.html", context)
+    return context
+
+
+def index_cache_entry(request=None) -> dict:
+    return cache.get_or_compute(INDEX_CACHE_KEY, settings.DASHBOARD_CACHE_TTL, build_index_context)
+
+
+def index_etag(request):
+    return index_cache_entry()['etag']
+
+
+def index_last_modified(request):
+    return datetime.fromtimestamp(index_cache_entry()['last_modified'], timezone.utc)
+
+
+# Несколько открытых вкладок с автообновлением получают одни и те же данные
+# из кеша, а неизменившаяся страница отдается как 304 без рендеринга
+@cache_control(no_cache=True)
+@condition(etag_func=index_etag, last_modified_func=index_last_modified)
+def index(request):
+    return render(request, "dbd/index.html", index_cache_entry()['value'])
+
+MAX_MARK_CHANGES = 500
+
+
+def parse_mark_change(item) -> tuple:
+    post_id, marked = int(item['post_id']), int(item.get('marked', 1))
+    if marked not in (0, 1):
+        raise ValueError('marked должен быть 0 или 1')
+    return post_id, marked
+
 
 @csrf_exempt
 @require_POST
 def mark_post(request):
     try:
         data = json.loads(request.body)
-        post_id = data.get('post_id')
-        marked = data.get('marked', 1)
-
-        db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "telegram_bot.db")
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("UPDATE post_logs SET marked = ? WHERE id = ?", (marked, post_id))
-        conn.commit()
-        conn.close()
+        counters = db.apply_mark_changes([parse_mark_change(data)])
+        cache.invalidate(INDEX_CACHE_KEY)
         
-        return JsonResponse({'success': True})
+        return JsonResponse({'success': True, **counters})
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
 
+@csrf_exempt
+@require_POST
+def mark_posts(request):
+    """Пакетная пометка: {"changes": [{"post_id": 1, "marked": 1}, ...]} одной транзакцией"""
+    try:
+        changes = [parse_mark_change(item) for item in json.loads(request.body).get('changes', [])]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return JsonResponse({'success': False, 'error': f"Некорректный запрос: {e}"}, status=400)
+    if not changes:
+        return JsonResponse({'success': False, 'error': 'Нет изменений'}, status=400)
+    if len(changes) > MAX_MARK_CHANGES:
+        return JsonResponse({'success': False, 'error': f"Не больше {MAX_MARK_CHANGES} изменений за запрос"}, status=400)
+
+    try:
+        counters = db.apply_mark_changes(changes)
+    except sqlite3.Error as e:
+        return JsonResponse({'success': False, 'error': f"Ошибка базы данных: {e}"}, status=500)
+    cache.invalidate(INDEX_CACHE_KEY)
+    return JsonResponse({'success': True, 'updated': len(changes), **counters})
+
+
+def review(request):
+    """Очередь просмотра: непросмотренные посты по одному, управление с клавиатуры"""
+    return render(request, "dbd/review.html", {'error': db.schema_error})
+
+
+def live(request):
+    """Живая лента батча: события оркестратора из events/stream/"""
+    return render(request, "dbd/live.html")
+
+
+def search(request):
+    """Полнотекстовый поиск по описаниям и тегам, результаты грузятся из api/search/"""
+    return render(request, "dbd/search.html", {'error': db.schema_error, 'query': request.GET.get('q', '')})
+
+
+def post_prompt(request, post_id):
+    """Полный промпт поста, пересобранный из шаблона и переменных частей"""
+    cursor = db.get_connection().cursor()
+    try:
+        prompt = load_full_prompt(cursor, post_id)
+    except sqlite3.Error as e:
+        db.reset_connection()
+        return JsonResponse({'success': False, 'error': str(e)})
+
+    if prompt is None:
+        return JsonResponse({'success': False, 'error': 'Пост не найден'}, status=404)
+    return JsonResponse({'success': True, **prompt})
+
+
 def scheduled_posts(request):
     """Страница с отложенными постами"""
-    db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "telegram_bot.db")
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    if db.schema_error:
+        return render(request, "dbd/scheduled_posts.html", {
+            'error': db.schema_error,
+            'stats': {'total': 0, 'pending': 0, 'sent': 0, 'failed': 0}
+        })
+
+    cursor = db.get_connection().cursor()
     
     try:
-        # Проверяем существование таблицы scheduled_posts
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='scheduled_posts'")
-        table_exists = cursor.fetchone()
+        # Получаем статистику отложенных постов из сводной таблицы
+        counts = dict(cursor.execute("""
+            SELECT substr(name, 11), value FROM stats_counters
+            WHERE name >= 'scheduled:' AND name < 'scheduled;'
+        """).fetchall())
+        
+        stats_dict = {
+            'total': sum(counts.values()),
+            'pending': counts.get('pending', 0),
+            'sent': counts.get('sent', 0),
+            'failed': counts.get('failed', 0)
+        }
+        
+        # Сами посты страница подгружает из api/scheduled/
+        context = {
+            'stats': stats_dict,
+            'error': None
+        }
         
-        if not table_exists:
-            context = {
-                'error': 'Таблица scheduled_posts не найдена. Запустите orchestrator.py для создания структуры БД.',
-                'scheduled_posts': [],
-                'stats': {'total': 0, 'pending': 0, 'sent': 0, 'failed': 0}
-            }
-        else:
-            # Получаем статистику отложенных постов
-            stats = cursor.execute("""
-                SELECT 
-                    COUNT(*) as total,
-                    SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-                    SUM(CASE WHEN status = 'sent' THEN 1 ELSE 0 END) as sent,
-                    SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed
-                FROM scheduled_posts
-            """).fetchone()
-            
-            stats_dict = {
-                'total': stats[0] if stats else 0,
-                'pending': stats[1] if stats else 0,
-                'sent': stats[2] if stats else 0,
-                'failed': stats[3] if stats else 0
-            }
-            
-            # Получаем все отложенные посты
-            posts_raw = cursor.execute("""
-                SELECT id, post_id, title, media_type, scheduled_time, status, 
-                       source, error_message, created_at, sent_at, message_id,
-                       LENGTH(media_data) as media_size
-                FROM scheduled_posts
-                ORDER BY scheduled_time DESC
-                LIMIT 50
-            """).fetchall()
-            
-            # Обрабатываем данные для отображения
-            scheduled_posts_list = []
-            for post in posts_raw:
-                scheduled_posts_list.append({
-                    'id': post[0],
-                    'post_id': post[1],
-                    'title': post[2][:50] + '...' if post[2] and len(post[2]) > 50 else post[2],
-                    'media_type': post[3],
-                    'scheduled_time': post[4],
-                    'status': post[5],
-                    'source': post[6],
-                    'error_message': post[7],
-                    'created_at': post[8],
-                    'sent_at': post[9],
-                    'message_id': post[10],
-                    'media_size_mb': round(post[11] / (1024*1024), 2) if post[11] else 0
-                })
-            
-            context = {
-                'scheduled_posts': scheduled_posts_list,
-                'stats': stats_dict,
-                'error': None
-            }
-            
-    except sqlite3.OperationalError as e:
+    except sqlite3.Error as e:
+        db.reset_connection()
         context = {
             'error': f"Ошибка базы данных: {str(e)}",
-            'scheduled_posts': [],
             'stats': {'total': 0, 'pending': 0, 'sent': 0, 'failed': 0}
         }
-    finally:
-        conn.close()
     
     return render(request, "dbd/scheduled_posts.html", context)
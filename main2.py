@@ -6,16 +6,17 @@ import asyncio
 import logging
 import base64
 import yaml
-import json
 from io import BytesIO
 from urllib.parse import urlparse
-from datetime import datetime
 import requests
 import aiohttp
 import aiosqlite
 from dotenv import load_dotenv
 from telegram import Bot
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from services.db_service import (init_db, intern_tags_with, link_post_tags, intern_prompt_with, media_digest,
+                                 description_prompt_columns, utc_now)
+from services.prompt_service import render_description_prompt
 
 # 1) Загрузка настроек из .env
 load_dotenv()
@@ -37,6 +38,13 @@ LM_MODEL = os.getenv("LM_MODEL", "saiga_nemo_12b_gguf")
 # Настройки SQLite
 DATABASE_PATH = os.getenv("DATABASE_PATH", "telegram_bot.db")
 
+# Шаблон промпта описания: в prompt_templates хранится один раз, теги — переменными поста
+DESCRIPTION_PROMPT_TEMPLATE = """Ты - пишешь текст для хентай-манги. 
+На основе следующих тегов создай краткое, но информативное описание изображения на русском языке.
+Теги: {tags}
+
+Описание:"""
+
 if not BOT_TOKEN or not CHANNEL_ID or not JSON_URL:
     raise RuntimeError("Укажите в .env BOT_TOKEN, CHANNEL_ID и JSON_URL")
 
@@ -47,13 +55,11 @@ bot = Bot(token=BOT_TOKEN)
 async def init_database():
     """Создает таблицу для хранения данных о публикациях"""
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            # Создаем таблицу если её нет
-            create_table_query = yaml_data['queries']["create_table_q"]
-            await db.execute(create_table_query)
+        # Общая схема (таблицы, миграции) создается в db_service
+        await init_db()
 
+        async with aiosqlite.connect(DATABASE_PATH) as db:
             # Создаем индексы для быстрого поиска
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_published_at ON post_logs(published_at);")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_interrogate_model ON post_logs(interrogate_model);")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_description_model ON post_logs(description_model);")
 
@@ -74,31 +80,36 @@ async def save_post_to_db(
         interrogate_method: str,
         interrogate_prompt: str,
         description_model: str,
-        description_prompt: str
+        description_prompt: dict
 ):
     """Сохраняет данные о публикации в базу данных"""
     try:
         async with aiosqlite.connect(DATABASE_PATH) as db:
             insert_query = yaml_data['queries']["insert_q"]
 
-            # Преобразуем теги в JSON строку
-            tags_json = json.dumps(tags, ensure_ascii=False)
+            # Теги храним в общем формате "tag1|tag2" и в нормализованных таблицах,
+            # промпты — ссылками на prompt_templates
+            tags_joined = "|".join(tag.strip() for tag in tags if tag.strip())
+            description_prompt_id, description_prompt_vars = await description_prompt_columns(db, description_prompt)
 
             cursor = await db.execute(insert_query, (
                 image_url,
                 image_data,
+                media_digest(image_data),
                 description,
-                tags_json,
-                datetime.now().isoformat(),
+                tags_joined,
+                utc_now(),
                 interrogate_model,
                 interrogate_method,
-                interrogate_prompt,
+                await intern_prompt_with(db, "interrogate", interrogate_prompt),
                 description_model,
-                description_prompt
+                description_prompt_id,
+                description_prompt_vars
             ))
 
-            await db.commit()
             post_id = cursor.lastrowid
+            await link_post_tags(db, post_id, await intern_tags_with(db, tags))
+            await db.commit()
             logging.info(f"Данные сохранены в БД с ID: {post_id}")
             return post_id
 
@@ -310,19 +321,13 @@ async def interrogate_with_tagger(image_bytes: bytes) -> tuple[list[str], str]:
 
 
 # 7) Функция для обработки тегов через LM Studio
-async def process_tags_with_lm(tags: list[str]) -> tuple[str, str]:
+async def process_tags_with_lm(tags: list[str]) -> tuple[str, dict]:
     """
     Отправляет теги в LM Studio для обработки
-    Возвращает (обработанный текст, промпт)
+    Возвращает (обработанный текст, части промпта для save_post_to_db)
     """
-    tags_str = ", ".join(tags)
-    print(tags_str)
-# переписать промпт так чтобы вместо тега подставлялся ? как в SQL-запросах
-    prompt = f"""Ты - пишешь текст для хентай-манги. 
-На основе следующих тегов создай краткое, но информативное описание изображения на русском языке.
-Теги: {tags_str}
-
-Описание:"""
+    prompt_parts = {"template": DESCRIPTION_PROMPT_TEMPLATE, "starter": "", "tags": tags, "negative_ids": []}
+    prompt = render_description_prompt(DESCRIPTION_PROMPT_TEMPLATE, "", tags, [])
 
     try:
         payload = {
@@ -344,14 +349,14 @@ async def process_tags_with_lm(tags: list[str]) -> tuple[str, str]:
                 if response.status == 200:
                     result = await response.json()
                     description = result["choices"][0]["message"]["content"].strip()
-                    return description, prompt
+                    return description, prompt_parts
                 else:
                     logging.error(f"LM Studio API error: {response.status}")
-                    return "", prompt
+                    return "", prompt_parts
 
     except Exception as e:
         logging.error(f"Ошибка при обработке через LM Studio: {e}")
-        return "", prompt
+        return "", prompt_parts
 
 
 # 8) Обновленная функция отправки изображений
@@ -1,4 +1,7 @@
 import os
+import time
+import argparse
+import inspect
 import requests
 import asyncio
 import logging
@@ -6,69 +9,16 @@ import yaml
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from typing import List, Set
-import logging.handlers
-
-
-# Настройка логирования с цветами и эмодзи
-class ColoredFormatter(logging.Formatter):
-    """Кастомный форматтер с цветами и эмодзи"""
-
-    grey = "\x1b[38;21m"
-    blue = "\x1b[34m"
-    green = "\x1b[32m"
-    yellow = "\x1b[33m"
-    red = "\x1b[31m"
-    bold_red = "\x1b[31;1m"
-    reset = "\x1b[0m"
-
-    FORMATS = {
-        logging.DEBUG: grey + "%(asctime)s - %(name)s - %(levelname)s - %(message)s" + reset,
-        logging.INFO: green + "%(asctime)s - %(name)s - %(levelname)s - %(message)s" + reset,
-        logging.WARNING: yellow + "%(asctime)s - %(name)s - %(levelname)s - %(message)s" + reset,
-        logging.ERROR: red + "%(asctime)s - %(name)s - %(levelname)s - %(message)s" + reset,
-        logging.CRITICAL: bold_red + "%(asctime)s - %(name)s - %(levelname)s - %(message)s" + reset
-    }
-
-    def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt='%Y-%m-%d %H:%M:%S')
-        return formatter.format(record)
-
-
-# Настройка корневого логгера
-logging.basicConfig(level=logging.INFO)
-root_logger = logging.getLogger()
-
-# Удаляем старые хендлеры
-for handler in root_logger.handlers[:]:
-    root_logger.removeHandler(handler)
-
-# Создаем новый хендлер для консоли с цветным форматтером
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(ColoredFormatter())
-root_logger.addHandler(console_handler)
-
-# Создаем папку для логов если её нет
-os.makedirs('logs', exist_ok=True)
-
-# Добавляем файловый хендлер с ротацией
-file_handler = logging.handlers.RotatingFileHandler(
-    'logs/tgposter.log',
-    maxBytes=10 * 1024 * 1024,  # 10MB
-    backupCount=5,
-    encoding='utf-8'
-)
-file_formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-file_handler.setFormatter(file_formatter)
-root_logger.addHandler(file_handler)
+from typing import List, Optional, Set
+
+
+# Логирование через очередь (services/logging_service.py): event loop не ждет запись в файл
+from services.logging_service import setup_logging, LOG_FILE
+setup_logging()
 
 # Создаем логгер для orchestrator
 logger = logging.getLogger('orchestrator')
-logger.info("📝 Логирование настроено. Логи сохраняются в logs/tgposter.log")
+logger.info("📝 Логирование настроено. Логи сохраняются в %s", LOG_FILE)
 
 # сначала подгружаем .env
 load_dotenv()
@@ -77,8 +27,19 @@ from services.reddit_service import fetch_latest, fetch_latest_posts
 from services.waifu_service import fetch_images_data
 from services.sd_service import interrogate_deepbooru, interrogate_with_tagger
 from services.lm_service import process_tags_with_lm
-from services.telegram_service_pyrogram import send_photo, send_video, send_animation, send_media_group, check_channel_access
-from services.db_service import init_db, is_reddit_processed, mark_reddit_processed, save_post_to_db, save_scheduled_post
+# TELEGRAM_BACKEND=bot — Bot API (services/telegram_service.py) без отложки, например для стендов bench/
+TELEGRAM_BACKEND = os.getenv("TELEGRAM_BACKEND", "pyrogram")
+if TELEGRAM_BACKEND == "bot":
+    from services.telegram_service import send_photo, send_video, send_animation, send_media_group, check_channel_access
+else:
+    from services.telegram_service_pyrogram import send_photo, send_video, send_animation, send_media_group, check_channel_access
+from services.retention_service import run_retention
+from services.events_service import init_events_db, close_events_db, begin_batch, publish_event, current_post
+from services.metrics_service import (start_metrics_server, POSTS, POSTS_IN_PROGRESS, STAGE_SECONDS, BATCH_SECONDS,
+                                      BATCH_SCHEDULED, UPSTREAM_SECONDS, UPSTREAM_ERRORS, DOWNLOADED_BYTES)
+from services.tracing_service import trace_batch, span, record_span
+from services.profiling_service import profiling_enabled, run_profiled, PROFILE_ENV
+from services.db_service import init_db, is_reddit_processed, mark_reddit_processed, save_post_to_db, save_scheduled_post, utc_now, to_epoch, intern_tags
 
 # читаем тайминги и subreddit
 with open("vars.yaml", encoding="utf-8") as f:
@@ -88,8 +49,23 @@ SUBREDDITS = cfg["reddit"]["subreddits"]
 INTERVAL_MIN = cfg["timings"]["time_scope"]
 USE_TAGGER = cfg.get("use_tagger", False)
 JSON_URL = os.getenv("JSON_URL")
+# Bot API не умеет отложку: посты ждут своего времени в scheduled_posts, публикует services/outbox_service.py
+USE_OUTBOX = TELEGRAM_BACKEND == "bot" and cfg.get("outbox", {}).get("enabled", False)
 LM_MODEL = os.getenv("LM_MODEL")
 
+
+def _accepts_schedule_date(func) -> bool:
+    try:
+        params = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return "schedule_date" in params or any(p.kind is p.VAR_KEYWORD for p in params.values())
+
+
+# Отложенный альбом — только если бэкенд принимает schedule_date в send_media_group,
+# иначе галерея уходит в отложку первым изображением через send_photo, как раньше
+SCHEDULED_MEDIA_GROUP = USE_OUTBOX or _accepts_schedule_date(send_media_group)
+
 # Теги, которые не нужно публиковать в Telegram
 EXCLUDED_TAGS = {
     # Количественные теги
@@ -171,9 +147,11 @@ def calculate_publish_times(num_posts: int = 8) -> List[datetime]:
 def filter_tags(tags: List[str]) -> List[str]:
     """Фильтрует теги, исключая ненужные"""
     logger = logging.getLogger(__name__)
-    logger.info(f"🔍 Фильтрация тегов: входные теги ({len(tags)}): {tags[:20]}")
+    logger.debug("🔍 Фильтрация тегов: входные теги (%d): %s", len(tags), tags[:20])
     
     filtered = []
+    # Решения по отдельным тегам собираются и логируются одной записью
+    rejected = []
     for tag in tags:
         # Очищаем тег от лишних символов
         clean_tag = tag.strip()
@@ -181,7 +159,7 @@ def filter_tags(tags: List[str]) -> List[str]:
         # Удаляем смайлики и специальные символы в начале тега
         clean_tag = clean_tag.lstrip('#:').strip()
         if not clean_tag or len(clean_tag) < 2:
-            logger.debug(f"❌ Пропускаем слишком короткий тег: '{tag}'")
+            rejected.append(tag)
             continue
             
         # Нормализуем тег для проверки
@@ -199,16 +177,30 @@ def filter_tags(tags: List[str]) -> List[str]:
             # Пропускаем теги с числами в начале (1girl, 2boys и т.д.)
             if not (len(tag_normalized) > 1 and tag_normalized[0].isdigit()):
                 filtered.append(clean_tag)
-                logger.debug(f"✅ Принят тег: '{clean_tag}'")
             else:
-                logger.debug(f"❌ Пропускаем тег с цифрой в начале: '{tag}'")
+                rejected.append(tag)
         else:
-            logger.debug(f"❌ Пропускаем исключенный тег: '{tag}'")
+            rejected.append(tag)
 
-    logger.info(f"✅ Результат фильтрации: {len(filtered)} тегов из {len(tags)}: {filtered[:10]}")
+    logger.debug("❌ Отброшенные теги: %s", rejected)
+    logger.info("✅ Результат фильтрации: %d тегов из %d: %s", len(filtered), len(tags), filtered[:10])
     return filtered[:10]  # Ограничиваем максимум 10 тегами
 
 
+def observe_stage(stage: str, started: float, **attrs) -> float:
+    """Длительность этапа — в метрики и трассу батча"""
+    duration = time.perf_counter() - started
+    STAGE_SECONDS.labels(stage).observe(duration)
+    record_span(stage, "stage", started, **attrs)
+    return duration
+
+
+async def finish_stage(kind: str, post_id: str, stage: str, started: float, **data):
+    """Как observe_stage, плюс событие в живую ленту"""
+    duration = observe_stage(stage, started, **data)
+    await publish_event(kind, post_id, duration=duration, **data)
+
+
 async def process_reddit_post(subreddit: str) -> bool:
     """
     Обрабатывает посты из указанного subreddit, пока один не будет успешно отправлен.
@@ -224,7 +216,8 @@ async def process_reddit_posts(subreddit: str, max_posts: int = 3) -> bool:
     """
     logger.info(f"🔍 Проверяем Reddit r/{subreddit}...")
 
-    posts = fetch_latest_posts(subreddit, limit=max_posts)
+    # Клиент Reddit синхронный (requests) — в отдельном потоке, event loop не блокируется
+    posts = await asyncio.to_thread(fetch_latest_posts, subreddit, max_posts)
     if not posts:
         logger.info(f"📭 Новых медиа-постов в r/{subreddit} не найдено")
         return False
@@ -254,6 +247,27 @@ async def process_reddit_posts(subreddit: str, max_posts: int = 3) -> bool:
     return False
 
 
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def read_media_files(paths: List[str]) -> List[bytes]:
+    """Файлы поста (изображения галереи) одновременно и вне потока event loop"""
+    return list(await asyncio.gather(*(asyncio.to_thread(_read_file, path) for path in paths)))
+
+
+async def enqueue_scheduled_post(post: dict, media_type: str, media_data: Optional[bytes], caption: str,
+                                 scheduled_time: datetime, source: str, media_path: Optional[str] = None,
+                                 gallery_media: Optional[List[bytes]] = None):
+    """Пост в outbox (scheduled_posts): outbox_service опубликует его в scheduled_time"""
+    # Видео и GIF копируются из файла в БД частями, без чтения в память;
+    # остальные изображения галереи — в scheduled_post_media, outbox отправит их альбомами
+    row_id = await save_scheduled_post(post['post_id'], post.get('title'), media_type, media_data, caption,
+                                       scheduled_time, source, media_path=media_path, gallery_media=gallery_media)
+    logger.info(f"📥 Пост в очереди публикации: scheduled_posts #{row_id}")
+
+
 async def process_single_post_for_scheduling(post: dict, scheduled_time: datetime) -> bool:
     """
     Обрабатывает один пост и отправляет его в отложку Telegram.
@@ -264,74 +278,102 @@ async def process_single_post_for_scheduling(post: dict, scheduled_time: datetim
     is_waifu = 'waifu_data' in post
     source = 'waifu' if is_waifu else 'reddit'
     
-    logger.info(f"🔄 Обрабатываем {source} пост для отложенной публикации: {post['post_id']}")
-    logger.info(f"⏰ Время публикации: {scheduled_time}")
+    logger.info("🔄 Обрабатываем %s пост для отложенной публикации: %s", source, post['post_id'])
+    logger.info("⏰ Время публикации: %s", scheduled_time)
+    post_id = post['post_id']
+    started = time.perf_counter()
 
     # Обработка видео - отправляем с "Отправить позже"
     if post["media_type"] == "video":
-        logger.info(f"🎥 Отправляем видео в отложку через USER API")
+        logger.info("🎥 Отправляем видео в отложку через USER API")
         try:
-            await send_video(post["media_paths"][0], schedule_date=scheduled_time)
+            if USE_OUTBOX:
+                await enqueue_scheduled_post(post, "video", None, None, scheduled_time, source,
+                                             media_path=post["media_paths"][0])
+            else:
+                await send_video(post["media_paths"][0], schedule_date=scheduled_time)
             logger.info("✅ Видео добавлено в отложку Telegram")
+            await publish_event("scheduled", post_id, media_type="video", duration=time.perf_counter() - started)
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка при отправке видео в отложку: {e}")
+            await publish_event("failed", post_id, stage="telegram", error=str(e))
             return False
     
     # Обработка GIF - отправляем с "Отправить позже"
     if post["media_type"] == "gif":
-        logger.info(f"🎞️ Отправляем GIF в отложку через USER API")
+        logger.info("🎞️ Отправляем GIF в отложку через USER API")
         try:
-            await send_animation(post["media_paths"][0], schedule_date=scheduled_time)
+            if USE_OUTBOX:
+                await enqueue_scheduled_post(post, "gif", None, None, scheduled_time, source,
+                                             media_path=post["media_paths"][0])
+            else:
+                await send_animation(post["media_paths"][0], schedule_date=scheduled_time)
             logger.info("✅ GIF добавлен в отложку Telegram")
+            await publish_event("scheduled", post_id, media_type="gif", duration=time.perf_counter() - started)
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка при отправке GIF в отложку: {e}")
+            await publish_event("failed", post_id, stage="telegram", error=str(e))
             return False
 
     # Обработка изображений (одиночных или галереи)
-    logger.info(f"🖼️ Обрабатываем {'галерею' if post.get('is_gallery') else 'изображение'}...")
+    logger.info("🖼️ Обрабатываем %s...", 'галерею' if post.get('is_gallery') else 'изображение')
 
+    stage = "download"
     try:
         # Получаем изображение для AI анализа
         if is_waifu:
             # Для waifu загружаем изображение по URL
-            resp = requests.get(post["media_paths"][0], timeout=15)
-            resp.raise_for_status()
+            try:
+                with span("waifu.image", series=UPSTREAM_SECONDS.labels("waifu", "image")):
+                    resp = requests.get(post["media_paths"][0], timeout=15)
+                resp.raise_for_status()
+            except requests.RequestException:
+                UPSTREAM_ERRORS.labels("waifu").inc()
+                raise
             img_bytes = resp.content
-            logger.info(f"📥 Загружено waifu изображение: {len(img_bytes) / 1024 / 1024:.2f} МБ")
+            DOWNLOADED_BYTES.labels("waifu").inc(len(img_bytes))
+            logger.info("📥 Загружено waifu изображение: %.2f МБ", len(img_bytes) / 1024 / 1024)
         else:
             # Для Reddit используем первое изображение из галереи/поста
             first_image_path = post["media_paths"][0]
-            logger.info(f"🔍 Читаем файл: {first_image_path}")
+            logger.info("🔍 Читаем файл: %s", first_image_path)
             
             # Проверяем существование файла
             if not os.path.exists(first_image_path):
                 logger.error(f"❌ Файл не существует: {first_image_path}")
+                await publish_event("failed", post_id, stage=stage, error="файл не существует")
                 return False
             
             with open(first_image_path, "rb") as f:
                 img_bytes = f.read()
-            logger.info(f"📊 Размер изображения: {len(img_bytes) / 1024 / 1024:.2f} МБ")
+            logger.info("📊 Размер изображения: %.2f МБ", len(img_bytes) / 1024 / 1024)
             
             # Дополнительная проверка размера
             if len(img_bytes) < 1024:  # Менее 1KB - подозрительно мало
                 logger.error(f"❌ Изображение слишком маленькое ({len(img_bytes)} байт), возможно файл поврежден")
                 # Покажем содержимое файла для диагностики
                 logger.error(f"🔍 Первые 100 байт файла: {img_bytes[:100]}")
+                await publish_event("failed", post_id, stage=stage, error="изображение слишком маленькое")
                 return False
             
             # Проверим заголовок файла
             header = img_bytes[:10]
-            logger.debug(f"🔍 Заголовок файла: {header.hex()}")
+            logger.debug("🔍 Заголовок файла: %s", header)
             
             # Проверяем на HTML (возможна ошибка скачивания)
             if img_bytes.startswith(b'<html') or img_bytes.startswith(b'<!DOCTYPE'):
-                logger.error(f"❌ Файл содержит HTML вместо изображения, возможно ошибка при скачивании")
+                logger.error("❌ Файл содержит HTML вместо изображения, возможно ошибка при скачивании")
                 logger.error(f"🔍 Начало файла: {img_bytes[:200].decode('utf-8', errors='ignore')}")
+                await publish_event("failed", post_id, stage=stage, error="HTML вместо изображения")
                 return False
 
+        await finish_stage("downloaded", post_id, stage, started, bytes=len(img_bytes))
+
         # Получаем теги от AI
+        stage = "tagging"
+        stage_started = time.perf_counter()
         logger.info("🔮 Запускаем анализ через AI...")
         if USE_TAGGER:
             tags, method = await interrogate_with_tagger(img_bytes)
@@ -373,59 +415,89 @@ async def process_single_post_for_scheduling(post: dict, scheduled_time: datetim
                     
                 tags = list(set(fallback_tags))  # Убираем дубликаты
             method = "fallback"
-            logger.info(f"🔄 Используем фоллбэк теги: {tags}")
+            logger.info("🔄 Используем фоллбэк теги: %s", tags)
         
         # Дополнительная проверка, что теги не потерялись
         if not tags:
             logger.error("❌ Теги полностью отсутствуют! Добавляем базовые теги...")
             tags = ["anime", "art", "picture"]
 
-        logger.info(f"🏷️ Получено {len(tags)} тегов через {method}")
-        logger.info(f"📝 Теги: {tags}")
+        logger.info("🏷️ Получено %d тегов через %s", len(tags), method)
+        logger.debug("📝 Теги: %s", tags)
+        await finish_stage("tagged", post_id, stage, stage_started, tags=len(tags), method=method)
 
         # Для waifu объединяем теги
         if is_waifu:
             original_tags = post['waifu_data']["tags"]
             all_tags = list(set(original_tags + tags))
-            logger.info(f"📊 Всего тегов для LM Studio: {len(all_tags)}")
+            logger.info("📊 Всего тегов для LM Studio: %d", len(all_tags))
         else:
             all_tags = tags
 
         # Генерируем описание
+        stage = "description"
+        stage_started = time.perf_counter()
         logger.info("💭 Генерируем описание через LM Studio...")
         desc, desc_prompt = await process_tags_with_lm(all_tags)
-        logger.info(f"✍️ Описание сгенерировано: {len(desc)} символов")
+        logger.info("✍️ Описание сгенерировано: %d символов", len(desc))
+        await finish_stage("described", post_id, stage, stage_started, chars=len(desc), model=LM_MODEL)
 
         # Фильтруем теги для публикации (используем теги от AI, а не waifu)
         filtered_tags = filter_tags(tags)
         
-        logger.info(f"🏷️ После фильтрации: {len(filtered_tags)} тегов из {len(tags)}")
-        logger.info(f"🔍 Исходные AI теги: {tags[:10]}")
-        logger.info(f"✅ Отфильтрованные теги: {filtered_tags}")
+        logger.info("🏷️ После фильтрации: %d тегов из %d", len(filtered_tags), len(tags))
+        logger.debug("🔍 Исходные AI теги: %s", tags[:10])
+        logger.debug("✅ Отфильтрованные теги: %s", filtered_tags)
 
         # Создаем caption
         hashtags = [f"#{t.replace(' ', '_').replace('-', '_')}" for t in filtered_tags[:10] if t.strip()]
-        logger.info(f"📝 Создано хештегов: {len(hashtags)}")
-        logger.info(f"📝 Хештеги: {hashtags}")
+        logger.info("📝 Создано хештегов: %d", len(hashtags))
+        logger.debug("📝 Хештеги: %s", hashtags)
         
         hashtag_string = " ".join(hashtags) if hashtags else ""
         caption = f"{desc}\n\n{hashtag_string}"
         
-        logger.info(f"📄 Итоговый caption длиной {len(caption)} символов:")
-        logger.info(f"📄 Caption: {caption[:200]}{'...' if len(caption) > 200 else ''}")
+        logger.info("📄 Итоговый caption длиной %d символов:", len(caption))
+        logger.info("📄 Caption: %s%s", caption[:200], '...' if len(caption) > 200 else '')
 
         # Отправляем через USER API с "Отправить позже"!
+        stage = "telegram"
+        stage_started = time.perf_counter()
         logger.info("📤 Отправляем в отложку Telegram через USER API...")
-        await send_photo(img_bytes, caption=caption, schedule_date=scheduled_time)
+        is_album = not is_waifu and post.get("is_gallery") and len(post["media_paths"]) > 1
+        if is_album and not SCHEDULED_MEDIA_GROUP:
+            logger.warning("⚠️ send_media_group бэкенда не принимает schedule_date: "
+                           "в отложку уходит только первое изображение галереи")
+            is_album = False
+        if is_album:
+            # Первое изображение уже прочитано для AI, остальные — один раз, одновременно
+            gallery_rest = await read_media_files(post["media_paths"][1:])
+            logger.info("📚 Галерея из %d изображений", len(gallery_rest) + 1)
+            if USE_OUTBOX:
+                await enqueue_scheduled_post(post, "gallery", img_bytes, caption, scheduled_time, source,
+                                             gallery_media=gallery_rest)
+            else:
+                # Подпись — только к первому изображению
+                await send_media_group([{'media': img_bytes, 'caption': caption}] +
+                                       [{'media': data} for data in gallery_rest],
+                                       schedule_date=scheduled_time)
+        elif USE_OUTBOX:
+            await enqueue_scheduled_post(post, "gallery" if post.get("is_gallery") else "image", img_bytes, caption,
+                                         scheduled_time, source)
+        else:
+            await send_photo(img_bytes, caption=caption, schedule_date=scheduled_time)
+        observe_stage(stage, stage_started)
 
         # Сохраняем в обычную БД постов для истории
+        stage = "save"
+        stage_started = time.perf_counter()
         logger.info("💾 Сохраняем в БД для истории...")
         await save_post_to_db(
             image_url=post["post_id"],
             image_data=img_bytes,
             description=desc,
             tags="|".join(tag.strip() for tag in all_tags if tag.strip()),
-            published_at=scheduled_time.isoformat(),
+            published_at=to_epoch(scheduled_time),
             interrogate_model=method,
             interrogate_method=method,
             interrogate_prompt=f"{source}_interrogate",
@@ -433,11 +505,16 @@ async def process_single_post_for_scheduling(post: dict, scheduled_time: datetim
             description_prompt=desc_prompt
         )
 
+        observe_stage(stage, stage_started)
+
         logger.info("✅ Пост добавлен в отложку Telegram через USER API")
+        await publish_event("scheduled", post_id, media_type=post["media_type"], scheduled_time=to_epoch(scheduled_time),
+                            duration=time.perf_counter() - started)
         return True
 
     except Exception as e:
         logger.error(f"❌ Ошибка при обработке поста для отложки: {e}")
+        await publish_event("failed", post_id, stage=stage, error=str(e))
         return False
 
 
@@ -449,7 +526,7 @@ async def process_single_reddit_post(post: dict) -> bool:
 
     # Обработка видео - отправляем без анализа
     if post["media_type"] == "video":
-        logger.info(f"🎥 Отправляем видео без AI-обработки")
+        logger.info("🎥 Отправляем видео без AI-обработки")
         await send_video(post["media_paths"][0])
         await mark_reddit_processed(post["post_id"])
         logger.info("✅ Видео отправлено и помечено как обработанное")
@@ -457,21 +534,23 @@ async def process_single_reddit_post(post: dict) -> bool:
     
     # Обработка GIF - отправляем как анимацию без анализа
     if post["media_type"] == "gif":
-        logger.info(f"🎞️ Отправляем GIF как анимацию без AI-обработки")
+        logger.info("🎞️ Отправляем GIF как анимацию без AI-обработки")
         await send_animation(post["media_paths"][0])
         await mark_reddit_processed(post["post_id"])
         logger.info("✅ GIF отправлен как анимация и помечен как обработанный")
         return True
 
     # Обработка изображений (одиночных или галереи)
-    logger.info(f"🖼️ Обрабатываем {'галерею' if post['is_gallery'] else 'изображение'}...")
+    logger.info("🖼️ Обрабатываем %s...", 'галерею' if post['is_gallery'] else 'изображение')
 
     # Для AI анализа используем только первое изображение
     first_image_path = post["media_paths"][0]
-    logger.info(f"🤖 Анализируем первое изображение через AI: {first_image_path}")
+    logger.info("🤖 Анализируем первое изображение через AI: %s", first_image_path)
 
-    img_bytes = open(first_image_path, "rb").read()
-    logger.info(f"📊 Размер изображения: {len(img_bytes) / 1024 / 1024:.2f} МБ")
+    # Галерея читается сразу целиком и один раз: те же байты идут в альбом и в БД
+    images = await read_media_files(post["media_paths"] if post['is_gallery'] else [first_image_path])
+    img_bytes = images[0]
+    logger.info("📊 Размер изображения: %.2f МБ", len(img_bytes) / 1024 / 1024)
 
     # Получаем теги от AI
     logger.info("🔮 Запускаем анализ через AI...")
@@ -483,19 +562,19 @@ async def process_single_reddit_post(post: dict) -> bool:
     if not tags:
         tags, method = await interrogate_deepbooru(img_bytes)
 
-    logger.info(f"🏷️ Получено {len(tags)} тегов через {method}")
+    logger.info("🏷️ Получено %d тегов через %s", len(tags), method)
     if tags:
-        logger.debug(f"📝 Примеры тегов: {tags[:5]}")
+        logger.debug("📝 Примеры тегов: %s", tags[:5])
 
     # Генерируем описание
     logger.info("💭 Генерируем описание через LM Studio...")
     desc, desc_prompt = await process_tags_with_lm(tags)
-    logger.info(f"✍️ Описание сгенерировано: {len(desc)} символов")
+    logger.info("✍️ Описание сгенерировано: %d символов", len(desc))
 
     # Фильтруем теги для публикации
     filtered_tags = filter_tags(tags)
-    logger.info(f"🏷️ После фильтрации: {len(filtered_tags)} тегов из {len(tags)}")
-    logger.debug(f"📝 Отфильтрованные теги: {filtered_tags}")
+    logger.info("🏷️ После фильтрации: %d тегов из %d", len(filtered_tags), len(tags))
+    logger.debug("📝 Отфильтрованные теги: %s", filtered_tags)
 
     # Убираем пустые теги и создаем хештеги
     hashtags = [f"#{t.replace(' ', '_').replace('-', '_')}" for t in filtered_tags[:10] if t.strip()]
@@ -503,18 +582,10 @@ async def process_single_reddit_post(post: dict) -> bool:
 
     # Отправляем в Telegram
     if post['is_gallery'] and len(post['media_paths']) > 1:
-        logger.info(f"📤 Отправляем галерею из {len(post['media_paths'])} изображений...")
-
-        # Подготавливаем все изображения для отправки группой
-        media_items = []
-        for i, path in enumerate(post['media_paths']):
-            with open(path, 'rb') as f:
-                media_bytes = f.read()
-                # Добавляем подпись только к первому изображению
-                media_items.append({
-                    'media': media_bytes,
-                    'caption': caption if i == 0 else None
-                })
+        logger.info("📤 Отправляем галерею из %d изображений...", len(post['media_paths']))
+
+        # Подпись — только к первому изображению; альбомы по 10 и подготовка — в send_media_group
+        media_items = [{'media': data, 'caption': caption if i == 0 else None} for i, data in enumerate(images)]
 
         try:
             await send_media_group(media_items)
@@ -523,18 +594,20 @@ async def process_single_reddit_post(post: dict) -> bool:
             logger.info("🔄 Галерея не может быть отправлена, пропускаем этот пост")
             return False
 
-        # Сохраняем каждое изображение в БД
-        for i, path in enumerate(post['media_paths']):
-            with open(path, 'rb') as f:
-                img_data = f.read()
+        # Теги интернируются один раз и переиспользуются для всех изображений галереи
+        tags_joined = "|".join(tag.strip() for tag in tags if tag.strip())
+        tag_ids = await intern_tags(tags)
 
-            logger.info(f"💾 Сохраняем изображение #{i + 1} в БД...")
+        # Сохраняем каждое изображение в БД
+        for i, img_data in enumerate(images):
+            logger.info("💾 Сохраняем изображение #%d в БД...", i + 1)
             await save_post_to_db(
+                tag_ids=tag_ids,
                 image_url=f"{post['post_id']}_image_{i}",
                 image_data=img_data,
                 description=desc if i == 0 else f"Изображение {i + 1} из галереи",
-                tags="|".join(tag.strip() for tag in tags if tag.strip()),
-                published_at=datetime.now().isoformat(),
+                tags=tags_joined,
+                published_at=utc_now(),
                 interrogate_model=method if i == 0 else "gallery_item",
                 interrogate_method=method if i == 0 else "gallery_item",
                 interrogate_prompt="reddit_gallery_interrogate",
@@ -558,7 +631,7 @@ async def process_single_reddit_post(post: dict) -> bool:
             image_data=img_bytes,
             description=desc,
             tags="|".join(tag.strip() for tag in tags if tag.strip()),
-            published_at=datetime.now().isoformat(),
+            published_at=utc_now(),
             interrogate_model=method,
             interrogate_method=method,
             interrogate_prompt="reddit_interrogate",
@@ -572,7 +645,16 @@ async def process_single_reddit_post(post: dict) -> bool:
 
 
 async def schedule_batch_posts():
-    """Новый цикл обработки - создает 8 отложенных постов"""
+    """Батч отложенных постов с трассировкой (traces/<id батча>.json)"""
+    batch_id = begin_batch()
+    logger.info(f"🆔 Батч {batch_id}")
+    with trace_batch(batch_id) as batch_span:
+        processed_posts = await create_scheduled_posts()
+        batch_span.set(scheduled=processed_posts)
+
+
+async def create_scheduled_posts() -> int:
+    """Новый цикл обработки - создает 8 отложенных постов, возвращает число запланированных"""
     logger.info("=" * 60)
     logger.info("🚀 НАЧАЛО СОЗДАНИЯ ОТЛОЖЕННЫХ ПОСТОВ")
     logger.info("=" * 60)
@@ -582,12 +664,14 @@ async def schedule_batch_posts():
     # Рассчитываем времена публикации для 8 постов
     publish_times = calculate_publish_times(8)
     logger.info(f"⏰ Рассчитанные времена публикации:")
-    for i, time in enumerate(publish_times):
-        logger.info(f"   Пост #{i + 1}: {time.strftime('%Y-%m-%d %H:%M')}")
+    for i, publish_time in enumerate(publish_times):
+        logger.info(f"   Пост #{i + 1}: {publish_time.strftime('%Y-%m-%d %H:%M')}")
 
     processed_posts = 0
     target_posts = 8
 
+    await publish_event("batch_started", target=target_posts)
+
     # Проходим по всем subreddit в порядке приоритета
     for idx, subreddit in enumerate(SUBREDDITS):
         if processed_posts >= target_posts:
@@ -596,7 +680,8 @@ async def schedule_batch_posts():
         logger.info(f"🔍 Обрабатываем subreddit #{idx + 1}/{len(SUBREDDITS)}: r/{subreddit}")
         
         # Получаем больше постов чем нужно, на случай дубликатов или ошибок
-        posts = fetch_latest_posts(subreddit, limit=15)
+        # Клиент Reddit синхронный (requests) — в отдельном потоке, event loop не блокируется
+        posts = await asyncio.to_thread(fetch_latest_posts, subreddit, 15)
         if not posts:
             logger.info(f"📭 Новых медиа-постов в r/{subreddit} не найдено")
             continue
@@ -612,9 +697,20 @@ async def schedule_batch_posts():
                 logger.info(f"⏭️ Пост {post['post_id']} уже был обработан ранее")
                 continue
 
+            await publish_event("candidate", post["post_id"], source="reddit", subreddit=subreddit, media_type=post["media_type"])
+
             try:
                 # Обрабатываем пост для отложенной публикации
-                success = await process_single_post_for_scheduling(post, publish_times[processed_posts])
+                POSTS_IN_PROGRESS.inc()
+                post_token = current_post.set(post["post_id"])
+                try:
+                    with span("post", category="post", new_track=True, post_id=post["post_id"], source="reddit") as post_span:
+                        success = await process_single_post_for_scheduling(post, publish_times[processed_posts])
+                        post_span.set(success=success)
+                finally:
+                    current_post.reset(post_token)
+                    POSTS_IN_PROGRESS.dec()
+                POSTS.labels("reddit", "scheduled" if success else "failed").inc()
                 if success:
                     await mark_reddit_processed(post["post_id"])
                     processed_posts += 1
@@ -654,7 +750,17 @@ async def schedule_batch_posts():
                         'waifu_data': item  # Сохраняем оригинальные данные
                     }
                     
-                    scheduled_post_data = await process_single_post_for_scheduling(waifu_post, publish_times[processed_posts])
+                    await publish_event("candidate", waifu_post["post_id"], source="waifu", media_type="image")
+                    POSTS_IN_PROGRESS.inc()
+                    post_token = current_post.set(waifu_post["post_id"])
+                    try:
+                        with span("post", category="post", new_track=True, post_id=waifu_post["post_id"], source="waifu") as post_span:
+                            scheduled_post_data = await process_single_post_for_scheduling(waifu_post, publish_times[processed_posts])
+                            post_span.set(success=scheduled_post_data)
+                    finally:
+                        current_post.reset(post_token)
+                        POSTS_IN_PROGRESS.dec()
+                    POSTS.labels("waifu", "scheduled" if scheduled_post_data else "failed").inc()
                     if scheduled_post_data:
                         processed_posts += 1
                         logger.info(f"✅ Waifu пост #{processed_posts} запланирован на {publish_times[processed_posts-1].strftime('%H:%M %d.%m')}")
@@ -669,40 +775,68 @@ async def schedule_batch_posts():
     elapsed = (datetime.now() - start_time).total_seconds()
     logger.info(f"⏱️ Время создания {processed_posts} отложенных постов: {elapsed:.1f} сек")
     logger.info(f"📈 Статистика: {processed_posts}/{target_posts} постов запланировано")
+    await publish_event("batch_finished", processed=processed_posts, target=target_posts, duration=elapsed)
+    BATCH_SECONDS.observe(elapsed)
+    BATCH_SCHEDULED.set(processed_posts)
     logger.info("=" * 60 + "\n")
+    return processed_posts
 
 
-async def process_cycle():
+async def process_cycle(profile: bool = False):
     """Основной цикл обработки - теперь только создает отложенные посты"""
-    await schedule_batch_posts()
+    if profile:
+        await run_profiled(schedule_batch_posts)
+    else:
+        await schedule_batch_posts()
 
 
 
-async def main():
+async def main(profile: bool = False):
     """Главная функция"""
     logger.info("🚀 Запуск системы создания отложенных постов TgPoster")
     logger.info(f"📋 Конфигурация:")
     logger.info(f"   - Subreddits ({len(SUBREDDITS)}): {', '.join(f'r/{s}' for s in SUBREDDITS)}")
     logger.info(f"   - Tagger: {'включен' if USE_TAGGER else 'выключен'}")
     logger.info(f"   - LM Model: {LM_MODEL}")
+    logger.info(f"   - Профилирование: {'включено' if profile else 'выключено'}")
 
     # Инициализация БД
     logger.info("🗄️ Инициализация базы данных...")
     await init_db()
+    await init_events_db()
+    try:
+        await start_metrics_server()
 
-    # Проверяем доступ к каналу
-    logger.info("📡 Проверяем подключение к Telegram...")
-    if not await check_channel_access():
-        logger.error("❌ Нет доступа к каналу! Проверьте, что бот добавлен в канал как администратор")
-        return
+        # Проверяем доступ к каналу
+        logger.info("📡 Проверяем подключение к Telegram...")
+        if not await check_channel_access():
+            logger.error("❌ Нет доступа к каналу! Проверьте, что бот добавлен в канал как администратор")
+            return
 
-    # Запуск создания отложенных постов
-    logger.info("▶️ Запуск создания отложенных постов...")
-    await process_cycle()
+        # Запуск создания отложенных постов
+        logger.info("▶️ Запуск создания отложенных постов...")
+        await process_cycle(profile)
 
-    logger.info("✅ Создание отложенных постов завершено!")
-    logger.info("💡 Посты добавлены в отложку Telegram и будут автоматически опубликованы по расписанию")
+        logger.info("✅ Создание отложенных постов завершено!")
+
+        # Очистка старых данных после батча, пока публикация не идет
+        logger.info("🧹 Запуск retention...")
+        try:
+            await run_retention()
+        except Exception as e:
+            # БД занята outbox или дашбордом: батч уже выполнен, очистка повторится после следующего
+            logger.error(f"❌ Ошибка retention: {e}")
+        if USE_OUTBOX:
+            logger.info("💡 Посты в scheduled_posts: их опубликует python -m services.outbox_service по расписанию")
+        else:
+            logger.info("💡 Посты добавлены в отложку Telegram и будут автоматически опубликованы по расписанию")
+    finally:
+        await close_events_db()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Создание отложенных постов TgPoster")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"профилировать батч (или {PROFILE_ENV}=1), результаты в profiles/")
+    args = parser.parse_args()
+    asyncio.run(main(profiling_enabled(args.profile)))
\ No newline at end of file
@@ -1,106 +1,948 @@
+import io
 import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
 import yaml
 import aiosqlite
 from datetime import datetime
+from .prompt_service import prompt_hash, NEGATIVE_EXAMPLES_VERSION_KEY
+from .metrics_service import DB_SECONDS, timed
 
 DATABASE_PATH = os.getenv("DATABASE_PATH", "telegram_bot.db")
 
 with open("vars.yaml", encoding="utf-8") as f:
     SQL = yaml.load(f, Loader=yaml.FullLoader)["queries"]
 
+# Все время в БД хранится как UTC epoch (целые секунды) — так диапазонные
+# запросы вида "created_at >= ?" используют индексы
+EPOCH_NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+REDDIT_POSTS_DDL = """
+    CREATE TABLE IF NOT EXISTS reddit_posts(
+      post_id TEXT PRIMARY KEY,
+      processed_at INTEGER
+    );
+"""
+
+SCHEDULED_POSTS_DDL = f"""
+    CREATE TABLE IF NOT EXISTS scheduled_posts(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      post_id TEXT NOT NULL,
+      title TEXT,
+      media_type TEXT,
+      media_data BLOB,
+      media_digest TEXT,
+      caption TEXT,
+      scheduled_time INTEGER NOT NULL,
+      status TEXT DEFAULT 'pending',
+      source TEXT DEFAULT 'reddit',
+      error_message TEXT,
+      created_at INTEGER NOT NULL DEFAULT ({EPOCH_NOW_SQL}),
+      sent_at INTEGER,
+      message_id INTEGER,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt_at INTEGER,
+      claimed_at INTEGER
+    );
+"""
+
+# Словарь тегов: каждый тег хранится один раз, посты ссылаются на него по id
+TAGS_DDL = """
+    CREATE TABLE IF NOT EXISTS tags(
+      id INTEGER PRIMARY KEY,
+      name TEXT NOT NULL UNIQUE
+    );
+"""
+
+POST_TAGS_DDL = """
+    CREATE TABLE IF NOT EXISTS post_tags(
+      post_id INTEGER NOT NULL,
+      tag_id INTEGER NOT NULL,
+      position INTEGER NOT NULL,
+      PRIMARY KEY (post_id, tag_id)
+    ) WITHOUT ROWID;
+"""
+
+# Промпты (шаблоны, стартовые фразы, interrogate-промпты) хранятся один раз по хешу
+PROMPT_TEMPLATES_DDL = f"""
+    CREATE TABLE IF NOT EXISTS prompt_templates(
+      id INTEGER PRIMARY KEY,
+      hash TEXT NOT NULL UNIQUE,
+      kind TEXT NOT NULL,
+      body TEXT NOT NULL,
+      created_at INTEGER NOT NULL DEFAULT ({EPOCH_NOW_SQL})
+    );
+"""
+
+# Служебные значения (версии кешей и т.п.), общие для бота и дашборда
+APP_META_DDL = """
+    CREATE TABLE IF NOT EXISTS app_meta(
+      key TEXT PRIMARY KEY,
+      value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+"""
+
+# file_id уже загруженных в Telegram медиа: повторная отправка того же содержимого идет по file_id, без загрузки.
+# kind — тип отправки (photo/video/animation): file_id одного типа не подходит для другого
+TELEGRAM_MEDIA_CACHE_DDL = f"""
+    CREATE TABLE IF NOT EXISTS telegram_media_cache(
+      media_digest TEXT NOT NULL,
+      kind TEXT NOT NULL,
+      file_id TEXT NOT NULL,
+      file_unique_id TEXT,
+      created_at INTEGER NOT NULL DEFAULT ({EPOCH_NOW_SQL}),
+      PRIMARY KEY (media_digest, kind)
+    ) WITHOUT ROWID;
+"""
+
+# Остальные изображения отложенной галереи (первое — в scheduled_posts.media_data), position с 1.
+# Строки живут столько же, сколько медиа поста: см. SCHEDULED_POST_MEDIA_TRIGGERS_DDL
+SCHEDULED_POST_MEDIA_DDL = """
+    CREATE TABLE IF NOT EXISTS scheduled_post_media(
+      id INTEGER PRIMARY KEY,
+      scheduled_post_id INTEGER NOT NULL,
+      position INTEGER NOT NULL,
+      media_data BLOB,
+      media_digest TEXT,
+      UNIQUE (scheduled_post_id, position)
+    );
+"""
+
+# foreign_keys в соединениях не включен — каскад триггерами: удаление поста и очистка его медиа (ретенция)
+SCHEDULED_POST_MEDIA_TRIGGERS_DDL = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_scheduled_post_media_delete AFTER DELETE ON scheduled_posts
+    BEGIN
+      DELETE FROM scheduled_post_media WHERE scheduled_post_id = OLD.id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_scheduled_post_media_strip AFTER UPDATE OF media_data ON scheduled_posts
+    WHEN NEW.media_data IS NULL
+    BEGIN
+      DELETE FROM scheduled_post_media WHERE scheduled_post_id = NEW.id;
+    END;
+    """,
+]
+
+INDEXES_DDL = [
+    "CREATE INDEX IF NOT EXISTS idx_post_logs_created_at ON post_logs(created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_post_logs_published_at ON post_logs(published_at);",
+    "CREATE INDEX IF NOT EXISTS idx_post_logs_marked ON post_logs(marked, created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_reddit_posts_processed_at ON reddit_posts(processed_at);",
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_status_time ON scheduled_posts(status, scheduled_time);",
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_sent_at ON scheduled_posts(sent_at);",
+    "CREATE INDEX IF NOT EXISTS idx_post_tags_tag ON post_tags(tag_id, post_id);",
+    "CREATE INDEX IF NOT EXISTS idx_post_logs_prompt ON post_logs(description_prompt_id, marked);",
+    "CREATE INDEX IF NOT EXISTS idx_post_logs_model ON post_logs(description_model, created_at);",
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_time ON scheduled_posts(scheduled_time);",
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_due ON scheduled_posts(status, next_attempt_at);",
+    "CREATE INDEX IF NOT EXISTS idx_post_logs_review ON post_logs(reviewed_at, created_at);",
+]
+
+
+# Сводные таблицы для дашборда. Поддерживаются триггерами в той же транзакции,
+# что и запись в исходные таблицы, поэтому виджеты читаются по первичному ключу
+# вместо COUNT(*)/GROUP BY по всей истории. Часовые бакеты (epoch / 3600)
+# позволяют собирать сутки в любом часовом поясе дашборда.
+HOUR_SECONDS = 60 * 60
+
+ROLLUP_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS stats_counters(
+      name TEXT PRIMARY KEY,
+      value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS post_stats_hourly(
+      hour INTEGER PRIMARY KEY,
+      posts INTEGER NOT NULL DEFAULT 0,
+      marked INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS post_stats_by_model(
+      model TEXT PRIMARY KEY,
+      posts INTEGER NOT NULL DEFAULT 0,
+      marked INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS post_stats_by_prompt(
+      prompt_id INTEGER PRIMARY KEY,
+      posts INTEGER NOT NULL DEFAULT 0,
+      marked INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scheduled_sent_hourly(
+      hour INTEGER PRIMARY KEY,
+      sent INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+]
+
+ROLLUP_TABLES = ["stats_counters", "post_stats_hourly", "post_stats_by_model",
+                 "post_stats_by_prompt", "scheduled_sent_hourly"]
+
+
+def _bump_counter(name_sql: str, delta_sql: str) -> str:
+    return (f"INSERT INTO stats_counters(name, value) VALUES ({name_sql}, {delta_sql}) "
+            f"ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;")
+
+
+def _post_rollup_sql(row: str, sign: int) -> str:
+    """Изменения сводок при добавлении (sign=1) или удалении (sign=-1) строки post_logs"""
+    marked = f"{sign} * (CASE WHEN {row}.marked = 1 THEN 1 ELSE 0 END)"
+    return f"""
+        {_bump_counter("'posts'", str(sign))}
+        {_bump_counter("'marked'", marked)}
+        INSERT INTO post_stats_hourly(hour, posts, marked) VALUES ({row}.created_at / {HOUR_SECONDS}, {sign}, {marked})
+          ON CONFLICT(hour) DO UPDATE SET posts = posts + excluded.posts, marked = marked + excluded.marked;
+        INSERT INTO post_stats_by_model(model, posts, marked) SELECT {row}.description_model, {sign}, {marked}
+          WHERE {row}.description_model IS NOT NULL
+          ON CONFLICT(model) DO UPDATE SET posts = posts + excluded.posts, marked = marked + excluded.marked;
+        INSERT INTO post_stats_by_prompt(prompt_id, posts, marked) SELECT {row}.description_prompt_id, {sign}, {marked}
+          WHERE {row}.description_prompt_id IS NOT NULL
+          ON CONFLICT(prompt_id) DO UPDATE SET posts = posts + excluded.posts, marked = marked + excluded.marked;
+    """
+
+
+def _scheduled_rollup_sql(row: str, sign: int) -> str:
+    """Изменения сводок при добавлении (sign=1) или удалении (sign=-1) строки scheduled_posts"""
+    return f"""
+        {_bump_counter(f"'scheduled:' || COALESCE({row}.status, '')", str(sign))}
+        INSERT INTO scheduled_sent_hourly(hour, sent) SELECT {row}.sent_at / {HOUR_SECONDS}, {sign}
+          WHERE {row}.status = 'sent' AND {row}.sent_at IS NOT NULL
+          ON CONFLICT(hour) DO UPDATE SET sent = sent + excluded.sent;
+    """
+
+
+def _post_tags_rollup_sql(row: str, sign: int) -> str:
+    """Число связей пост-тег и постов с тегами (по первому тегу поста)"""
+    return f"""
+        {_bump_counter("'tag_links'", str(sign))}
+        {_bump_counter("'tagged_posts'", f"{sign} * ({row}.position = 0)")}
+    """
+
+
+ROLLUP_TRIGGERS_DDL = [
+    f"CREATE TRIGGER IF NOT EXISTS trg_post_logs_rollup_ins AFTER INSERT ON post_logs BEGIN {_post_rollup_sql('NEW', 1)} END;",
+    f"CREATE TRIGGER IF NOT EXISTS trg_post_logs_rollup_del AFTER DELETE ON post_logs BEGIN {_post_rollup_sql('OLD', -1)} END;",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_post_logs_rollup_upd
+        AFTER UPDATE OF marked, created_at, description_model, description_prompt_id ON post_logs
+        BEGIN {_post_rollup_sql('OLD', -1)} {_post_rollup_sql('NEW', 1)} END;""",
+    f"CREATE TRIGGER IF NOT EXISTS trg_scheduled_posts_rollup_ins AFTER INSERT ON scheduled_posts BEGIN {_scheduled_rollup_sql('NEW', 1)} END;",
+    f"CREATE TRIGGER IF NOT EXISTS trg_scheduled_posts_rollup_del AFTER DELETE ON scheduled_posts BEGIN {_scheduled_rollup_sql('OLD', -1)} END;",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_scheduled_posts_rollup_upd
+        AFTER UPDATE OF status, sent_at ON scheduled_posts
+        BEGIN {_scheduled_rollup_sql('OLD', -1)} {_scheduled_rollup_sql('NEW', 1)} END;""",
+    f"CREATE TRIGGER IF NOT EXISTS trg_post_tags_rollup_ins AFTER INSERT ON post_tags BEGIN {_post_tags_rollup_sql('NEW', 1)} END;",
+    f"CREATE TRIGGER IF NOT EXISTS trg_post_tags_rollup_del AFTER DELETE ON post_tags BEGIN {_post_tags_rollup_sql('OLD', -1)} END;",
+]
+
+# Полнотекстовый индекс по описаниям и тегам. External content: текст не
+# дублируется, индекс ссылается на post_logs.id и синхронизируется триггерами
+POST_LOGS_FTS_DDL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS post_logs_fts USING fts5(
+      description, tags,
+      content='post_logs', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2'
+    );
+"""
+
+FTS_TRIGGERS_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS trg_post_logs_fts_ins AFTER INSERT ON post_logs BEGIN
+        INSERT INTO post_logs_fts(rowid, description, tags) VALUES (NEW.id, NEW.description, NEW.tags);
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS trg_post_logs_fts_del AFTER DELETE ON post_logs BEGIN
+        INSERT INTO post_logs_fts(post_logs_fts, rowid, description, tags) VALUES ('delete', OLD.id, OLD.description, OLD.tags);
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS trg_post_logs_fts_upd AFTER UPDATE OF description, tags ON post_logs BEGIN
+        INSERT INTO post_logs_fts(post_logs_fts, rowid, description, tags) VALUES ('delete', OLD.id, OLD.description, OLD.tags);
+        INSERT INTO post_logs_fts(rowid, description, tags) VALUES (NEW.id, NEW.description, NEW.tags);
+    END;""",
+]
+
+# Полный пересчет сводок из исходных таблиц (бэкфилл и восстановление)
+ROLLUP_REBUILD_SQL = [
+    *(f"DELETE FROM {table};" for table in ROLLUP_TABLES),
+    """
+    INSERT INTO stats_counters(name, value)
+    SELECT 'posts', COUNT(*) FROM post_logs
+    UNION ALL SELECT 'marked', COUNT(*) FROM post_logs WHERE marked = 1
+    UNION ALL SELECT 'tag_links', COUNT(*) FROM post_tags
+    UNION ALL SELECT 'tagged_posts', COUNT(*) FROM post_tags WHERE position = 0
+    UNION ALL SELECT 'scheduled:' || COALESCE(status, ''), COUNT(*) FROM scheduled_posts GROUP BY status;
+    """,
+    f"""
+    INSERT INTO post_stats_hourly(hour, posts, marked)
+    SELECT created_at / {HOUR_SECONDS}, COUNT(*), SUM(CASE WHEN marked = 1 THEN 1 ELSE 0 END)
+    FROM post_logs GROUP BY 1;
+    """,
+    """
+    INSERT INTO post_stats_by_model(model, posts, marked)
+    SELECT description_model, COUNT(*), SUM(CASE WHEN marked = 1 THEN 1 ELSE 0 END)
+    FROM post_logs WHERE description_model IS NOT NULL GROUP BY 1;
+    """,
+    """
+    INSERT INTO post_stats_by_prompt(prompt_id, posts, marked)
+    SELECT description_prompt_id, COUNT(*), SUM(CASE WHEN marked = 1 THEN 1 ELSE 0 END)
+    FROM post_logs WHERE description_prompt_id IS NOT NULL GROUP BY 1;
+    """,
+    f"""
+    INSERT INTO scheduled_sent_hourly(hour, sent)
+    SELECT sent_at / {HOUR_SECONDS}, COUNT(*)
+    FROM scheduled_posts WHERE status = 'sent' AND sent_at IS NOT NULL GROUP BY 1;
+    """,
+]
+
+
+def utc_now() -> int:
+    """Текущее время в формате БД (UTC epoch, секунды)"""
+    return int(time.time())
+
+
+def to_epoch(value: datetime) -> int:
+    """Переводит datetime в UTC epoch. Наивные datetime считаются локальным временем"""
+    return int(value.timestamp())
+
+
+def media_digest(data: bytes):
+    """sha256 содержимого медиа: по нему дашборд кеширует превью, не читая BLOB"""
+    return hashlib.sha256(data).hexdigest() if data else None
+
+
+def media_file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 файла по частям, без чтения целиком; совпадает с media_digest его содержимого"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Медиа отложенных постов пишется в BLOB и читается из него частями (incremental blob I/O):
+# видео не загружается в память целиком ни при сохранении, ни при отправке
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+
+class BlobReader(io.RawIOBase):
+    """
+    Файл только для чтения поверх sqlite3.Blob. Держит свое соединение с БД, пока не закрыт;
+    read/seek/tell — как у файла, поэтому его можно отдать httpx (загрузка в Telegram) как файл
+    """
+
+    def __init__(self, db: sqlite3.Connection, blob, name: str = None):
+        super().__init__()
+        self._db = db
+        self._blob = blob
+        self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self._blob.read(size)
+
+    def readinto(self, buffer) -> int:
+        data = self._blob.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # sqlite3.Blob.seek ничего не возвращает, а httpx по результату seek узнает длину тела
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def tell(self) -> int:
+        return self._blob.tell()
+
+    def __len__(self) -> int:
+        return len(self._blob)
+
+    def close(self):
+        if not self.closed:
+            self._blob.close()
+            self._db.close()
+        super().close()
+
+
+def open_media_blob(table: str, column: str, row_id: int, name: str = None) -> BlobReader:
+    """BLOB строки как файл для чтения частями; закрыть после использования"""
+    # Соединение открывается в потоке to_thread, а читает httpx в потоке event loop
+    db = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    try:
+        return BlobReader(db, db.blobopen(table, column, row_id, readonly=True), name)
+    except Exception:
+        db.close()
+        raise
+
+
+def split_tags(raw) -> list:
+    """
+    Разбирает теги из post_logs.tags во всех встречавшихся форматах:
+    "tag1|tag2", JSON-список (старый main2.py) и "tag1, tag2"
+    """
+    if not raw:
+        return []
+    if isinstance(raw, (list, tuple)):
+        items = raw
+    elif raw.startswith("["):
+        try:
+            items = json.loads(raw)
+        except ValueError:
+            items = raw.strip("[]").split(",")
+    elif "|" in raw:
+        items = raw.split("|")
+    else:
+        items = raw.split(",")
+
+    result = []
+    for item in items:
+        tag = str(item).strip()
+        if tag and tag not in result:
+            result.append(tag)
+    return result
+
+
+async def intern_tags_with(db, tags) -> list:
+    """Возвращает id тегов из словаря tags, добавляя недостающие (на открытом соединении)"""
+    names = split_tags(tags)
+    if not names:
+        return []
+    await db.executemany("INSERT OR IGNORE INTO tags(name) VALUES (?)", [(name,) for name in names])
+    qmarks = ", ".join("?" for _ in names)
+    cur = await db.execute(f"SELECT name, id FROM tags WHERE name IN ({qmarks})", names)
+    ids = dict(await cur.fetchall())
+    return [ids[name] for name in names]
+
+
+async def link_post_tags(db, post_id: int, tag_ids: list):
+    """Связывает пост с тегами, сохраняя их порядок"""
+    await db.executemany(
+        "INSERT OR IGNORE INTO post_tags(post_id, tag_id, position) VALUES (?, ?, ?)",
+        [(post_id, tag_id, position) for position, tag_id in enumerate(tag_ids)]
+    )
+
+
+async def intern_prompt_with(db, kind: str, body: str) -> int:
+    """Возвращает id промпта в prompt_templates, добавляя его при первом использовании"""
+    key = prompt_hash(body)
+    await db.execute(
+        "INSERT OR IGNORE INTO prompt_templates(hash, kind, body) VALUES (?, ?, ?)",
+        (key, kind, body)
+    )
+    cur = await db.execute("SELECT id FROM prompt_templates WHERE hash = ?", (key,))
+    return (await cur.fetchone())[0]
+
+
+async def description_prompt_columns(db, prompt) -> tuple:
+    """
+    Раскладывает промпт описания на id шаблона и компактные переменные (JSON).
+    prompt — части (template, starter, tags, negative_ids, negatives, note) из lm_service.process_tags_with_lm
+    или main2.process_tags_with_lm либо готовая строка
+    """
+    if isinstance(prompt, str):
+        return await intern_prompt_with(db, "description", prompt), None
+
+    prompt_vars = {
+        "starter_id": await intern_prompt_with(db, "starter", prompt["starter"]),
+        "tag_ids": await intern_tags_with(db, prompt["tags"]),
+        "negative_ids": prompt["negative_ids"],
+    }
+    if prompt.get("negatives"):
+        # Текст примеров — в prompt_templates: промпт пересобирается и после архивации помеченных постов
+        prompt_vars["negative_prompt_ids"] = [
+            await intern_prompt_with(db, "negative", text) for text in prompt["negatives"]
+        ]
+    if prompt.get("note"):
+        prompt_vars["note"] = prompt["note"]
+    template_id = await intern_prompt_with(db, "description", prompt["template"])
+    return template_id, json.dumps(prompt_vars, ensure_ascii=False, separators=(",", ":"))
+
+
+async def _migrate_post_tags(db):
+    """Заполняет tags/post_tags из старой колонки post_logs.tags"""
+    await db.execute(TAGS_DDL)
+    await db.execute(POST_TAGS_DDL)
+    cur = await db.execute("SELECT id, tags FROM post_logs WHERE tags IS NOT NULL AND tags != ''")
+    for post_id, raw_tags in await cur.fetchall():
+        await link_post_tags(db, post_id, await intern_tags_with(db, raw_tags))
+
+
+def _epoch_expr(column: str, local: bool) -> str:
+    """SQL-выражение, переводящее старое текстовое значение времени в UTC epoch"""
+    modifier = ", 'utc'" if local else ""
+    return (
+        f"CASE WHEN {column} IS NULL OR typeof({column}) = 'integer' THEN {column} "
+        f"ELSE CAST(strftime('%s', {column}{modifier}) AS INTEGER) END"
+    )
+
+
+async def _table_columns(db, table: str) -> dict:
+    """Колонки таблицы: имя -> объявленный тип"""
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1]: row[2] for row in await cur.fetchall()}
+
+
+async def _add_column(db, table: str, column: str, decl: str):
+    """ALTER TABLE ADD COLUMN, если колонки еще нет"""
+    if column not in await _table_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _rebuild_table(db, table: str, create_sql: str, converters: dict, drop_columns=()):
+    """
+    Пересоздает таблицу по актуальной схеме, перенося данные.
+    converters: колонка -> SQL-выражение для переноса значения.
+    Старые колонки, которых нет в актуальной схеме, сохраняются, пока их явно
+    не удалит своя миграция через drop_columns — схема в create_sql всегда
+    последняя, а миграции применяются по порядку.
+    """
+    old_columns = await _table_columns(db, table)
+
+    await db.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    await db.execute(create_sql)
+    new_columns = await _table_columns(db, table)
+    for column, decl in old_columns.items():
+        if column not in new_columns and column not in drop_columns:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+    columns = [col for col in old_columns if col not in drop_columns]
+    select_exprs = [converters.get(col, col) for col in columns]
+    await db.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(select_exprs)} FROM {table}_old"
+    )
+    await db.execute(f"DROP TABLE {table}_old")
+
+
+async def _migrate_epoch_timestamps(db):
+    """
+    Переводит все колонки времени в UTC epoch.
+    Раньше писались: isoformat() локального времени, CURRENT_TIMESTAMP (UTC)
+    и datetime('now', 'localtime') — учитываем источник каждой колонки.
+    """
+    await _rebuild_table(db, "post_logs", SQL["create_table_q"], {
+        "published_at": _epoch_expr("published_at", local=True),
+        "created_at": _epoch_expr("created_at", local=False),
+    })
+    await _rebuild_table(db, "scheduled_posts", SCHEDULED_POSTS_DDL, {
+        "scheduled_time": _epoch_expr("scheduled_time", local=True),
+        "created_at": _epoch_expr("created_at", local=False),
+        "sent_at": _epoch_expr("sent_at", local=True),
+    })
+    await db.execute(f"UPDATE reddit_posts SET processed_at = {_epoch_expr('processed_at', local=True)}")
+
+
+async def _migrate_prompt_templates(db):
+    """
+    Переносит полные промпты из post_logs в prompt_templates.
+    Старые промпты не разбираются на части: каждый уникальный текст становится
+    шаблоном без переменных и пересобирается как есть.
+    """
+    await db.execute(PROMPT_TEMPLATES_DDL)
+    await _add_column(db, "post_logs", "description_prompt_vars", "TEXT")
+    for column, kind in (("description_prompt", "description"), ("interrogate_prompt", "interrogate")):
+        await _add_column(db, "post_logs", f"{column}_id", "INTEGER")
+        cur = await db.execute(f"SELECT id, {column} FROM post_logs WHERE {column} IS NOT NULL")
+        updates = []
+        async for post_id, body in cur:
+            updates.append((await intern_prompt_with(db, kind, body), post_id))
+        await db.executemany(f"UPDATE post_logs SET {column}_id = ? WHERE id = ?", updates)
+
+    # Пересоздаем таблицу без колонок с полными текстами
+    await _rebuild_table(db, "post_logs", SQL["create_table_q"], {},
+                         drop_columns=("description_prompt", "interrogate_prompt"))
+
+
+async def _migrate_media_digests(db):
+    """Добавляет image_digest/media_digest и считает их для уже сохраненных медиа"""
+    for table, blob_column, digest_column in (("post_logs", "image_data", "image_digest"),
+                                              ("scheduled_posts", "media_data", "media_digest")):
+        await _add_column(db, table, digest_column, "TEXT")
+        cur = await db.execute(f"SELECT id, {blob_column} FROM {table} WHERE {blob_column} IS NOT NULL")
+        updates = []
+        async for row_id, data in cur:
+            updates.append((media_digest(data), row_id))
+        await db.executemany(f"UPDATE {table} SET {digest_column} = ? WHERE id = ?", updates)
+
+
+async def _migrate_review(db):
+    """Добавляет reviewed_at и app_meta; уже помеченные посты считаются просмотренными"""
+    await db.execute(APP_META_DDL)
+    await _add_column(db, "post_logs", "reviewed_at", "INTEGER")
+    await db.execute("UPDATE post_logs SET reviewed_at = created_at WHERE marked = 1 AND reviewed_at IS NULL")
+
+
+async def _migrate_rollups(db):
+    """Создает сводные таблицы; заполняются они пересчетом после миграций"""
+    for ddl in ROLLUP_DDL:
+        await db.execute(ddl)
+
+
+async def _migrate_fts(db):
+    """Создает полнотекстовый индекс; заполняется он пересборкой после миграций"""
+    await db.execute(POST_LOGS_FTS_DDL)
+
+
+async def _migrate_outbox(db):
+    """Колонки outbox (services/outbox_service.py): попытки, время следующей попытки, захват строки"""
+    await _add_column(db, "scheduled_posts", "attempts", "INTEGER NOT NULL DEFAULT 0")
+    await _add_column(db, "scheduled_posts", "next_attempt_at", "INTEGER")
+    await _add_column(db, "scheduled_posts", "claimed_at", "INTEGER")
+    await db.execute("UPDATE scheduled_posts SET next_attempt_at = scheduled_time WHERE next_attempt_at IS NULL")
+
+
+async def rebuild_rollups_with(db):
+    """Пересчитывает сводные таблицы из исходных (на открытом соединении)"""
+    for sql in ROLLUP_REBUILD_SQL:
+        await db.execute(sql)
+
+
+# Миграции применяются по порядку, номер версии хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migrate_epoch_timestamps,
+    _migrate_post_tags,
+    _migrate_prompt_templates,
+    _migrate_rollups,
+    _migrate_media_digests,
+    _migrate_review,
+    _migrate_fts,
+    _migrate_outbox,
+]
+
+
 async def init_db():
     async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='post_logs'")
+        is_new_db = not await cur.fetchone()
+        if is_new_db:
+            # Должно быть задано до создания первой таблицы — тогда retention
+            # может возвращать место небольшими шагами incremental_vacuum
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL сохраняется в файле БД: читатели (дашборд) не блокируют запись
+        await db.execute("PRAGMA journal_mode = WAL")
+
         await db.execute(SQL["create_table_q"])
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS reddit_posts(
-              post_id TEXT PRIMARY KEY,
-              processed_at DATETIME
-            );
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS scheduled_posts(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              post_id TEXT NOT NULL,
-              title TEXT,
-              media_type TEXT,
-              media_data BLOB,
-              caption TEXT,
-              scheduled_time DATETIME NOT NULL,
-              status TEXT DEFAULT 'pending',
-              source TEXT DEFAULT 'reddit',
-              error_message TEXT,
-              created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-              sent_at DATETIME,
-              message_id INTEGER
-            );
-        """)
+        await db.execute(REDDIT_POSTS_DDL)
+        await db.execute(SCHEDULED_POSTS_DDL)
+        await db.execute(TAGS_DDL)
+        await db.execute(POST_TAGS_DDL)
+        await db.execute(PROMPT_TEMPLATES_DDL)
+        await db.execute(APP_META_DDL)
+        await db.execute(TELEGRAM_MEDIA_CACHE_DDL)
+        await db.execute(SCHEDULED_POST_MEDIA_DDL)
+        for ddl in ROLLUP_DDL:
+            await db.execute(ddl)
+        await db.execute(POST_LOGS_FTS_DDL)
+
+        migrated = False
+        if is_new_db:
+            # Свежая БД сразу создана по актуальной схеме
+            await db.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        else:
+            cur = await db.execute("PRAGMA user_version")
+            version = (await cur.fetchone())[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                await db.execute("BEGIN")
+                await migration(db)
+                await db.execute(f"PRAGMA user_version = {number}")
+                await db.commit()
+                migrated = True
+
+        for ddl in INDEXES_DDL:
+            await db.execute(ddl)
+        # Пересоздание таблиц в миграциях удаляет их триггеры — создаем заново
+        for ddl in ROLLUP_TRIGGERS_DDL + FTS_TRIGGERS_DDL + SCHEDULED_POST_MEDIA_TRIGGERS_DDL:
+            await db.execute(ddl)
+        if migrated:
+            await rebuild_rollups_with(db)
+            await db.execute("INSERT INTO post_logs_fts(post_logs_fts) VALUES ('rebuild')")
         await db.commit()
 
+@timed(DB_SECONDS.labels("is_reddit_processed"))
 async def is_reddit_processed(post_id: str) -> bool:
     async with aiosqlite.connect(DATABASE_PATH) as db:
         cur = await db.execute("SELECT 1 FROM reddit_posts WHERE post_id=?", (post_id,))
         return bool(await cur.fetchone())
 
+@timed(DB_SECONDS.labels("mark_reddit_processed"))
 async def mark_reddit_processed(post_id: str):
     async with aiosqlite.connect(DATABASE_PATH) as db:
         await db.execute(
             "INSERT OR IGNORE INTO reddit_posts(post_id, processed_at) VALUES(?,?)",
-            (post_id, datetime.now().isoformat())
+            (post_id, utc_now())
         )
         await db.commit()
 
-async def save_post_to_db(**kwargs) -> int:
+@timed(DB_SECONDS.labels("intern_tags"))
+async def intern_tags(tags) -> list:
+    """Интернирует теги один раз и возвращает их id для последующих save_post_to_db"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
+        tag_ids = await intern_tags_with(db, tags)
+        await db.commit()
+        return tag_ids
+
+
+@timed(DB_SECONDS.labels("save_post_to_db"))
+async def save_post_to_db(tag_ids: list = None, **kwargs) -> int:
+    """
+    Сохраняет пост в post_logs. Связи с тегами пишутся в той же транзакции:
+    из готовых tag_ids (см. intern_tags) или из колонки tags.
+    description_prompt/interrogate_prompt сохраняются как ссылки на prompt_templates
+    """
+    description_prompt = kwargs.pop("description_prompt", None)
+    interrogate_prompt = kwargs.pop("interrogate_prompt", None)
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        if description_prompt is not None:
+            kwargs["description_prompt_id"], kwargs["description_prompt_vars"] = \
+                await description_prompt_columns(db, description_prompt)
+        if interrogate_prompt is not None:
+            kwargs["interrogate_prompt_id"] = await intern_prompt_with(db, "interrogate", interrogate_prompt)
+        if kwargs.get("image_data") and "image_digest" not in kwargs:
+            kwargs["image_digest"] = media_digest(kwargs["image_data"])
         cols = ", ".join(kwargs.keys())
         qmarks = ", ".join("?" for _ in kwargs)
         vals = list(kwargs.values())
         cur = await db.execute(f"INSERT INTO post_logs ({cols}) VALUES ({qmarks})", vals)
+        post_id = cur.lastrowid
+        if tag_ids is None:
+            tag_ids = await intern_tags_with(db, kwargs.get("tags"))
+        await link_post_tags(db, post_id, tag_ids)
         await db.commit()
-        return cur.lastrowid
+        return post_id
 
+@timed(DB_SECONDS.labels("get_marked_posts"))
 async def get_marked_posts() -> list:
-    """Получает все помеченные посты для использования в качестве негативных примеров"""
+    """
+    Получает помеченные посты для использования в качестве негативных примеров.
+    Возвращает список (id, description) — id сохраняются в переменных промпта
+    """
     async with aiosqlite.connect(DATABASE_PATH) as db:
         cur = await db.execute(
-            "SELECT description FROM post_logs WHERE marked = 1 AND description IS NOT NULL ORDER BY created_at DESC LIMIT 10"
+            "SELECT id, description FROM post_logs WHERE marked = 1 AND description IS NOT NULL ORDER BY created_at DESC LIMIT 10"
         )
-        rows = await cur.fetchall()
-        return [row[0] for row in rows]
+        return await cur.fetchall()
+
+def fts_terms_query(text: str, max_terms: int = 16) -> str:
+    """
+    Превращает произвольный текст в безопасный запрос FTS5: каждое слово
+    в кавычках (без операторов), слова объединяются через OR
+    """
+    words = []
+    for word in "".join(ch if ch.isalnum() else " " for ch in text.lower()).split():
+        if len(word) >= 4 and word not in words:
+            words.append(word)
+    return " OR ".join(f'"{word}"' for word in words[:max_terms])
+
+
+@timed(DB_SECONDS.labels("find_similar_descriptions"))
+async def find_similar_descriptions(text: str, recent: int = 500, limit: int = 5) -> list:
+    """
+    Кандидаты на похожие описания среди последних recent постов по FTS-индексу
+    (ранжирование bm25). Возвращает [(id, description), ...]
+    """
+    query = fts_terms_query(text)
+    if not query:
+        return []
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute("""
+            SELECT f.rowid, p.description
+            FROM post_logs_fts f JOIN post_logs p ON p.id = f.rowid
+            WHERE f.description MATCH ? AND f.rowid > (SELECT COALESCE(MAX(id), 0) - ? FROM post_logs)
+            ORDER BY f.rank LIMIT ?
+        """, (query, recent, limit))
+        return await cur.fetchall()
+
+@timed(DB_SECONDS.labels("get_negative_examples_version"))
+async def get_negative_examples_version() -> int:
+    """Версия набора помеченных постов (меняется при пометках из дашборда)"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute("SELECT value FROM app_meta WHERE key = ?", (NEGATIVE_EXAMPLES_VERSION_KEY,))
+        row = await cur.fetchone()
+        return row[0] if row else 0
+
+def _insert_scheduled_post_from_file(values: tuple, media_path: str) -> int:
+    """
+    INSERT с zeroblob нужного размера и запись файла в BLOB частями, sha256 — за тот же проход.
+    Одна транзакция: outbox не увидит строку с недописанным медиа
+    """
+    digest = hashlib.sha256()
+    db = sqlite3.connect(DATABASE_PATH)
+    try:
+        with db:
+            cur = db.execute("""
+                INSERT INTO scheduled_posts (post_id, title, media_type, media_data, caption,
+                                           scheduled_time, next_attempt_at, source)
+                VALUES (?, ?, ?, zeroblob(?), ?, ?, ?, ?)
+            """, values)
+            row_id = cur.lastrowid
+            with db.blobopen("scheduled_posts", "media_data", row_id) as blob, open(media_path, "rb") as f:
+                for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b""):
+                    blob.write(chunk)
+                    digest.update(chunk)
+            db.execute("UPDATE scheduled_posts SET media_digest = ? WHERE id = ?", (digest.hexdigest(), row_id))
+    finally:
+        db.close()
+    return row_id
 
+@timed(DB_SECONDS.labels("save_scheduled_post"))
 async def save_scheduled_post(post_id: str, title: str, media_type: str, media_data: bytes, 
-                              caption: str, scheduled_time: datetime, source: str = 'reddit') -> int:
-    """Сохраняет отложенный пост в БД"""
+                              caption: str, scheduled_time: datetime, source: str = 'reddit',
+                              media_path: str = None, gallery_media: list = None) -> int:
+    """
+    Сохраняет отложенный пост в БД. media_path вместо media_data — медиа копируется из файла частями.
+    gallery_media — остальные изображения галереи (после media_data), в той же транзакции
+    """
+    if media_data is None and media_path:
+        return await asyncio.to_thread(_insert_scheduled_post_from_file, (
+            post_id, title, media_type, os.path.getsize(media_path), caption,
+            to_epoch(scheduled_time), to_epoch(scheduled_time), source), media_path)
     async with aiosqlite.connect(DATABASE_PATH) as db:
         cur = await db.execute("""
-            INSERT INTO scheduled_posts (post_id, title, media_type, media_data, caption, 
-                                       scheduled_time, source)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (post_id, title, media_type, media_data, caption, scheduled_time.isoformat(), source))
+            INSERT INTO scheduled_posts (post_id, title, media_type, media_data, media_digest, caption, 
+                                       scheduled_time, next_attempt_at, source)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (post_id, title, media_type, media_data, media_digest(media_data), caption,
+              to_epoch(scheduled_time), to_epoch(scheduled_time), source))
+        row_id = cur.lastrowid
+        if gallery_media:
+            await db.executemany("""
+                INSERT INTO scheduled_post_media (scheduled_post_id, position, media_data, media_digest)
+                VALUES (?, ?, ?, ?)
+            """, [(row_id, position, data, media_digest(data)) for position, data in enumerate(gallery_media, 1)])
         await db.commit()
-        return cur.lastrowid
+        return row_id
 
+@timed(DB_SECONDS.labels("get_pending_scheduled_posts"))
 async def get_pending_scheduled_posts() -> list:
-    """Получает все отложенные посты, которые готовы к отправке"""
+    """
+    Получает все отложенные посты, которые готовы к отправке. Без медиа: только метаданные и
+    media_size, само медиа читается при отправке через open_scheduled_media
+    """
     async with aiosqlite.connect(DATABASE_PATH) as db:
         cur = await db.execute("""
-            SELECT id, post_id, title, media_type, media_data, caption, scheduled_time, source
+            SELECT id, post_id, title, media_type, length(media_data) AS media_size, media_digest, caption,
+                   scheduled_time, source
             FROM scheduled_posts
-            WHERE status = 'pending' AND datetime(scheduled_time) <= datetime('now', 'localtime')
+            WHERE status = 'pending' AND scheduled_time <= ?
             ORDER BY scheduled_time ASC
-        """)
+        """, (utc_now(),))
         rows = await cur.fetchall()
         return [dict(zip([col[0] for col in cur.description], row)) for row in rows]
 
-async def mark_scheduled_post_sent(post_id: int, message_id: int):
-    """Помечает отложенный пост как отправленный"""
+@timed(DB_SECONDS.labels("next_scheduled_post_time"))
+async def next_scheduled_post_time():
+    """Время (UTC epoch) ближайшей попытки среди ожидающих постов или None; по индексу idx_scheduled_posts_due"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("""
+        cur = await db.execute("SELECT MIN(next_attempt_at) FROM scheduled_posts WHERE status = 'pending'")
+        return (await cur.fetchone())[0]
+
+@timed(DB_SECONDS.labels("claim_scheduled_post"))
+async def claim_scheduled_post():
+    """
+    Забирает самый ранний пост, которому пора выйти: pending → sending одним UPDATE, поэтому
+    два обработчика не получат одну строку. attempts — номер попытки, им же помечается результат
+    """
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute("""
+            UPDATE scheduled_posts
+            SET status = 'sending', claimed_at = ?, attempts = attempts + 1
+            WHERE id = (SELECT id FROM scheduled_posts
+                        WHERE status = 'pending' AND next_attempt_at <= ?
+                        ORDER BY next_attempt_at, id LIMIT 1)
+            RETURNING id, post_id, title, media_type, length(media_data) AS media_size, media_digest, caption,
+                      scheduled_time, source, attempts
+        """, (utc_now(), utc_now()))
+        row = await cur.fetchone()
+        columns = [col[0] for col in cur.description]
+        await db.commit()
+        return dict(zip(columns, row)) if row else None
+
+@timed(DB_SECONDS.labels("get_scheduled_post_media"))
+async def get_scheduled_post_media(row_id: int) -> list:
+    """Остальные изображения отложенной галереи без самих данных: [{position, media_digest, media_size}]"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute("""
+            SELECT position, media_digest, length(media_data) AS media_size
+            FROM scheduled_post_media WHERE scheduled_post_id = ? AND media_data IS NOT NULL
+            ORDER BY position
+        """, (row_id,))
+        rows = await cur.fetchall()
+        return [dict(zip([col[0] for col in cur.description], row)) for row in rows]
+
+@timed(DB_SECONDS.labels("load_scheduled_post_media"))
+async def load_scheduled_post_media(row_id: int, position: int) -> bytes:
+    """Изображение отложенной галереи (position из get_scheduled_post_media)"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute(
+            "SELECT media_data FROM scheduled_post_media WHERE scheduled_post_id = ? AND position = ?",
+            (row_id, position))
+        row = await cur.fetchone()
+        if row is None or row[0] is None:
+            raise ValueError(f"Нет изображения {position} отложенного поста #{row_id}")
+        return row[0]
+
+async def open_scheduled_media(row_id: int, name: str = None) -> BlobReader:
+    """Медиа отложенного поста как файл для чтения частями (см. BlobReader); закрыть после отправки"""
+    return await asyncio.to_thread(open_media_blob, "scheduled_posts", "media_data", row_id, name)
+
+@timed(DB_SECONDS.labels("mark_scheduled_post_sent"))
+async def mark_scheduled_post_sent(post_id: int, message_id: int, attempt: int = None) -> bool:
+    """
+    Помечает отложенный пост как отправленный.
+    attempt — номер попытки из claim_scheduled_post: пометка проходит, только если строку не забрали заново
+    """
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute(f"""
             UPDATE scheduled_posts 
-            SET status = 'sent', sent_at = datetime('now', 'localtime'), message_id = ?
-            WHERE id = ?
-        """, (message_id, post_id))
+            SET status = 'sent', sent_at = ?, message_id = ?, error_message = NULL
+            WHERE id = ?{" AND status = 'sending' AND attempts = ?" if attempt is not None else ""}
+        """, (utc_now(), message_id, post_id, *(() if attempt is None else (attempt,))))
+        await db.commit()
+        return cur.rowcount > 0
+
+@timed(DB_SECONDS.labels("retry_scheduled_post"))
+async def retry_scheduled_post(post_id: int, error_message: str, next_attempt_at: int):
+    """Возвращает захваченный пост в очередь: следующая попытка не раньше next_attempt_at"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.execute("""
+            UPDATE scheduled_posts
+            SET status = 'pending', error_message = ?, next_attempt_at = ?, claimed_at = NULL
+            WHERE id = ? AND status = 'sending'
+        """, (error_message, next_attempt_at, post_id))
+        await db.commit()
+
+@timed(DB_SECONDS.labels("release_stale_scheduled_posts"))
+async def release_stale_scheduled_posts(claimed_before: int, resend: bool, error_message: str) -> list:
+    """
+    Посты, застрявшие в sending (процесс упал посреди отправки): resend — обратно в очередь,
+    иначе failed с error_message. Возвращает их id
+    """
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        if resend:
+            cur = await db.execute("""
+                UPDATE scheduled_posts SET status = 'pending', next_attempt_at = ?, claimed_at = NULL
+                WHERE status = 'sending' AND claimed_at < ? RETURNING id
+            """, (utc_now(), claimed_before))
+        else:
+            cur = await db.execute("""
+                UPDATE scheduled_posts SET status = 'failed', error_message = ?
+                WHERE status = 'sending' AND claimed_at < ? RETURNING id
+            """, (error_message, claimed_before))
+        ids = [row[0] for row in await cur.fetchall()]
         await db.commit()
+        return ids
 
+@timed(DB_SECONDS.labels("mark_scheduled_post_failed"))
 async def mark_scheduled_post_failed(post_id: int, error_message: str):
     """Помечает отложенный пост как не отправленный"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
@@ -111,20 +953,63 @@ async def mark_scheduled_post_failed(post_id: int, error_message: str):
         """, (error_message, post_id))
         await db.commit()
 
+@timed(DB_SECONDS.labels("get_scheduled_posts_stats"))
 async def get_scheduled_posts_stats() -> dict:
-    """Получает статистику отложенных постов"""
+    """Получает статистику отложенных постов из сводной таблицы"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        cur = await db.execute("""
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-                SUM(CASE WHEN status = 'sent' THEN 1 ELSE 0 END) as sent,
-                SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed
-            FROM scheduled_posts
-        """)
-        row = await cur.fetchone()
-        return dict(zip([col[0] for col in cur.description], row)) if row else {}
+        cur = await db.execute(
+            "SELECT substr(name, 11), value FROM stats_counters WHERE name >= 'scheduled:' AND name < 'scheduled;'"
+        )
+        counts = dict(await cur.fetchall())
+        stats = {status: counts.get(status, 0) for status in ("pending", "sent", "failed")}
+        return {"total": sum(counts.values()), **stats}
+
+
+@timed(DB_SECONDS.labels("get_telegram_file_ids"))
+async def get_telegram_file_ids(kind: str, digests: list) -> dict:
+    """file_id уже загруженных медиа: {media_digest: file_id} для найденных"""
+    digests = [digest for digest in digests if digest]
+    if not digests:
+        return {}
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        cur = await db.execute(
+            f"SELECT media_digest, file_id FROM telegram_media_cache "
+            f"WHERE kind = ? AND media_digest IN ({', '.join('?' * len(digests))})",
+            (kind, *digests)
+        )
+        return dict(await cur.fetchall())
 
+@timed(DB_SECONDS.labels("save_telegram_file_ids"))
+async def save_telegram_file_ids(kind: str, entries: list):
+    """Запоминает file_id после загрузки: entries — [(media_digest, file_id, file_unique_id)]"""
+    entries = [entry for entry in entries if entry[0]]
+    if not entries:
+        return
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.executemany(
+            "INSERT OR REPLACE INTO telegram_media_cache(media_digest, kind, file_id, file_unique_id) "
+            "VALUES (?, ?, ?, ?)",
+            [(digest, kind, file_id, file_unique_id) for digest, file_id, file_unique_id in entries]
+        )
+        await db.commit()
+
+@timed(DB_SECONDS.labels("forget_telegram_file_ids"))
+async def forget_telegram_file_ids(kind: str, digests: list):
+    """Удаляет file_id, которые Telegram больше не принимает (другой бот, файл удален)"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.executemany("DELETE FROM telegram_media_cache WHERE media_digest = ? AND kind = ?",
+                             [(digest, kind) for digest in digests])
+        await db.commit()
+
+
+async def rebuild_rollups():
+    """Полный пересчет сводных таблиц дашборда (бэкфилл после ручных правок БД)"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.execute("BEGIN")
+        await rebuild_rollups_with(db)
+        await db.commit()
+
+@timed(DB_SECONDS.labels("get_all_scheduled_posts"))
 async def get_all_scheduled_posts() -> list:
     """Получает все отложенные посты для отображения в dashboard"""
     async with aiosqlite.connect(DATABASE_PATH) as db:
@@ -138,14 +1023,18 @@ async def get_all_scheduled_posts() -> list:
         return [dict(zip([col[0] for col in cur.description], row)) for row in rows]
 
 
-async def get_pending_scheduled_posts() -> list:
-    """Получает посты, которые нужно опубликовать (время публикации прошло)"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cur = await db.execute("""
-            SELECT id, post_id, title, media_type, media_data, caption, scheduled_time, source
-            FROM scheduled_posts
-            WHERE status = 'pending' AND scheduled_time <= datetime('now')
-            ORDER BY scheduled_time ASC
-        """)
-        rows = await cur.fetchall()
-        return [dict(zip([col[0] for col in cur.description], row)) for row in rows]
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Обслуживание telegram_bot.db")
+    parser.add_argument("command", choices=["init", "rebuild-rollups"],
+                        help="init — создать/мигрировать схему, rebuild-rollups — пересчитать сводные таблицы")
+    args = parser.parse_args()
+
+    async def _run(command: str):
+        await init_db()
+        if command == "rebuild-rollups":
+            await rebuild_rollups()
+
+    asyncio.run(_run(args.command))
+    print(f"✅ {args.command}: готово")
@@ -0,0 +1,227 @@
+import yaml
+import heapq
+import asyncio
+import logging
+import itertools
+import contextvars
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from telegram.error import RetryAfter
+
+from .metrics_service import TELEGRAM_QUEUE_DEPTH, TELEGRAM_QUEUE_WAIT, TELEGRAM_ACTIVE, TELEGRAM_FLOOD_WAITS
+
+logger = logging.getLogger('dispatch_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    DISPATCH = yaml.load(f, Loader=yaml.FullLoader).get("telegram", {})
+
+# Диспетчер запросов к Telegram Bot API: все отправки telegram_service идут через одну очередь.
+# - токен-бакеты: общий на бота и по каждому чату (лимиты Telegram ~30 сообщений/сек и ~20/мин в группу);
+#   альбом стоит столько токенов, сколько в нем элементов
+# - RetryAfter (flood control) ставит на паузу всю очередь на указанное время, запрос повторяется
+# - до concurrency запросов (загрузок) одновременно
+# - порядок — по приоритету: посты, которым пора выйти, раньше обычных отправок и предзагрузки
+# Глубина очереди, ожидание и паузы — в метриках tgposter_telegram_*.
+
+PRIORITY_DUE = 0        # отложенные посты, время которых наступило
+PRIORITY_NORMAL = 1     # обычная отправка из батча
+PRIORITY_PREFETCH = 2   # предзагрузка медиа (file_id заранее)
+PRIORITY_NAMES = {PRIORITY_DUE: "due", PRIORITY_NORMAL: "normal", PRIORITY_PREFETCH: "prefetch"}
+
+CONCURRENCY = DISPATCH.get("concurrency", 4)
+GLOBAL_RATE = DISPATCH.get("global_rate", 25)                     # запросов в секунду на бота
+GLOBAL_BURST = DISPATCH.get("global_burst", GLOBAL_RATE)
+CHAT_RATE = DISPATCH.get("chat_rate_per_minute", 20) / 60         # сообщений в секунду в один чат
+CHAT_BURST = DISPATCH.get("chat_burst", 5)
+RETRY_AFTER_ATTEMPTS = DISPATCH.get("retry_after_attempts", 3)    # повторов после RetryAfter
+SLOW_WAIT = DISPATCH.get("log_wait_sec", 5)                       # ожидание дольше — в лог
+
+
+class TokenBucket:
+    """rate токенов в секунду, запас не больше burst. Запрос дороже burst проходит при полном бакете и уходит в долг"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float, cost: float = 1) -> float:
+        """Сколько секунд ждать, пока хватит токенов"""
+        self._refill(now)
+        return max(0.0, (min(cost, self.burst) - self.tokens) / self.rate)
+
+    def take(self, now: float, cost: float = 1):
+        self._refill(now)
+        self.tokens -= cost
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "call", "chat_id", "cost", "label", "future", "context", "enqueued", "attempts")
+
+    def __init__(self, priority, seq, call, chat_id, cost, label, future, enqueued):
+        self.priority = priority
+        self.seq = seq
+        self.call = call
+        self.chat_id = chat_id
+        self.cost = cost
+        self.label = label
+        self.future = future
+        # Контекст отправителя (batch_id/post_id в логах, текущий спан) — и для выполнения запроса
+        self.context = contextvars.copy_context()
+        self.enqueued = enqueued
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class TelegramDispatcher:
+    """Очередь с приоритетами поверх токен-бакетов; запросы выполняются задачами текущего event loop"""
+
+    def __init__(self, concurrency: int = CONCURRENCY):
+        self.concurrency = concurrency
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.queue = []
+        self.active = 0
+        self.paused_until = 0.0
+        self._seq = itertools.count()
+        self._runner: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def submit(self, call: Callable[[], Awaitable], chat_id, priority: int = PRIORITY_NORMAL,
+                     cost: float = 1, label: str = "") -> Any:
+        """
+        Выполняет call() (новый запрос при каждом вызове — повтор после RetryAfter вызывает его снова),
+        когда позволяют лимиты, и возвращает результат
+        """
+        loop = asyncio.get_running_loop()
+        if self._runner is None or self._runner.done():
+            # Новый event loop (или первый вызов) — свой цикл диспетчера
+            self._wakeup = asyncio.Event()
+            self._runner = loop.create_task(self._run(), name="telegram-dispatcher")
+        job = _Job(priority, next(self._seq), call, str(chat_id), cost, label, loop.create_future(), loop.time())
+        heapq.heappush(self.queue, job)
+        TELEGRAM_QUEUE_DEPTH.labels(PRIORITY_NAMES[priority]).inc()
+        self._wakeup.set()
+        return await job.future
+
+    def stats(self) -> dict:
+        """Состояние очереди: ждут по приоритетам, выполняются, сколько еще пауза после RetryAfter"""
+        loop = asyncio.get_running_loop()
+        queued = {}
+        for job in self.queue:
+            queued[PRIORITY_NAMES[job.priority]] = queued.get(PRIORITY_NAMES[job.priority], 0) + 1
+        return {"queued": queued, "active": self.active,
+                "paused_sec": round(max(0.0, self.paused_until - loop.time()), 1)}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            delay = self._start_ready(loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_ready(self, now: float) -> Optional[float]:
+        """Запускает все задания, которые позволяют лимиты; через сколько секунд проверить снова (None — по событию)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        next_check = None
+        started = False
+        for job in sorted(self.queue):
+            if job.future.done():
+                # Отправитель отменил ожидание
+                self._dequeue(job)
+                started = True
+                continue
+            if self.active >= self.concurrency:
+                break
+            global_wait = self.global_bucket.delay(now, job.cost)
+            if global_wait > 0:
+                # Общий лимит не пропустит и менее приоритетные — ждем его
+                next_check = global_wait if next_check is None else min(next_check, global_wait)
+                break
+            chat_bucket = self.chat_buckets.setdefault(job.chat_id, TokenBucket(CHAT_RATE, CHAT_BURST))
+            chat_wait = chat_bucket.delay(now, job.cost)
+            if chat_wait > 0:
+                # Этот чат упирается в свой лимит — пропускаем вперед задания для других чатов
+                next_check = chat_wait if next_check is None else min(next_check, chat_wait)
+                continue
+
+            self.global_bucket.take(now, job.cost)
+            chat_bucket.take(now, job.cost)
+            self._dequeue(job)
+            started = True
+            self.active += 1
+            TELEGRAM_ACTIVE.inc()
+            waited = now - job.enqueued
+            TELEGRAM_QUEUE_WAIT.labels(PRIORITY_NAMES[job.priority]).observe(waited)
+            if waited >= SLOW_WAIT:
+                logger.info(f"⏳ {job.label or 'Запрос'} ждал в очереди Telegram {waited:.1f} сек")
+            asyncio.get_running_loop().create_task(self._execute(job), context=job.context)
+
+        if started:
+            heapq.heapify(self.queue)
+        return next_check
+
+    def _dequeue(self, job: _Job):
+        self.queue.remove(job)
+        TELEGRAM_QUEUE_DEPTH.labels(PRIORITY_NAMES[job.priority]).dec()
+
+    async def _execute(self, job: _Job):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            seconds = _retry_seconds(e)
+            TELEGRAM_FLOOD_WAITS.inc()
+            # Пауза для всей очереди: следующий запрос получил бы тот же RetryAfter
+            self.paused_until = max(self.paused_until, loop.time() + seconds)
+            job.attempts += 1
+            if job.attempts > RETRY_AFTER_ATTEMPTS or job.future.done():
+                logger.error(f"❌ Flood control: {job.label or 'запрос'} не отправлен после {job.attempts} попыток")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                logger.warning(f"⏸️ Flood control: очередь Telegram на паузе {seconds:.0f} сек, "
+                               f"{job.label or 'запрос'} повторится")
+                job.enqueued = loop.time()
+                heapq.heappush(self.queue, job)
+                TELEGRAM_QUEUE_DEPTH.labels(PRIORITY_NAMES[job.priority]).inc()
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.active -= 1
+            TELEGRAM_ACTIVE.dec()
+            self._wakeup.set()
+
+
+dispatcher = TelegramDispatcher()
+
+
+async def dispatch(call: Callable[[], Awaitable], chat_id, priority: int = PRIORITY_NORMAL,
+                   cost: float = 1, label: str = "") -> Any:
+    """Запрос к Telegram через общий диспетчер (см. TelegramDispatcher.submit)"""
+    return await dispatcher.submit(call, chat_id, priority, cost, label)
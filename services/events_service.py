@@ -0,0 +1,90 @@
+import json
+import time
+import yaml
+import logging
+import aiosqlite
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger('events_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    EVENTS = yaml.load(f, Loader=yaml.FullLoader).get("events", {})
+
+# События прогресса пишутся в отдельную маленькую БД, а не в telegram_bot.db:
+# дашборд читает их для живой ленты (SSE) и не трогает основные таблицы,
+# а запись события не конкурирует с записью постов
+EVENTS_DATABASE_PATH = EVENTS.get("database", "events.db")
+KEEP_HOURS = EVENTS.get("keep_hours", 72)
+
+EVENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS pipeline_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        batch_id TEXT,
+        post_id TEXT,
+        kind TEXT NOT NULL,
+        data TEXT
+    )
+"""
+
+# Текущий батч: задается в schedule_batch_posts, события внутри него помечаются автоматически
+current_batch: ContextVar[Optional[str]] = ContextVar("current_batch", default=None)
+# Текущий пост (для логов); задается на время обработки поста
+current_post: ContextVar[Optional[str]] = ContextVar("current_post", default=None)
+
+
+# Одно соединение на процесс: событий по нескольку на пост, а aiosqlite.connect каждый раз запускает поток
+_db: Optional[aiosqlite.Connection] = None
+
+
+async def _connection() -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        _db = await aiosqlite.connect(EVENTS_DATABASE_PATH)
+    return _db
+
+
+async def init_events_db():
+    """Создает БД событий, удаляет события старше keep_hours и открывает соединение для publish_event"""
+    db = await _connection()
+    await db.execute("PRAGMA journal_mode = WAL")
+    await db.execute(EVENTS_DDL)
+    if KEEP_HOURS is not None:
+        cur = await db.execute("DELETE FROM pipeline_events WHERE ts < ?", (time.time() - KEEP_HOURS * 3600,))
+        if cur.rowcount:
+            logger.info(f"🧹 Удалено старых событий: {cur.rowcount}")
+    await db.commit()
+
+
+async def close_events_db():
+    """Закрывает соединение БД событий (при завершении процесса)"""
+    global _db
+    if _db is not None:
+        db, _db = _db, None
+        await db.close()
+
+
+def begin_batch() -> str:
+    """Новый id батча для событий текущей задачи"""
+    batch_id = time.strftime("%Y%m%d-%H%M%S")
+    current_batch.set(batch_id)
+    return batch_id
+
+
+async def publish_event(kind: str, post_id: Optional[str] = None, **data):
+    """
+    Добавляет событие прогресса (candidate, downloaded, tagged, described, scheduled, failed, ...).
+    data — произвольные поля (длительности в секундах, размеры, модель).
+    Ошибка записи события не должна ломать обработку поста, поэтому только логируется
+    """
+    try:
+        db = await _connection()
+        await db.execute(
+            "INSERT INTO pipeline_events (ts, batch_id, post_id, kind, data) VALUES (?, ?, ?, ?, ?)",
+            (time.time(), current_batch.get(), post_id, kind,
+             json.dumps(data, ensure_ascii=False, default=str) if data else None)
+        )
+        await db.commit()
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось записать событие {kind}: {e}")
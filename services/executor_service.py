@@ -0,0 +1,222 @@
+import os
+import yaml
+import base64
+import atexit
+import asyncio
+import logging
+import logging.handlers
+import threading
+import contextvars
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, NamedTuple, Optional
+
+logger = logging.getLogger('executor_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    EXECUTOR = yaml.load(f, Loader=yaml.FullLoader).get("executor", {})
+
+# CPU-работа вне потока event loop: сжатие изображений (Pillow), base64 для SD, разбор HTML.
+# Пул процессов (spawn) — для кода, который держит GIL; Pillow отпускает GIL на декодировании,
+# ресайзе и кодировании, поэтому его можно выполнять в пуле потоков (pillow_threads) без передачи байт.
+# Байты от shared_memory_min_kb идут в воркер и обратно через shared memory: по pipe передаются
+# только имя блока и длина, без pickle-копий. Логи воркеров пишутся логированием основного процесса.
+
+PROCESSES = EXECUTOR.get("processes", min(4, os.cpu_count() or 1))
+PILLOW_THREADS = EXECUTOR.get("pillow_threads", 0)
+SHARED_MEMORY_MIN_BYTES = EXECUTOR.get("shared_memory_min_kb", 256) * 1024
+
+_lock = threading.Lock()
+_process_pool: Optional[ProcessPoolExecutor] = None
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class SharedBytes(NamedTuple):
+    """Байты в блоке shared memory: между процессами передаются только имя и длина"""
+    name: str
+    size: int
+
+
+def _to_shared(data: bytes) -> SharedBytes:
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    block.buf[:len(data)] = data
+    handle = SharedBytes(block.name, len(data))
+    block.close()
+    return handle
+
+
+def _from_shared(handle: SharedBytes, release: bool) -> bytes:
+    block = shared_memory.SharedMemory(name=handle.name)
+    try:
+        return bytes(block.buf[:handle.size])
+    finally:
+        block.close()
+        if release:
+            block.unlink()
+
+
+def _release(handle: SharedBytes):
+    try:
+        block = shared_memory.SharedMemory(name=handle.name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+def _pack(value: Any) -> Any:
+    """Крупные bytes (в том числе внутри кортежа) — в shared memory"""
+    if isinstance(value, bytes) and len(value) >= SHARED_MEMORY_MIN_BYTES:
+        return _to_shared(value)
+    if isinstance(value, tuple):
+        return _rebuild(value, [_pack(item) for item in value])
+    return value
+
+
+def _rebuild(value: tuple, items: list) -> tuple:
+    # NamedTuple (например, image_service.PreparedImage) сохраняет свой тип
+    return type(value)(*items) if hasattr(value, "_fields") else tuple(items)
+
+
+def _unpack(value: Any, release: bool) -> Any:
+    if isinstance(value, SharedBytes):
+        return _from_shared(value, release)
+    if isinstance(value, tuple):
+        return _rebuild(value, [_unpack(item, release) for item in value])
+    return value
+
+
+def _handles(value: Any) -> list:
+    if isinstance(value, SharedBytes):
+        return [value]
+    if isinstance(value, tuple):
+        return [handle for item in value for handle in _handles(item)]
+    return []
+
+
+def _call_in_worker(func: Callable, args: tuple) -> Any:
+    # Входные блоки освобождает основной процесс, результат — тот, кто его заберет
+    return _pack(func(*(_unpack(arg, release=False) for arg in args)))
+
+
+def _init_worker(log_queue, level: int):
+    """Логи воркера — в очередь основного процесса"""
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(level)
+
+
+class _WorkerLogHandler(logging.Handler):
+    """Запись из воркера — в логгер с тем же именем, с уровнями по модулям основного процесса"""
+
+    def emit(self, record):
+        target = logging.getLogger(record.name)
+        if target.isEnabledFor(record.levelno):
+            target.handle(record)
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool, _log_listener
+    with _lock:
+        if _process_pool is None:
+            # spawn, а не fork: в основном процессе уже работают потоки (логирование, aiosqlite)
+            context = multiprocessing.get_context("spawn")
+            log_queue = context.Queue()
+            _log_listener = logging.handlers.QueueListener(log_queue, _WorkerLogHandler())
+            _log_listener.start()
+            _process_pool = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=context, initializer=_init_worker,
+                                                initargs=(log_queue, logging.getLogger().getEffectiveLevel()))
+            atexit.register(shutdown)
+            logger.info(f"⚙️ Пул процессов для CPU-задач: {PROCESSES} воркеров")
+        return _process_pool
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=PILLOW_THREADS or None, thread_name_prefix="cpu")
+        return _thread_pool
+
+
+def _submit(func: Callable, args: tuple) -> tuple[Future, list]:
+    packed = tuple(_pack(arg) for arg in args)
+    return _get_process_pool().submit(_call_in_worker, func, packed), _handles(packed)
+
+
+def _discard_result(future: Future):
+    if not future.cancelled() and future.exception() is None:
+        for handle in _handles(future.result()):
+            _release(handle)
+
+
+async def run_cpu(func: Callable, *args) -> Any:
+    """
+    Выполняет func(*args) в пуле процессов и возвращает результат.
+    func и аргументы должны передаваться в другой процесс: функция уровня модуля, простые данные
+    """
+    if not PROCESSES:
+        return await _run_in_thread(func, *args)
+    future, shared = _submit(func, args)
+    try:
+        result = await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        # Результат уже не нужен — блоки освобождаются, когда воркер закончит
+        future.add_done_callback(_discard_result)
+        raise
+    finally:
+        for handle in shared:
+            _release(handle)
+    return _unpack(result, release=True)
+
+
+async def run_pillow(func: Callable, *args) -> Any:
+    """Операции Pillow: в пуле потоков, если задан pillow_threads, иначе в пуле процессов"""
+    if PILLOW_THREADS:
+        return await _run_in_thread(func, *args)
+    return await run_cpu(func, *args)
+
+
+async def _run_in_thread(func: Callable, *args) -> Any:
+    # Контекст задачи (batch_id/post_id для логов) переносится в поток, как в asyncio.to_thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_get_thread_pool(), context.run, func, *args)
+
+
+def call_cpu(func: Callable, *args) -> Any:
+    """
+    Синхронный вариант run_cpu для кода, который уже выполняется в отдельном потоке (asyncio.to_thread).
+    В потоке event loop блокирует его так же, как прямой вызов func
+    """
+    if not PROCESSES:
+        return func(*args)
+    future, shared = _submit(func, args)
+    try:
+        result = future.result()
+    finally:
+        for handle in shared:
+            _release(handle)
+    return _unpack(result, release=True)
+
+
+def b64encode(data: bytes) -> bytes:
+    """base64 для run_cpu: результат тоже bytes, поэтому крупный возвращается через shared memory"""
+    return base64.b64encode(data)
+
+
+def shutdown():
+    """Останавливает пулы; вызывается при выходе"""
+    global _process_pool, _thread_pool, _log_listener
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=True)
+        _thread_pool = None
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
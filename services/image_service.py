@@ -0,0 +1,286 @@
+import math
+import logging
+from io import BytesIO
+from typing import NamedTuple, Optional
+from PIL import Image, ImageOps
+
+# Подготовка изображений к отправке в Telegram: сжатие до лимита и проверка размеров.
+# Только Pillow, без клиента Telegram: функции выполняются и в воркерах пула (executor_service)
+
+logger = logging.getLogger('image_service')
+
+# Константы для сжатия изображений
+MAX_FILE_SIZE_MB = 10  # максимальный размер файла для Telegram фото
+MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+# Ограничения Telegram на размеры фото
+MAX_RESOLUTION = 10000  # по каждой стороне
+MAX_TOTAL_SIZE = 10000  # ширина + высота
+
+# Сжатие: качество подбирается бинарным поиском на маленьком превью,
+# полное разрешение кодируется один раз (повторно — только если прогноз промахнулся)
+JPEG_QUALITY_MAX = 85
+JPEG_QUALITY_MIN = 40       # ниже качество не опускаем — уменьшаем разрешение
+JPEG_QUALITY_SCALED = 75    # качество, с которым кодируем уменьшенное изображение
+PREVIEW_TILE = 128          # сторона фрагмента превью (кратна блоку JPEG 8x8)
+PREVIEW_GRID = 6            # фрагментов по каждой стороне, не больше
+PREVIEW_SHARE = 8           # превью не больше 1/8 пикселей результата
+QUALITY_TOLERANCE = 2       # точность бинарного поиска качества
+SIZE_SAFETY = 0.92          # запас к бюджету на ошибку прогноза по превью
+MAX_FULL_ENCODES = 3        # полных кодирований, не больше
+SCALE_STEPS = 4             # шагов подбора масштаба по превью
+UNDERSHOOT = 0.75           # результат меньше этой доли бюджета — уточняем прогноз
+
+# Форматы, которые Telegram принимает как фото без перекодирования
+PASSTHROUGH_FORMATS = {"JPEG", "PNG", "WEBP"}
+EXIF_ORIENTATION = 0x0112
+
+
+def _dimension_error(width: int, height: int) -> Optional[str]:
+    """Почему размеры не проходят ограничения Telegram, None — проходят"""
+    if width > MAX_RESOLUTION or height > MAX_RESOLUTION:
+        return f"Разрешение {width}x{height} превышает максимум {MAX_RESOLUTION}x{MAX_RESOLUTION}"
+    if width + height > MAX_TOTAL_SIZE:
+        return f"Общий размер {width + height} превышает лимит {MAX_TOTAL_SIZE}"
+    return None
+
+
+def validate_image_dimensions(image_bytes: bytes) -> tuple[bool, str]:
+    """Проверяет размеры изображения на соответствие ограничениям Telegram"""
+    try:
+        bio = BytesIO(image_bytes)
+        with Image.open(bio) as img:
+            width, height = img.size
+            error = _dimension_error(width, height)
+            return (False, error) if error else (True, f"Размеры {width}x{height} корректны")
+
+    except Exception as e:
+        return False, f"Ошибка при проверке размеров: {e}"
+
+
+def _encode_jpeg(img: Image.Image, quality: int) -> bytes:
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def _dimension_scale(width: int, height: int) -> float:
+    """Наибольший масштаб (не больше 1), при котором изображение проходит ограничения Telegram"""
+    return min(1.0, MAX_RESOLUTION / width, MAX_RESOLUTION / height, MAX_TOTAL_SIZE / (width + height))
+
+
+class _CompressionPlanner:
+    """
+    Подбирает (качество, масштаб) по превью: байт на пиксель превью × пиксели результата ≤ бюджет.
+    Превью — мозаика из фрагментов по сетке, каждый уменьшен в масштаб результата:
+    плотность деталей как у итогового изображения, а пикселей в десятки раз меньше.
+    calibration — поправка по факту полного кодирования
+    """
+
+    def __init__(self, img: Image.Image, budget: float, max_scale: float):
+        self.img = img
+        self.pixels = img.width * img.height
+        self.target = budget * SIZE_SAFETY
+        self.max_scale = max_scale
+        self.calibration = 1.0
+        self.previews = {}
+        self.bytes_per_pixel = {}
+
+    def preview(self, scale: float) -> Image.Image:
+        key = round(scale, 3)
+        if key not in self.previews:
+            width, height = self.img.size
+            # Превью не больше 1/PREVIEW_SHARE пикселей результата, иначе поиск дороже полного кодирования
+            grid = min(PREVIEW_GRID, int(math.sqrt(self.pixels * scale * scale / PREVIEW_SHARE)) // PREVIEW_TILE)
+            if grid < 2:
+                # Маленькое изображение — превью и есть результат
+                size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                self.previews[key] = self.img.resize(size, Image.Resampling.LANCZOS) if scale < 1 else self.img
+            else:
+                source = min(int(PREVIEW_TILE / scale), width, height)
+                mosaic = Image.new("RGB", (PREVIEW_TILE * grid, PREVIEW_TILE * grid))
+                for row in range(grid):
+                    for column in range(grid):
+                        left = (width - source) * column // (grid - 1)
+                        top = (height - source) * row // (grid - 1)
+                        tile = self.img.crop((left, top, left + source, top + source))
+                        if source != PREVIEW_TILE:
+                            tile = tile.resize((PREVIEW_TILE, PREVIEW_TILE), Image.Resampling.LANCZOS)
+                        mosaic.paste(tile, (column * PREVIEW_TILE, row * PREVIEW_TILE))
+                self.previews[key] = mosaic
+        return self.previews[key]
+
+    def predicted_size(self, quality: int, scale: float) -> float:
+        key = (quality, round(scale, 3))
+        if key not in self.bytes_per_pixel:
+            preview = self.preview(scale)
+            self.bytes_per_pixel[key] = len(_encode_jpeg(preview, quality)) / (preview.width * preview.height)
+            logger.debug("   🎛️ Превью, качество %d%%, масштаб %.2f: %.3f байт/пиксель", quality, scale,
+                         self.bytes_per_pixel[key])
+        return self.bytes_per_pixel[key] * self.calibration * self.pixels * scale * scale
+
+    def plan(self) -> tuple[int, float]:
+        # Сначала максимальное качество без уменьшения — частый случай, одно кодирование превью
+        if self.predicted_size(JPEG_QUALITY_MAX, self.max_scale) <= self.target:
+            return JPEG_QUALITY_MAX, self.max_scale
+
+        if self.predicted_size(JPEG_QUALITY_MIN, self.max_scale) <= self.target:
+            # Бинарный поиск наибольшего качества, которое укладывается в бюджет
+            # (с точностью до QUALITY_TOLERANCE)
+            low, high = JPEG_QUALITY_MIN, JPEG_QUALITY_MAX - 1
+            while high - low > QUALITY_TOLERANCE:
+                middle = (low + high + 1) // 2
+                if self.predicted_size(middle, self.max_scale) <= self.target:
+                    low = middle
+                else:
+                    high = middle - 1
+            return low, self.max_scale
+
+        # Качество не спасает — уменьшаем разрешение. Байт на пиксель зависит от масштаба,
+        # поэтому несколько шагов; берется наибольший масштаб, прогноз для которого в бюджете
+        scale, feasible = self.max_scale, None
+        for _ in range(SCALE_STEPS):
+            predicted = self.predicted_size(JPEG_QUALITY_SCALED, scale)
+            if predicted <= self.target:
+                feasible = max(feasible or 0, scale)
+                if predicted >= self.target * UNDERSHOOT:
+                    break
+            scale = min(self.max_scale, scale * math.sqrt(self.target / predicted))
+        return JPEG_QUALITY_SCALED, feasible or scale
+
+    def calibrate(self, quality: int, scale: float, actual_size: int):
+        self.calibration *= actual_size / self.predicted_size(quality, scale)
+
+
+def _compress_decoded(img: Image.Image, source_size: int, max_size_bytes: float, max_scale: float) -> tuple[bytes, tuple]:
+    """
+    Кодирует декодированное RGB-изображение в JPEG не больше max_size_bytes и max_scale.
+    Возвращает (байты, (ширина, высота)); если не уложились — наименьший вариант
+    """
+    logger.info("🗜️ Начинаем сжатие изображения: %.2f МБ -> %.2f МБ",
+                source_size / 1024 / 1024, max_size_bytes / 1024 / 1024)
+
+    planner = _CompressionPlanner(img, max_size_bytes, max_scale)
+    quality, scale = planner.plan()
+    original_width, original_height = img.size
+    best = None
+    refined = False
+
+    for _ in range(MAX_FULL_ENCODES):
+        size = (max(1, int(original_width * scale)), max(1, int(original_height * scale)))
+        resized = img.resize(size, Image.Resampling.LANCZOS) if size != img.size else img
+        compressed_bytes = _encode_jpeg(resized, quality)
+        logger.debug("   🎛️ Качество %d%%, %dx%d, размер: %.2f МБ", quality, size[0], size[1],
+                     len(compressed_bytes) / 1024 / 1024)
+
+        if len(compressed_bytes) <= max_size_bytes:
+            best = (compressed_bytes, quality, size)
+            # Превью завысило размер и запас большой — одна уточненная попытка с лучшим качеством/масштабом
+            improvable = quality < JPEG_QUALITY_MAX or scale < max_scale
+            if not refined and improvable and len(compressed_bytes) < max_size_bytes * UNDERSHOOT:
+                refined = True
+                planner.calibrate(quality, scale, len(compressed_bytes))
+                next_plan = planner.plan()
+                if next_plan != (quality, scale):
+                    quality, scale = next_plan
+                    continue
+            break
+
+        if best is not None:
+            # Уточненная попытка не уложилась — остается первая
+            break
+        # Прогноз промахнулся: уточняем его по факту и планируем заново
+        planner.calibrate(quality, scale, len(compressed_bytes))
+        next_plan = planner.plan()
+        if next_plan[0] >= quality and next_plan[1] >= scale * 0.99:
+            # План не изменился — уменьшаем масштаб пропорционально перерасходу
+            next_plan = (quality, scale * math.sqrt(max_size_bytes * SIZE_SAFETY / len(compressed_bytes)))
+        quality, scale = next_plan
+
+    if best is not None:
+        compressed_bytes, quality, size = best
+        logger.info("✅ Изображение сжато: %.2f МБ -> %.2f МБ (качество %d%%, %dx%d)", source_size / 1024 / 1024,
+                    len(compressed_bytes) / 1024 / 1024, quality, size[0], size[1])
+        return compressed_bytes, size
+
+    # Если и после уточнений не уложились, возвращаем последний (самый маленький) вариант
+    logger.warning("⚠️ Не удалось сжать изображение до %.2f МБ, возвращаем наименьший вариант",
+                   max_size_bytes / 1024 / 1024)
+    return compressed_bytes, size
+
+
+def compress_image(image_bytes: bytes, max_size_mb: float = MAX_FILE_SIZE_MB) -> bytes:
+    """
+    Сжимает изображение до указанного размера в МБ и ограничений Telegram по размерам.
+    Декодирует один раз, качество и масштаб подбирает по превью, полное разрешение кодирует один раз
+
+    Args:
+        image_bytes: исходные байты изображения
+        max_size_mb: максимальный размер в МБ
+
+    Returns:
+        bytes: сжатое изображение
+    """
+    try:
+        max_size_bytes = max_size_mb * 1024 * 1024
+
+        img = Image.open(BytesIO(image_bytes))
+        # Размеры из заголовка, без декодирования пикселей
+        max_scale = _dimension_scale(*img.size)
+
+        # Если изображение уже меньше лимита и проходит по размерам, возвращаем как есть
+        if len(image_bytes) <= max_size_bytes and max_scale == 1.0:
+            logger.debug(f"📏 Изображение уже подходящего размера: {len(image_bytes) / 1024 / 1024:.2f} МБ")
+            return image_bytes
+
+        # Единственное декодирование; JPEG без альфа-канала и палитры
+        img = img.convert('RGB') if img.mode != 'RGB' else img
+        img.load()
+        return _compress_decoded(img, len(image_bytes), max_size_bytes, max_scale)[0]
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка при сжатии изображения: {e}")
+        return image_bytes
+
+
+class PreparedImage(NamedTuple):
+    """Изображение, готовое к отправке фото в Telegram"""
+    data: Optional[bytes]        # None — исходные байты подходят как есть
+    width: int
+    height: int
+    error: Optional[str] = None  # почему отправить фото нельзя; None — можно
+
+
+def prepare_image(image_bytes: bytes, max_size_mb: float = MAX_FILE_SIZE_MB) -> PreparedImage:
+    """
+    Подготовка фото для Telegram за один проход: формат, размеры и ориентация из заголовка,
+    поворот по EXIF, уменьшение до ограничений и одно кодирование.
+    Если формат, размер и ориентация уже подходят, data=None: исходные байты не возвращаются
+    обратно из воркера. Размеры результата известны без повторного декодирования
+    """
+    try:
+        max_size_bytes = max_size_mb * 1024 * 1024
+        img = Image.open(BytesIO(image_bytes))
+        # Только заголовок: формат, размеры, EXIF
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        width, height = img.size
+        max_scale = _dimension_scale(width, height)
+
+        if (img.format in PASSTHROUGH_FORMATS and orientation == 1
+                and len(image_bytes) <= max_size_bytes and max_scale == 1.0):
+            logger.debug(f"📏 Изображение уже подходит: {img.format} {width}x{height}, "
+                         f"{len(image_bytes) / 1024 / 1024:.2f} МБ")
+            return PreparedImage(None, width, height)
+
+        # Единственное декодирование; поворот по EXIF до подбора масштаба (стороны могут поменяться)
+        if orientation != 1:
+            logger.debug(f"🔄 Поворот по EXIF: ориентация {orientation}")
+            img = ImageOps.exif_transpose(img)
+        img = img.convert('RGB') if img.mode != 'RGB' else img
+        img.load()
+
+        data, (width, height) = _compress_decoded(img, len(image_bytes), max_size_bytes, _dimension_scale(*img.size))
+        return PreparedImage(data, width, height, _dimension_error(width, height))
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка при подготовке изображения: {e}")
+        return PreparedImage(None, 0, 0, f"Не удалось прочитать изображение: {e}")
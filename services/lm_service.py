@@ -3,7 +3,10 @@ import yaml
 import aiohttp
 import logging
 from typing import List, Tuple
-from .db_service import get_marked_posts
+from .db_service import get_marked_posts, get_negative_examples_version, split_tags, find_similar_descriptions
+from .prompt_service import STARTERS, DESCRIPTION_PROMPT_TEMPLATE, MAX_NEGATIVE_EXAMPLES, render_description_prompt
+from .metrics_service import UPSTREAM_SECONDS, UPSTREAM_ERRORS, CACHE_REQUESTS
+from .tracing_service import span
 import random
 
 LM_STUDIO_URL = os.getenv("LM_STUDIO_URL")
@@ -12,52 +15,97 @@ LM_MODEL = os.getenv("LM_MODEL")
 with open("vars.yaml", encoding="utf-8") as f:
     cfg = yaml.load(f, Loader=yaml.FullLoader)
 SYSTEM_PROMPT = cfg["prompts"]["content"]
-
-STARTERS = [
-    "Опиши, что ты чувствуешь **внутри**, не упоминая внешность.",
-    "Погрузись в свои желания, не отвлекаясь на детали вокруг.",
-    "Опиши своё возбуждение, не рассказывая о том, как ты выглядишь.",
-    "Передай внутреннее состояние, будто ты шепчешь это на ухо.",
-    "Ты — девушка, которая вот-вот сорвётся от желания. Что у тебя в голове?"
-]
+SIMILARITY = cfg.get("similarity", {})
 
 starter_instruction = random.choice(STARTERS)
 
-
-async def process_tags_with_lm(tags: List[str]) -> Tuple[str, str]:
-    tags_str = ", ".join(tags)
+# Негативные примеры перечитываются только при смене версии в app_meta
+_negative_examples = {"version": None, "posts": []}
+
+
+async def get_negative_examples() -> list:
+    """Помеченные посты (id, description) для промпта, с кешем по версии"""
+    version = await get_negative_examples_version()
+    if version != _negative_examples["version"]:
+        CACHE_REQUESTS.labels("negative_examples", "miss").inc()
+        _negative_examples["posts"] = (await get_marked_posts())[:MAX_NEGATIVE_EXAMPLES]
+        _negative_examples["version"] = version
+        logging.debug("🔄 Негативные примеры обновлены (версия %s)", version)
+    else:
+        CACHE_REQUESTS.labels("negative_examples", "hit").inc()
+    return _negative_examples["posts"]
+
+
+def _words(text: str) -> set:
+    return {word for word in "".join(ch if ch.isalnum() else " " for ch in text.lower()).split() if len(word) >= 4}
+
+
+async def find_similar_post(desc: str):
+    """
+    Ищет среди последних постов описание, слишком похожее на desc.
+    FTS-индекс дает нескольких кандидатов, похожесть — доля общих слов (Жаккар).
+    Возвращает (id, похожесть) или None
+    """
+    words = _words(desc)
+    if not words:
+        return None
+    threshold = SIMILARITY.get("threshold", 0.6)
+    candidates = await find_similar_descriptions(desc, recent=SIMILARITY.get("recent_posts", 500))
+    for post_id, other in candidates:
+        other_words = _words(other or "")
+        score = len(words & other_words) / len(words | other_words) if other_words else 0
+        if score >= threshold:
+            return post_id, score
+    return None
+
+
+def smart_truncate(text: str, max_length: int = 250) -> str:
+    """Умное обрезание текста: по концу предложения, затем по пробелу, затем по лимиту"""
+    if len(text) <= max_length:
+        return text
+
+    # Поиск последнего полного предложения
+    sentence_endings = ['. ', '! ', '? ', '.\n', '!\n', '?\n']
+    best_cut = -1
+
+    for ending in sentence_endings:
+        pos = text.rfind(ending, 0, max_length)
+        if pos > best_cut and pos > 150:  # Минимум 150 символов
+            best_cut = pos + len(ending) - 1
+
+    if best_cut > 150:
+        return text[:best_cut + 1].rstrip()
+
+    # Если нет полных предложений, ищем пробел после слова
+    space_pos = text.rfind(' ', 150, max_length - 3)
+    if space_pos > 150:
+        return text[:space_pos] + "..."
+
+    # Крайний случай - обрезаем по лимиту
+    return text[:max_length - 3] + "..."
+
+
+async def process_tags_with_lm(tags: List[str]) -> Tuple[str, dict]:
+    """
+    Генерирует описание по тегам.
+    Возвращает (описание, части промпта) — части сохраняются в БД компактно
+    (шаблон + переменные), полный текст пересобирается по требованию.
+    """
+    tags = split_tags(tags)
 
     # Получаем негативные примеры
-    marked_posts = await get_marked_posts()
-    negative_examples = ""
-    if marked_posts:
-        negative_examples = "\n\n❌ НЕУДАЧНЫЕ ПРИМЕРЫ (ИЗБЕГАЙ ТАКОГО СТИЛЯ):\n"
-        for i, bad_desc in enumerate(marked_posts[:3], 1):  # Ограничиваем до 3 примеров для экономии токенов
-            # Обрезаем длинные примеры
-            short_desc = bad_desc[:150] + "..." if len(bad_desc) > 150 else bad_desc
-            negative_examples += f"❌ Плохо: {short_desc}\n"
-        negative_examples += "\n⚠️ НЕ повторяй ошибки из этих примеров!"
-
-    prompt = (
-        f"{starter_instruction}\n"
-        f"Теги ситуации: {tags_str}\n"
-        f"{negative_examples}\n\n"
-        f"КАК НУЖНО ПИСАТЬ:\n"
-        f'Каждое движение внутри сводит меня с ума...'
-        f'Так горячо... я больше не могу терпеть...'
-        f'Мне хочется сорваться прямо сейчас...'
-        f"✓ 'Мне так хочется, чтобы ты трахнул меня...'\n"
-        f"✓ 'Ох, я не могу сдержать свои стоны...'\n\n"
-        f"КАК НЕЛЬЗЯ ПИСАТЬ:\n"
-        f"✗ 'Мои длинные волосы...' / 'Я красивая...'\n"
-        f"✗ 'Комната освещена...' / 'На мне платье...'\n"
-        f"✗ 'Моя силуэт...' / 'Мое тело...'\n\n"
-        f"ТРЕБОВАНИЯ:\n"
-        f"• 150-200 символов\n"
-        f"• ТОЛЬКО от первого лица (я, мне, моя)\n"
-        f"• ТОЛЬКО ощущения и желания, НИКАКОЙ внешности!\n"
-        f"• Маты разрешены и приветствуются\n\n"
-        f"Напиши КАК ТЫ ЧУВСТВУЕШЬ сейчас:"
+    marked_posts = await get_negative_examples()
+    prompt_parts = {
+        "template": DESCRIPTION_PROMPT_TEMPLATE,
+        "starter": starter_instruction,
+        "tags": tags,
+        "negative_ids": [post_id for post_id, _ in marked_posts],
+        # Тексты тоже: исходные посты может удалить (заархивировать) retention
+        "negatives": [description for _, description in marked_posts],
+    }
+    prompt = render_description_prompt(
+        DESCRIPTION_PROMPT_TEMPLATE, starter_instruction, tags,
+        [description for _, description in marked_posts]
     )
 
     payload = {
@@ -70,53 +118,43 @@ async def process_tags_with_lm(tags: List[str]) -> Tuple[str, str]:
         "max_tokens": 300,  # Увеличиваем для гарантии 150+ символов
         "stop": None  # Не используем stop-слова, пусть модель завершает сама
     }
+    retries = SIMILARITY.get("retries", 1)
     try:
         async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    f"{LM_STUDIO_URL}/v1/chat/completions",
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=120)
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    desc = data["choices"][0]["message"]["content"].strip()
-
-                    # Умное обрезание текста
-                    def smart_truncate(text, max_length=250):
-                        if len(text) <= max_length:
-                            return text
-
-                        # Поиск последнего полного предложения
-                        sentence_endings = ['. ', '! ', '? ', '.\n', '!\n', '?\n']
-                        best_cut = -1
-
-                        for ending in sentence_endings:
-                            pos = text.rfind(ending, 0, max_length)
-                            if pos > best_cut and pos > 150:  # Минимум 150 символов
-                                best_cut = pos + len(ending) - 1
-
-                        if best_cut > 150:
-                            return text[:best_cut + 1].rstrip()
-
-                        # Если нет полных предложений, ищем пробел после слова
-                        space_pos = text.rfind(' ', 150, max_length - 3)
-                        if space_pos > 150:
-                            return text[:space_pos] + "..."
-
-                        # Крайний случай - обрезаем по лимиту
-                        return text[:max_length - 3] + "..."
-
-                    desc = smart_truncate(desc)
-
-                    # Проверка на минимальную длину после обрезания
-                    if not desc or len(desc.strip()) < 100:  # Снижаем минимум, чтобы не отклонять нормальные тексты
-                        logging.warning(f"Описание слишком короткое ({len(desc)} симв.): {desc}")
-                        return "", f"{prompt}\n\n[ОТКЛОНЕНО: слишком короткое описание - {len(desc)} символов]"
-
-                    logging.info(f"Сгенерированное описание ({len(desc)} симв.): {desc}")
-
-                    return desc, prompt
-                logging.error(f"LM Studio API returned {resp.status}")
+            for attempt in range(retries + 1):
+                async with span("lm_studio.chat", series=UPSTREAM_SECONDS.labels("lm_studio", LM_MODEL or ""),
+                                model=LM_MODEL, attempt=attempt), session.post(
+                        f"{LM_STUDIO_URL}/v1/chat/completions",
+                        json=payload,
+                        timeout=aiohttp.ClientTimeout(total=120)
+                ) as resp:
+                    if resp.status == 200:
+                        data = await resp.json()
+                        desc = data["choices"][0]["message"]["content"].strip()
+
+                        desc = smart_truncate(desc)
+
+                        # Проверка на минимальную длину после обрезания
+                        if not desc or len(desc.strip()) < 100:  # Снижаем минимум, чтобы не отклонять нормальные тексты
+                            logging.warning(f"Описание слишком короткое ({len(desc)} симв.): {desc}")
+                            prompt_parts["note"] = f"[ОТКЛОНЕНО: слишком короткое описание - {len(desc)} символов]"
+                            return "", prompt_parts
+
+                        # Проверка на повтор недавних описаний по FTS-индексу
+                        similar = await find_similar_post(desc)
+                        if similar and attempt < retries:
+                            logging.warning(f"Описание похоже на пост #{similar[0]} ({similar[1]:.0%}), генерируем заново")
+                            continue
+                        if similar:
+                            logging.warning(f"Описание похоже на пост #{similar[0]} ({similar[1]:.0%}), попытки исчерпаны")
+
+                        logging.info(f"Сгенерированное описание ({len(desc)} симв.): {desc}")
+
+                        return desc, prompt_parts
+                    UPSTREAM_ERRORS.labels("lm_studio").inc()
+                    logging.error(f"LM Studio API returned {resp.status}")
+                    break
     except Exception as e:
+        UPSTREAM_ERRORS.labels("lm_studio").inc()
         logging.error(f"process_tags_with_lm error: {e}")
-    return "", prompt
+    return "", prompt_parts
@@ -0,0 +1,124 @@
+import os
+import json
+import yaml
+import queue
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+from datetime import datetime, timezone
+from typing import Optional
+
+from .events_service import current_batch, current_post
+
+with open("vars.yaml", encoding="utf-8") as f:
+    LOGGING = yaml.load(f, Loader=yaml.FullLoader).get("logging", {})
+
+# Логирование оркестратора: event loop только кладет запись в очередь (QueueHandler),
+# форматирование и запись в консоль/файл идут в потоке QueueListener.
+# К каждой записи добавляются batch_id и post_id текущей задачи.
+
+LOG_FILE = LOGGING.get("file", "logs/tgposter.log")
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ColoredFormatter(logging.Formatter):
+    """Кастомный форматтер с цветами и эмодзи"""
+
+    grey = "\x1b[38;21m"
+    green = "\x1b[32m"
+    yellow = "\x1b[33m"
+    red = "\x1b[31m"
+    bold_red = "\x1b[31;1m"
+    reset = "\x1b[0m"
+
+    COLORS = {
+        logging.DEBUG: grey,
+        logging.INFO: green,
+        logging.WARNING: yellow,
+        logging.ERROR: red,
+        logging.CRITICAL: bold_red,
+    }
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, datefmt=DATE_FORMAT)
+
+    def format(self, record):
+        return self.COLORS.get(record.levelno, "") + super().format(record) + self.reset
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение, batch_id, post_id"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "batch_id": getattr(record, "batch_id", None),
+            "post_id": getattr(record, "post_id", None),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет batch_id/post_id; выполняется в потоке, где запись создана, до постановки в очередь"""
+
+    def filter(self, record):
+        record.batch_id = current_batch.get()
+        record.post_id = current_post.get()
+        return True
+
+
+_listener = None
+
+
+def setup_logging() -> Optional[logging.handlers.QueueListener]:
+    """
+    Настраивает корневой логгер по секции logging в vars.yaml:
+    format (text/json) для файла, level и уровни по модулям в levels
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    if multiprocessing.parent_process() is not None:
+        # Воркер пула (executor_service) при spawn заново импортирует главный модуль:
+        # его логи идут в основной процесс, свои обработчики и файл ему не нужны
+        return None
+
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(LOGGING.get("level", "INFO"))
+    for name, level in (LOGGING.get("levels") or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ColoredFormatter())
+
+    os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=LOGGING.get("max_bytes", 10 * 1024 * 1024),
+        backupCount=LOGGING.get("backup_count", 5),
+        encoding="utf-8"
+    )
+    if LOGGING.get("format") == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root_logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    _listener.start()
+    # Дописываем оставшиеся в очереди записи при выходе
+    atexit.register(_listener.stop)
+    return _listener
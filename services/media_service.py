@@ -0,0 +1,137 @@
+import os
+import yaml
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from .db_service import media_digest, media_file_digest
+from .executor_service import run_pillow
+from .image_service import PreparedImage, prepare_image, MAX_FILE_SIZE_MB
+from .metrics_service import CACHE_REQUESTS
+
+logger = logging.getLogger('media_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    MEDIA = yaml.load(f, Loader=yaml.FullLoader).get("media", {})
+
+# Подготовка фото к отправке в Telegram (image_service.prepare_image в пуле executor_service)
+# с кешем результата по sha256 исходных байт: повторы, перепланирование и повторные отправки
+# того же изображения обходятся без декодирования и кодирования.
+# Кеш двухуровневый: в памяти (LRU по объему) и на диске (переживает перезапуск).
+# На диске — только заголовок (ширина, высота, признак «исходник подходит») и перекодированные байты.
+
+CACHE_DIR = MEDIA.get("cache_dir", "media_cache")
+MEMORY_CACHE_BYTES = MEDIA.get("memory_cache_mb", 64) * 1024 * 1024
+DISK_CACHE_MB = MEDIA.get("disk_cache_mb", 512)  # None — без кеша на диске
+# Меняется вместе с результатом prepare_image: старые записи кеша перестают совпадать
+PREPARE_VERSION = 1
+_HEADER = struct.Struct("<IIB")
+
+_memory_cache: "OrderedDict[str, PreparedImage]" = OrderedDict()
+_memory_cache_bytes = 0
+
+
+def _cache_key(digest: str, max_size_mb: float) -> str:
+    return f"{digest}-{max_size_mb:g}mb-v{PREPARE_VERSION}"
+
+
+def _remember(key: str, prepared: PreparedImage):
+    global _memory_cache_bytes
+    if key in _memory_cache:
+        return
+    _memory_cache[key] = prepared
+    _memory_cache_bytes += len(prepared.data)
+    while _memory_cache_bytes > MEMORY_CACHE_BYTES and len(_memory_cache) > 1:
+        _, evicted = _memory_cache.popitem(last=False)
+        _memory_cache_bytes -= len(evicted.data)
+
+
+def _read_disk(key: str, image_bytes: bytes) -> Optional[PreparedImage]:
+    try:
+        with open(os.path.join(CACHE_DIR, key), "rb") as f:
+            width, height, passthrough = _HEADER.unpack(f.read(_HEADER.size))
+            data = image_bytes if passthrough else f.read()
+    except (FileNotFoundError, struct.error):
+        return None
+    return PreparedImage(data, width, height)
+
+
+def _write_disk(key: str, prepared: PreparedImage, passthrough: bool):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, key)
+    # Через временный файл: параллельный читатель не увидит недописанную запись
+    with open(path + ".tmp", "wb") as f:
+        f.write(_HEADER.pack(prepared.width, prepared.height, passthrough))
+        if not passthrough:
+            f.write(prepared.data)
+    os.replace(path + ".tmp", path)
+    _prune_disk()
+
+
+def _prune_disk():
+    """Самые старые записи удаляются, пока кеш на диске больше disk_cache_mb"""
+    entries = [entry for entry in os.scandir(CACHE_DIR) if entry.is_file() and not entry.name.endswith(".tmp")]
+    total = sum(entry.stat().st_size for entry in entries)
+    limit = DISK_CACHE_MB * 1024 * 1024
+    if total <= limit:
+        return
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+        if total <= limit:
+            break
+
+
+async def digest_media(data: bytes) -> str:
+    """media_digest вне потока event loop: sha256 отпускает GIL"""
+    return await asyncio.to_thread(media_digest, data)
+
+
+async def digest_media_file(path: str) -> str:
+    return await asyncio.to_thread(media_file_digest, path)
+
+
+async def prepare_media(image_bytes: bytes, max_size_mb: float = MAX_FILE_SIZE_MB,
+                        digest: Optional[str] = None) -> PreparedImage:
+    """
+    Фото, готовое к отправке: не больше max_size_mb и ограничений Telegram, с учетом ориентации EXIF.
+    data — байты для отправки (исходные, если они уже подходят); error — почему отправить нельзя.
+    digest — media_digest(image_bytes), если уже посчитан
+    """
+    if digest is None:
+        digest = await digest_media(image_bytes)
+    key = _cache_key(digest, max_size_mb)
+
+    prepared = _memory_cache.get(key)
+    if prepared is not None:
+        _memory_cache.move_to_end(key)
+        CACHE_REQUESTS.labels("prepared_media", "hit").inc()
+        logger.debug(f"♻️ Подготовленное изображение из кеша: {digest[:12]}")
+        return prepared
+
+    if DISK_CACHE_MB:
+        prepared = await asyncio.to_thread(_read_disk, key, image_bytes)
+        if prepared is not None:
+            CACHE_REQUESTS.labels("prepared_media", "hit").inc()
+            logger.debug(f"♻️ Подготовленное изображение с диска: {digest[:12]}")
+            _remember(key, prepared)
+            return prepared
+
+    CACHE_REQUESTS.labels("prepared_media", "miss").inc()
+    prepared = await run_pillow(prepare_image, image_bytes, max_size_mb)
+    if prepared.error:
+        # Ошибки не кешируются: битый файл может быть перекачан
+        return prepared._replace(data=image_bytes)
+
+    passthrough = prepared.data is None
+    if passthrough:
+        prepared = prepared._replace(data=image_bytes)
+    _remember(key, prepared)
+    if DISK_CACHE_MB:
+        try:
+            await asyncio.to_thread(_write_disk, key, prepared, passthrough)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить подготовленное изображение в кеш: {e}")
+    return prepared
@@ -0,0 +1,268 @@
+import time
+import yaml
+import logging
+import threading
+from bisect import bisect_left
+from functools import wraps
+from typing import Optional, Sequence
+
+from aiohttp import web
+
+logger = logging.getLogger('metrics_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    METRICS = yaml.load(f, Loader=yaml.FullLoader).get("metrics", {})
+
+# Метрики процесса в формате Prometheus (text exposition 0.0.4) на локальном порту.
+# Запись дешевая: серия с набором меток создается один раз и кешируется,
+# observe/inc — арифметика под блокировкой серии; текст формируется лишь при запросе /metrics.
+# Блокировки нужны: метрики пишутся и из потоков asyncio.to_thread (загрузки reddit_service).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REGISTRY = []
+
+
+def _label_str(names: Sequence[str], values: Sequence[str]) -> str:
+    pairs = [
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for name, value in zip(names, values)
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Серия для значений меток (кешируется, вызывать можно на каждом запросе)"""
+        series = self._series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+            # Два потока не создадут одну серию дважды (инкременты первой потерялись бы)
+            with self._lock:
+                series = self._series.setdefault(values, self._new_series())
+        return series
+
+    def _default(self):
+        return self.labels()
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._series.items())
+        for values, series in items:
+            lines.extend(series.render(self.name, _label_str(self.labelnames, values)))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str, labels: str) -> list:
+        return [f"{name}{labels} {_number(self.value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_series(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_series(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+
+class _HistogramSeries:
+    __slots__ = ("bounds", "counts", "sum", "count", "lock")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        bucket = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def render(self, name: str, labels: str) -> list:
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        inner = labels[1:-1] + "," if labels else ""
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{inner}le="{_number(bound)}"}} {cumulative}')
+        lines.append(f"{name}_sum{labels} {_number(total)}")
+        lines.append(f"{name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    """Контекстный менеджер (with и async with): наблюдает время выполнения блока"""
+    __slots__ = ("series", "started")
+
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.series.observe(time.perf_counter() - self.started)
+        return False
+
+    # Можно использовать и в async with рядом с сессией/запросом aiohttp
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.__exit__(*exc)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+def timed(series):
+    """Декоратор async-функции: длительность вызова пишется в серию гистограммы"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Метрики бота
+POSTS = Counter("tgposter_posts_total", "Обработанные посты по источнику и результату", ["source", "result"])
+POSTS_IN_PROGRESS = Gauge("tgposter_posts_in_progress", "Посты в обработке")
+STAGE_SECONDS = Histogram("tgposter_stage_seconds", "Длительность этапов обработки поста", ["stage"])
+BATCH_SECONDS = Histogram("tgposter_batch_seconds", "Длительность батча отложенных постов",
+                          buckets=(60, 300, 600, 1200, 1800, 2700, 3600, 7200))
+BATCH_SCHEDULED = Gauge("tgposter_last_batch_scheduled_posts", "Запланировано постов в последнем батче")
+UPSTREAM_SECONDS = Histogram("tgposter_upstream_request_seconds", "Длительность запросов к внешним сервисам",
+                             ["upstream", "model"])
+UPSTREAM_ERRORS = Counter("tgposter_upstream_errors_total", "Ошибки запросов к внешним сервисам", ["upstream"])
+DB_SECONDS = Histogram("tgposter_db_operation_seconds", "Длительность операций с БД", ["operation"],
+                       buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+CACHE_REQUESTS = Counter("tgposter_cache_requests_total", "Обращения к кешам (hit/miss)", ["cache", "result"])
+DOWNLOADED_BYTES = Counter("tgposter_downloaded_bytes_total", "Скачано байт", ["source"])
+UPLOADED_BYTES = Counter("tgposter_uploaded_bytes_total", "Отправлено байт в Telegram", ["media_type"])
+TELEGRAM_QUEUE_DEPTH = Gauge("tgposter_telegram_queue_depth", "Запросы в очереди диспетчера Telegram", ["priority"])
+TELEGRAM_QUEUE_WAIT = Histogram("tgposter_telegram_queue_wait_seconds", "Ожидание запроса в очереди Telegram",
+                                ["priority"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+TELEGRAM_ACTIVE = Gauge("tgposter_telegram_requests_active", "Выполняющиеся запросы к Telegram")
+TELEGRAM_FLOOD_WAITS = Counter("tgposter_telegram_flood_waits_total", "Ответы RetryAfter (flood control) от Telegram")
+OUTBOX_DELIVERIES = Counter("tgposter_outbox_deliveries_total", "Попытки отправки отложенных постов по результату",
+                            ["result"])
+OUTBOX_LAG = Histogram("tgposter_outbox_lag_seconds", "Задержка публикации относительно scheduled_time",
+                       buckets=(1, 5, 15, 60, 300, 900, 3600, 6 * 3600, 24 * 3600))
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-cache"})
+
+
+async def start_metrics_server(host: Optional[str] = None, port: Optional[int] = None):
+    """Поднимает /metrics в текущем event loop. Порт null в vars.yaml — выключено"""
+    host = host or METRICS.get("host", "127.0.0.1")
+    port = port if port is not None else METRICS.get("port")
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось открыть порт метрик {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,166 @@
+import yaml
+import signal
+import asyncio
+import logging
+import argparse
+from typing import Optional
+
+from telegram.error import BadRequest, Forbidden, TimedOut
+
+from .db_service import (init_db, utc_now, claim_scheduled_post, next_scheduled_post_time, mark_scheduled_post_sent,
+                         mark_scheduled_post_failed, retry_scheduled_post, release_stale_scheduled_posts)
+from .metrics_service import OUTBOX_DELIVERIES, OUTBOX_LAG, start_metrics_server
+
+logger = logging.getLogger('outbox_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    OUTBOX = yaml.load(f, Loader=yaml.FullLoader).get("outbox", {})
+
+# Публикация отложенных постов Bot API из scheduled_posts (Bot API не умеет отложку):
+#   python -m services.outbox_service
+# - спит до ближайшего next_attempt_at (MIN по индексу idx_scheduled_posts_due), не перебирая таблицу;
+#   строки, добавленные другим процессом (оркестратором), замечает не позже max_sleep_sec
+# - строку забирает атомарно (pending → sending), отправляет через telegram_service.send_scheduled_post
+# - временные ошибки — повтор с удвоением паузы, не больше max_attempts попыток
+# - пометка sent проверяет номер попытки: строку, забранную заново, старая попытка не перезапишет
+# Bot API не принимает ключ идемпотентности: если процесс упал (или запрос оборвался по таймауту)
+# после отправки, но до пометки, исход неизвестен. Такие посты по умолчанию не повторяются,
+# а помечаются failed — лучше пропуск, чем дубль в канале; resend_unconfirmed: true — повторять.
+
+MAX_ATTEMPTS = OUTBOX.get("max_attempts", 5)
+BACKOFF_SEC = OUTBOX.get("backoff_sec", 30)
+BACKOFF_MAX_SEC = OUTBOX.get("backoff_max_sec", 1800)
+LEASE_SEC = OUTBOX.get("lease_sec", 900)
+RESEND_UNCONFIRMED = OUTBOX.get("resend_unconfirmed", False)
+MAX_SLEEP_SEC = OUTBOX.get("max_sleep_sec", 60)
+MARK_ATTEMPTS = 5  # пометка sent после успешной отправки повторяется, сам пост — никогда
+
+UNCONFIRMED_ERROR = "Отправка прервана, исход неизвестен: проверьте канал"
+# Повтор не поможет: неверный запрос, нет прав в канале, битое медиа, неизвестный тип.
+# Сюда же AlbumPartiallySentError (ValueError): часть альбомов галереи в канале, повтор их продублирует
+PERMANENT_ERRORS = (BadRequest, Forbidden, ValueError)
+
+
+def _backoff(attempt: int) -> int:
+    return min(BACKOFF_MAX_SEC, BACKOFF_SEC * 2 ** (attempt - 1))
+
+
+async def _release_stale():
+    """Строки, захваченные раньше lease_sec назад, — отправка прервана падением процесса"""
+    released = await release_stale_scheduled_posts(utc_now() - LEASE_SEC, RESEND_UNCONFIRMED, UNCONFIRMED_ERROR)
+    if released:
+        OUTBOX_DELIVERIES.labels("unconfirmed").inc(len(released))
+        if RESEND_UNCONFIRMED:
+            logger.warning(f"⚠️ Прерванные отправки возвращены в очередь: {released}")
+        else:
+            logger.error(f"❌ Прерванные отправки с неизвестным исходом (не повторяются): {released}")
+
+
+async def _mark_sent(post: dict, message_id: int):
+    """Пост уже в канале: повторяется только пометка, не отправка"""
+    for attempt in range(1, MARK_ATTEMPTS + 1):
+        try:
+            if not await mark_scheduled_post_sent(post['id'], message_id, attempt=post['attempts']):
+                logger.warning(f"⚠️ Пост #{post['id']} отправлен, но строку уже забрали заново")
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось пометить пост #{post['id']} отправленным ({e}), попытка {attempt}")
+            await asyncio.sleep(attempt)
+    # Строка останется в sending и после lease_sec уйдет в failed без повторной отправки
+    logger.error(f"❌ Пост #{post['id']} отправлен (message_id: {message_id}), но не помечен в БД")
+
+
+async def deliver(post: dict, send) -> bool:
+    """Одна попытка отправки захваченного поста; True — пост в канале"""
+    attempt = post['attempts']
+    try:
+        message_id = await send(post)
+    except TimedOut as e:
+        # Запрос мог дойти до Telegram: тот же случай, что падение процесса посреди отправки
+        if RESEND_UNCONFIRMED and attempt < MAX_ATTEMPTS:
+            await retry_scheduled_post(post['id'], str(e), utc_now() + _backoff(attempt))
+            OUTBOX_DELIVERIES.labels("retry").inc()
+        else:
+            await mark_scheduled_post_failed(post['id'], f"{UNCONFIRMED_ERROR} ({e})")
+            OUTBOX_DELIVERIES.labels("unconfirmed").inc()
+        logger.error(f"❌ Таймаут отправки поста #{post['id']}: {e}")
+        return False
+    except PERMANENT_ERRORS as e:
+        await mark_scheduled_post_failed(post['id'], str(e))
+        OUTBOX_DELIVERIES.labels("failed").inc()
+        logger.error(f"❌ Пост #{post['id']} не может быть отправлен: {e}")
+        return False
+    except Exception as e:
+        if attempt >= MAX_ATTEMPTS:
+            await mark_scheduled_post_failed(post['id'], str(e))
+            OUTBOX_DELIVERIES.labels("failed").inc()
+            logger.error(f"❌ Пост #{post['id']} не отправлен за {attempt} попыток: {e}")
+        else:
+            delay = _backoff(attempt)
+            await retry_scheduled_post(post['id'], str(e), utc_now() + delay)
+            OUTBOX_DELIVERIES.labels("retry").inc()
+            logger.warning(f"⚠️ Пост #{post['id']}: попытка {attempt} не удалась ({e}), повтор через {delay} сек")
+        return False
+
+    await _mark_sent(post, message_id)
+    OUTBOX_DELIVERIES.labels("sent").inc()
+    OUTBOX_LAG.observe(max(0, utc_now() - post['scheduled_time']))
+    logger.info(f"✅ Пост #{post['id']} ({post['post_id']}) опубликован, message_id: {message_id}")
+    return True
+
+
+async def run_outbox(stop: Optional[asyncio.Event] = None):
+    """Публикует посты по мере наступления их времени, пока не выставлен stop"""
+    # Импорт здесь: telegram_service читает BOT_TOKEN и CHANNEL_ID из окружения при импорте
+    from .telegram_service import send_scheduled_post
+
+    stop = stop or asyncio.Event()
+    logger.info("📬 Outbox запущен")
+    await _release_stale()
+    while not stop.is_set():
+        try:
+            post = await claim_scheduled_post()
+            if post is not None:
+                # По одному: порядок публикации в канале совпадает с порядком scheduled_time
+                await deliver(post, send_scheduled_post)
+                continue
+
+            await _release_stale()
+            next_time = await next_scheduled_post_time()
+            delay = MAX_SLEEP_SEC if next_time is None else min(MAX_SLEEP_SEC, max(0, next_time - utc_now()))
+            if next_time is not None and delay < MAX_SLEEP_SEC:
+                logger.debug("⏰ Следующий пост через %d сек", delay)
+        except Exception as e:
+            # БД занята или недоступна: строка в sending разберется по lease_sec
+            logger.error(f"❌ Ошибка outbox: {e}")
+            delay = MAX_SLEEP_SEC
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+    logger.info("🛑 Outbox остановлен")
+
+
+async def main():
+    await init_db()
+    # Свой порт: оркестратор с батчем может работать одновременно
+    await start_metrics_server(port=OUTBOX.get("metrics_port"))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            # Текущая отправка доводится до пометки в БД, новые строки не забираются
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await run_outbox(stop)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from .logging_service import setup_logging
+
+    load_dotenv()
+    setup_logging()
+    argparse.ArgumentParser(description="Публикация отложенных постов Bot API из scheduled_posts").parse_args()
+    asyncio.run(main())
@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import yaml
+import pstats
+import asyncio
+import logging
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger('profiling_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    PROFILING = yaml.load(f, Loader=yaml.FullLoader).get("profiling", {})
+
+# Режим профилирования батча (orchestrator.py --profile или TGPOSTER_PROFILE=1).
+# За один прогон собираются:
+#   profile.pstats     — cProfile (детерминированный) для pstats/snakeviz
+#   stacks.collapsed   — сэмплы стека потока event loop для flamegraph.pl/speedscope
+#   summary.txt        — топ функций, задачи asyncio, задержка event loop, пиковый RSS, tracemalloc
+# Профилировщики заметно замедляют прогон, поэтому режим включается только явно.
+
+PROFILE_ENV = "TGPOSTER_PROFILE"
+PROFILES_DIR = PROFILING.get("dir", "profiles")
+SAMPLE_INTERVAL = PROFILING.get("sample_interval_ms", 5) / 1000
+LAG_INTERVAL = PROFILING.get("lag_interval_ms", 100) / 1000
+TRACEMALLOC_FRAMES = PROFILING.get("tracemalloc_frames", 10)
+TOP = PROFILING.get("top", 30)
+
+
+def profiling_enabled(flag: bool = False) -> bool:
+    return flag or os.getenv(PROFILE_ENV, "").lower() in ("1", "true", "yes")
+
+
+class StackSampler(threading.Thread):
+    """Периодически снимает стек указанного потока и считает одинаковые стеки"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class TaskTimings:
+    """Фабрика задач event loop: время жизни каждой задачи asyncio по имени корутины"""
+
+    def __init__(self):
+        self.durations = {}
+        self.previous_factory = None
+
+    def install(self, loop):
+        self.previous_factory = loop.get_task_factory()
+
+        def factory(loop, coro, **kwargs):
+            if self.previous_factory is not None:
+                task = self.previous_factory(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            started = time.perf_counter()
+            name = getattr(coro, "__qualname__", type(coro).__name__)
+            task.add_done_callback(
+                lambda _: self.durations.setdefault(name, []).append(time.perf_counter() - started))
+            return task
+
+        loop.set_task_factory(factory)
+
+    def uninstall(self, loop):
+        loop.set_task_factory(self.previous_factory)
+
+    def report(self) -> list:
+        lines = [f"{'задача':<60} {'кол-во':>7} {'всего, с':>10} {'макс., с':>9}"]
+        ranked = sorted(self.durations.items(), key=lambda item: sum(item[1]), reverse=True)
+        for name, values in ranked[:TOP]:
+            lines.append(f"{name[:60]:<60} {len(values):>7} {sum(values):>10.2f} {max(values):>9.2f}")
+        return lines
+
+
+async def measure_loop_lag(samples: list, interval: float):
+    """Насколько позже запланированного просыпается sleep — задержка event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - expected)
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса в МБ (ru_maxrss в Linux в килобайтах, в macOS — в байтах); nan, где нет resource"""
+    # Импорт здесь: модуля resource нет в Windows, а orchestrator импортирует этот сервис и без --profile
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def _percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+async def run_profiled(coro_fn, *args, **kwargs):
+    """Выполняет coro_fn под профилировщиками и пишет результаты в profiles/<время запуска>/"""
+    run_dir = os.path.join(PROFILES_DIR, time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+    logger.info(f"🔬 Профилирование прогона, результаты: {run_dir}")
+
+    loop = asyncio.get_running_loop()
+    tasks = TaskTimings()
+    tasks.install(loop)
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag_samples, LAG_INTERVAL))
+    sampler = StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+
+    started = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        return await coro_fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        sampler.stop()
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        tasks.uninstall(loop)
+        # Собственные выделения профилировщика в топ не попадают
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        traced_current, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(os.path.join(run_dir, "profile.pstats"))
+        sampler.write(os.path.join(run_dir, "stacks.collapsed"))
+        write_summary(os.path.join(run_dir, "summary.txt"), profiler, elapsed, tasks, lag_samples,
+                      snapshot, traced_peak, sum(sampler.stacks.values()))
+        logger.info(f"🔬 Профиль сохранен: {run_dir} ({elapsed:.1f} сек)")
+
+
+def write_summary(path: str, profiler, elapsed: float, tasks: TaskTimings, lag_samples: list,
+                  snapshot, traced_peak: int, samples: int):
+    lines = [
+        f"Время прогона: {elapsed:.1f} сек",
+        f"Пиковый RSS процесса: {peak_rss_mb():.1f} МБ",
+        f"Пик памяти под tracemalloc: {traced_peak / 1024 / 1024:.1f} МБ",
+        f"Сэмплов стека: {samples} (интервал {SAMPLE_INTERVAL * 1000:.0f} мс)",
+        "",
+        "Задержка event loop:",
+    ]
+    if lag_samples:
+        lines.append(f"  замеров {len(lag_samples)}, средняя {sum(lag_samples) / len(lag_samples) * 1000:.1f} мс, "
+                     f"p99 {_percentile(lag_samples, 0.99) * 1000:.1f} мс, макс. {max(lag_samples) * 1000:.1f} мс")
+    else:
+        lines.append("  нет замеров")
+
+    lines += ["", "Задачи asyncio:"] + tasks.report()
+
+    lines += ["", f"Топ-{TOP} мест выделения памяти (tracemalloc):"]
+    for stat in snapshot.statistics("lineno")[:TOP]:
+        frame = stat.traceback[0]
+        lines.append(f"  {stat.size / 1024:>10.1f} КБ {stat.count:>8} блоков  {frame.filename}:{frame.lineno}")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n\n")
+        f.write(f"Топ-{TOP} функций по суммарному времени (cProfile):\n")
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP)
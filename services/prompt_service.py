@@ -0,0 +1,78 @@
+import hashlib
+from typing import List, Optional
+
+# Модуль без побочных эффектов (не читает vars.yaml и .env),
+# поэтому его можно импортировать и из дашборда для пересборки промптов
+
+STARTERS = [
+    "Опиши, что ты чувствуешь **внутри**, не упоминая внешность.",
+    "Погрузись в свои желания, не отвлекаясь на детали вокруг.",
+    "Опиши своё возбуждение, не рассказывая о том, как ты выглядишь.",
+    "Передай внутреннее состояние, будто ты шепчешь это на ухо.",
+    "Ты — девушка, которая вот-вот сорвётся от желания. Что у тебя в голове?"
+]
+
+# Шаблон хранится в prompt_templates один раз, в post_logs — только переменные части
+DESCRIPTION_PROMPT_TEMPLATE = (
+    "{starter}\n"
+    "Теги ситуации: {tags}\n"
+    "{negative_examples}\n\n"
+    "КАК НУЖНО ПИСАТЬ:\n"
+    "Каждое движение внутри сводит меня с ума..."
+    "Так горячо... я больше не могу терпеть..."
+    "Мне хочется сорваться прямо сейчас..."
+    "✓ 'Мне так хочется, чтобы ты трахнул меня...'\n"
+    "✓ 'Ох, я не могу сдержать свои стоны...'\n\n"
+    "КАК НЕЛЬЗЯ ПИСАТЬ:\n"
+    "✗ 'Мои длинные волосы...' / 'Я красивая...'\n"
+    "✗ 'Комната освещена...' / 'На мне платье...'\n"
+    "✗ 'Моя силуэт...' / 'Мое тело...'\n\n"
+    "ТРЕБОВАНИЯ:\n"
+    "• 150-200 символов\n"
+    "• ТОЛЬКО от первого лица (я, мне, моя)\n"
+    "• ТОЛЬКО ощущения и желания, НИКАКОЙ внешности!\n"
+    "• Маты разрешены и приветствуются\n\n"
+    "Напиши КАК ТЫ ЧУВСТВУЕШЬ сейчас:"
+)
+
+MAX_NEGATIVE_EXAMPLES = 3  # Ограничиваем до 3 примеров для экономии токенов
+NEGATIVE_EXAMPLE_LENGTH = 150
+
+# Ключ в app_meta: версия набора помеченных постов. Дашборд увеличивает ее один раз
+# на пакет пометок, lm_service перечитывает негативные примеры только при смене версии
+NEGATIVE_EXAMPLES_VERSION_KEY = "negative_examples_version"
+
+
+def prompt_hash(body: str) -> str:
+    """Ключ шаблона в prompt_templates"""
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def build_negative_examples(descriptions: List[str]) -> str:
+    """Собирает блок негативных примеров из помеченных описаний"""
+    if not descriptions:
+        return ""
+
+    block = "\n\n❌ НЕУДАЧНЫЕ ПРИМЕРЫ (ИЗБЕГАЙ ТАКОГО СТИЛЯ):\n"
+    for bad_desc in descriptions[:MAX_NEGATIVE_EXAMPLES]:
+        # Обрезаем длинные примеры
+        if len(bad_desc) > NEGATIVE_EXAMPLE_LENGTH:
+            short_desc = bad_desc[:NEGATIVE_EXAMPLE_LENGTH] + "..."
+        else:
+            short_desc = bad_desc
+        block += f"❌ Плохо: {short_desc}\n"
+    block += "\n⚠️ НЕ повторяй ошибки из этих примеров!"
+    return block
+
+
+def render_description_prompt(template: str, starter: str, tags: List[str],
+                              negative_descriptions: List[str], note: Optional[str] = None) -> str:
+    """Собирает полный промпт для LM Studio из шаблона и переменных частей"""
+    prompt = template.format(
+        starter=starter,
+        tags=", ".join(tags),
+        negative_examples=build_negative_examples(negative_descriptions)
+    )
+    if note:
+        prompt += f"\n\n{note}"
+    return prompt
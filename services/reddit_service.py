@@ -1,16 +1,47 @@
 import requests
 import json
 import os
+import time
 import logging
 from urllib.parse import urlsplit, unquote
 from bs4 import BeautifulSoup
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+from .metrics_service import UPSTREAM_SECONDS, UPSTREAM_ERRORS, DOWNLOADED_BYTES
+from .tracing_service import span, record_span
+from .executor_service import call_cpu
 
 USER_AGENT = "python:reddit.parser:v2.0 (by /u/Yar0v)"
+# Адрес Reddit переопределяется для стендов бенчмарка (bench/)
+REDDIT_BASE_URL = os.getenv("REDDIT_BASE_URL", "https://www.reddit.com").rstrip("/")
 
 # Настройка логгера для reddit_service
 logger = logging.getLogger('reddit_service')
-logger.setLevel(logging.DEBUG)
+
+
+def find_media_in_html(html: str) -> Optional[Tuple[str, str]]:
+    """Прямой URL медиа на HTML-странице: (url, "video" | "image") или None"""
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Попробуем найти видео
+    video = soup.find("video")
+    if video:
+        logger.debug("🎥 Найден тег <video>")
+        src = None
+        if video.has_attr("src"):
+            src = video["src"]
+        else:
+            src_tag = video.find("source")
+            if src_tag and src_tag.has_attr("src"):
+                src = src_tag["src"]
+        return (src, "video") if src else None
+
+    # Попробуем найти изображение
+    img = soup.find("img")
+    if img and img.has_attr("src"):
+        logger.debug("🖼️ Найден тег <img>")
+        return img["src"], "image"
+    return None
 
 
 def download_media(url: str, folder: str = "downloads", index: int = 0) -> str:
@@ -25,47 +56,28 @@ def download_media(url: str, folder: str = "downloads", index: int = 0) -> str:
     try:
         # 1) Первый запрос — чтобы понять, это сразу файл или HTML-страница
         logger.debug(f"🔍 Выполняем GET запрос к {url}")
-        resp = requests.get(url, headers=headers, allow_redirects=True, timeout=15)
+        with span("reddit.page", series=UPSTREAM_SECONDS.labels("reddit", "media"), url=url):
+            resp = requests.get(url, headers=headers, allow_redirects=True, timeout=15)
         resp.raise_for_status()
+        DOWNLOADED_BYTES.labels("reddit").inc(len(resp.content))
         ctype = resp.headers.get("Content-Type", "").lower()
         logger.debug(f"📋 Content-Type: {ctype}")
 
         # Если это HTML — ищем прямой URL на медиа внутри
         if "text/html" in ctype:
             logger.debug("🌐 Обнаружен HTML, парсим страницу...")
-            soup = BeautifulSoup(resp.text, "html.parser")
-
-            # Попробуем найти видео
-            video = soup.find("video")
-            if video:
-                logger.debug("🎥 Найден тег <video>")
-                src = None
-                if video.has_attr("src"):
-                    src = video["src"]
-                else:
-                    src_tag = video.find("source")
-                    if src_tag and src_tag.has_attr("src"):
-                        src = src_tag["src"]
-                if src:
-                    logger.info(f"🔗 Найден прямой URL видео: {src}")
-                    url = src
-                    # Обновляем content-type
-                    sub_resp = requests.head(url, headers=headers, timeout=10)
-                    ctype = sub_resp.headers.get("Content-Type", "video/mp4").lower()
-            else:
-                # Попробуем найти изображение
-                img = soup.find("img")
-                if img and img.has_attr("src"):
-                    logger.debug("🖼️ Найден тег <img>")
-                    src = img["src"]
-                    logger.info(f"🔗 Найден прямой URL изображения: {src}")
-                    url = src
-                    # Обновляем content-type
-                    sub_resp = requests.head(url, headers=headers, timeout=10)
-                    ctype = sub_resp.headers.get("Content-Type", "image/jpeg").lower()
+            # Разбор страницы держит GIL — в пуле процессов, поток только ждет результат
+            found = call_cpu(find_media_in_html, resp.text)
+            if found:
+                url, kind = found
+                logger.info(f"🔗 Найден прямой URL {'видео' if kind == 'video' else 'изображения'}: {url}")
+                # Обновляем content-type
+                sub_resp = requests.head(url, headers=headers, timeout=10)
+                ctype = sub_resp.headers.get("Content-Type", "video/mp4" if kind == "video" else "image/jpeg").lower()
 
         # Загружаем файл
         logger.debug(f"⬇️ Скачиваем файл по URL: {url}")
+        download_started = time.perf_counter()
         file_resp = requests.get(url, headers=headers, stream=True, timeout=30)
         file_resp.raise_for_status()
         
@@ -121,7 +133,10 @@ def download_media(url: str, folder: str = "downloads", index: int = 0) -> str:
                 if total_size > 0:
                     progress = (downloaded / total_size) * 100
                     if progress % 25 < 1:  # Логируем каждые 25%
-                        logger.debug(f"⏬ Загружено: {progress:.1f}%")
+                        logger.debug("⏬ Загружено: %.1f%%", progress)
+        UPSTREAM_SECONDS.labels("reddit", "media").observe(time.perf_counter() - download_started)
+        record_span("reddit.media", "upstream", download_started, url=url, bytes=downloaded)
+        DOWNLOADED_BYTES.labels("reddit").inc(downloaded)
 
         # Проверяем, что скачали действительно изображение/видео, а не HTML
         if len(content_data) > 100:
@@ -139,6 +154,8 @@ def download_media(url: str, folder: str = "downloads", index: int = 0) -> str:
         return filepath
 
     except Exception as e:
+        if isinstance(e, requests.RequestException):
+            UPSTREAM_ERRORS.labels("reddit").inc()
         logger.error(f"❌ Ошибка при скачивании медиа: {e}")
         raise
 
@@ -257,12 +274,14 @@ def fetch_latest_posts(subreddit: str, limit: int = 8) -> List[Dict]:
         List[Dict]: список постов в том же формате, что и fetch_latest
     """
     logger.info(f"🔍 Получаем {limit} последних постов из r/{subreddit}")
-    api_url = f"https://www.reddit.com/r/{subreddit}.json?limit={limit}"
+    api_url = f"{REDDIT_BASE_URL}/r/{subreddit}.json?limit={limit}"
     headers = {"User-Agent": USER_AGENT}
 
     try:
-        resp = requests.get(api_url, headers=headers, timeout=15)
+        with span("reddit.listing", series=UPSTREAM_SECONDS.labels("reddit", "listing"), subreddit=subreddit):
+            resp = requests.get(api_url, headers=headers, timeout=15)
         resp.raise_for_status()
+        DOWNLOADED_BYTES.labels("reddit").inc(len(resp.content))
         data = resp.json()
 
         children = data.get("data", {}).get("children", [])
@@ -280,6 +299,7 @@ def fetch_latest_posts(subreddit: str, limit: int = 8) -> List[Dict]:
         return posts
 
     except requests.RequestException as e:
+        UPSTREAM_ERRORS.labels("reddit").inc()
         logger.error(f"❌ Ошибка при запросе к Reddit API: {e}")
         return []
     except Exception as e:
@@ -0,0 +1,250 @@
+import os
+import gzip
+import json
+import yaml
+import asyncio
+import logging
+import argparse
+import aiosqlite
+from datetime import datetime
+from typing import Optional
+
+from .db_service import DATABASE_PATH, utc_now
+
+logger = logging.getLogger('retention_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    RETENTION = yaml.load(f, Loader=yaml.FullLoader).get("retention", {})
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+def _cutoff(days: Optional[int]) -> Optional[int]:
+    """Граница по времени (UTC epoch) для политики "хранить N дней" или None, если выключена"""
+    if days is None:
+        return None
+    return utc_now() - int(days) * DAY_SECONDS
+
+
+async def _db_bytes(db) -> tuple:
+    """(размер файла БД, размер свободных страниц) в байтах"""
+    page_size = (await (await db.execute("PRAGMA page_size")).fetchone())[0]
+    page_count = (await (await db.execute("PRAGMA page_count")).fetchone())[0]
+    freelist = (await (await db.execute("PRAGMA freelist_count")).fetchone())[0]
+    return page_count * page_size, freelist * page_size
+
+
+async def _vacuum_step(db, pages: int):
+    """Возвращает ОС до pages свободных страниц (только при auto_vacuum=INCREMENTAL)"""
+    # Не execute: модуль sqlite3 делает один шаг запроса без колонок, и освобождается одна страница.
+    # executescript выполняет pragma до конца (и сначала фиксирует открытую транзакцию — ее здесь нет)
+    await db.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+
+
+async def _run_batches(db, name: str, batch_fn, pause: float, vacuum_pages: int) -> int:
+    """
+    Повторяет batch_fn (одна короткая транзакция) пока она что-то обрабатывает.
+    Между батчами — шаг incremental_vacuum и пауза, чтобы публикация и дашборд
+    не ждали блокировку
+    """
+    total = 0
+    while True:
+        processed = await batch_fn(db)
+        await db.commit()
+        if not processed:
+            break
+        total += processed
+        await _vacuum_step(db, vacuum_pages)
+        await asyncio.sleep(pause)
+
+    if total:
+        logger.info(f"🧹 {name}: обработано {total} строк")
+    return total
+
+
+def _strip_media_batch(table: str, column: str, where: str, params: tuple, batch_size: int):
+    """Батч обнуления BLOB-колонки у старых строк (по возрастанию id)"""
+    last_id = 0
+
+    async def batch(db) -> int:
+        nonlocal last_id
+        cur = await db.execute(f"""
+            SELECT id FROM {table}
+            WHERE id > ? AND {where} AND {column} IS NOT NULL
+            ORDER BY id LIMIT ?
+        """, (last_id, *params, batch_size))
+        ids = [row[0] for row in await cur.fetchall()]
+        if not ids:
+            return 0
+        last_id = ids[-1]
+        await db.executemany(f"UPDATE {table} SET {column} = NULL WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    return batch
+
+
+def _delete_batch(table: str, key: str, where: str, params: tuple, batch_size: int):
+    """Батч удаления старых строк"""
+
+    async def batch(db) -> int:
+        cur = await db.execute(f"""
+            DELETE FROM {table}
+            WHERE {key} IN (SELECT {key} FROM {table} WHERE {where} LIMIT ?)
+        """, (*params, batch_size))
+        return cur.rowcount
+
+    return batch
+
+
+def _archive_post_logs_batch(cutoff: int, segment_path: str, batch_size: int):
+    """
+    Батч архивации post_logs: строки (без image_data) с именами тегов
+    дописываются в gzip-сегмент отдельным членом, затем удаляются из БД.
+    Файл синхронизируется до удаления, поэтому при сбое строка может попасть
+    в архив дважды, но не потеряется
+    """
+
+    state = {}
+
+    async def batch(db) -> int:
+        if not state:
+            # id монотонны по created_at: граница считается один раз по индексу
+            cur = await db.execute("SELECT MAX(id) FROM post_logs WHERE created_at < ?", (cutoff,))
+            state["max_id"] = (await cur.fetchone())[0] or 0
+            cur = await db.execute("PRAGMA table_info(post_logs)")
+            state["columns"] = [row[1] for row in await cur.fetchall() if row[1] != "image_data"]
+
+        columns = state["columns"]
+        cur = await db.execute(f"""
+            SELECT {', '.join(columns)} FROM post_logs
+            WHERE id <= ?
+            ORDER BY id LIMIT ?
+        """, (state["max_id"], batch_size))
+        rows = [dict(zip(columns, row)) for row in await cur.fetchall()]
+        if not rows:
+            return 0
+
+        ids = [row["id"] for row in rows]
+        qmarks = ", ".join("?" for _ in ids)
+        cur = await db.execute(f"""
+            SELECT pt.post_id, t.name FROM post_tags pt JOIN tags t ON t.id = pt.tag_id
+            WHERE pt.post_id IN ({qmarks}) ORDER BY pt.post_id, pt.position
+        """, ids)
+        tag_names = {}
+        for post_id, name in await cur.fetchall():
+            tag_names.setdefault(post_id, []).append(name)
+
+        lines = []
+        for row in rows:
+            row["tag_names"] = tag_names.get(row["id"], [])
+            lines.append(json.dumps(row, ensure_ascii=False))
+
+        def write_segment():
+            with gzip.open(segment_path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+        await asyncio.to_thread(write_segment)
+
+        await db.execute(f"DELETE FROM post_tags WHERE post_id IN ({qmarks})", ids)
+        await db.execute(f"DELETE FROM post_logs WHERE id IN ({qmarks})", ids)
+        return len(ids)
+
+    return batch
+
+
+async def run_retention(config: dict = None) -> dict:
+    """
+    Применяет политики хранения из vars.yaml (секция retention) небольшими батчами.
+    Возвращает отчет: обработанные строки по политикам и освобожденные байты
+    """
+    config = config or RETENTION
+    tables = config.get("tables", {})
+    batch_size = int(config.get("batch_size", 200))
+    pause = float(config.get("batch_pause_sec", 0.2))
+    vacuum_pages = int(config.get("vacuum_step_pages", 256))
+    vacuum_max_steps = int(config.get("vacuum_max_steps", 40))
+
+    report = {}
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.execute("PRAGMA busy_timeout = 5000")
+        auto_vacuum = (await (await db.execute("PRAGMA auto_vacuum")).fetchone())[0]
+        if auto_vacuum != 2:
+            logger.warning("⚠️ auto_vacuum не INCREMENTAL: место будет переиспользоваться, но файл не уменьшится. "
+                           "Однократно выполните: python -m services.retention_service --enable-incremental-vacuum")
+        size_before, free_before = await _db_bytes(db)
+
+        post_logs = tables.get("post_logs", {})
+        scheduled = tables.get("scheduled_posts", {})
+        reddit = tables.get("reddit_posts", {})
+        jobs = []
+
+        cutoff = _cutoff(post_logs.get("archive_days"))
+        if cutoff is not None:
+            archive_dir = config.get("archive_dir", "archive")
+            os.makedirs(archive_dir, exist_ok=True)
+            segment = os.path.join(archive_dir, f"post_logs-{datetime.now():%Y%m%d-%H%M%S}.jsonl.gz")
+            jobs.append(("post_logs_archived", _archive_post_logs_batch(cutoff, segment, batch_size)))
+
+        cutoff = _cutoff(post_logs.get("media_days"))
+        if cutoff is not None:
+            jobs.append(("post_logs_media", _strip_media_batch(
+                "post_logs", "image_data", "created_at < ?", (cutoff,), batch_size)))
+
+        cutoff = _cutoff(scheduled.get("keep_days"))
+        if cutoff is not None:
+            jobs.append(("scheduled_posts_deleted", _delete_batch(
+                "scheduled_posts", "id", "status IN ('sent', 'failed') AND scheduled_time < ?", (cutoff,), batch_size)))
+
+        cutoff = _cutoff(scheduled.get("media_days"))
+        if cutoff is not None:
+            jobs.append(("scheduled_posts_media", _strip_media_batch(
+                "scheduled_posts", "media_data", "status IN ('sent', 'failed') AND scheduled_time < ?", (cutoff,), batch_size)))
+
+        cutoff = _cutoff(reddit.get("keep_days"))
+        if cutoff is not None:
+            jobs.append(("reddit_posts_deleted", _delete_batch(
+                "reddit_posts", "post_id", "processed_at < ?", (cutoff,), batch_size)))
+
+        for name, batch_fn in jobs:
+            report[name] = await _run_batches(db, name, batch_fn, pause, vacuum_pages)
+
+        # Добираем свободные страницы теми же небольшими шагами, не больше vacuum_max_steps за запуск:
+        # после большой чистки остаток freelist вернется ОС в следующие запуски
+        for _ in range(vacuum_max_steps if auto_vacuum == 2 else 0):
+            _, free_now = await _db_bytes(db)
+            if not free_now:
+                break
+            await _vacuum_step(db, vacuum_pages)
+            await asyncio.sleep(pause)
+
+        size_after, free_after = await _db_bytes(db)
+
+    report["bytes_reclaimed"] = size_before - size_after
+    report["bytes_free"] = free_after
+    logger.info(f"♻️ Retention завершен: {report}, "
+                f"файл БД {size_before / 1024 / 1024:.2f} МБ -> {size_after / 1024 / 1024:.2f} МБ")
+    return report
+
+
+async def enable_incremental_vacuum():
+    """Однократный перевод существующей БД в auto_vacuum=INCREMENTAL (полный VACUUM, блокирует БД)"""
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+        mode = (await (await db.execute("PRAGMA auto_vacuum")).fetchone())[0]
+    logger.info(f"✅ auto_vacuum = {mode} (2 = INCREMENTAL)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Очистка и сжатие telegram_bot.db по политикам хранения")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="однократно включить auto_vacuum=INCREMENTAL для существующей БД")
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        asyncio.run(enable_incremental_vacuum())
+    else:
+        asyncio.run(run_retention())
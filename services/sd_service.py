@@ -1,11 +1,22 @@
 import os
-import base64
+import json
 import logging
 import aiohttp
 from typing import List, Tuple
 
+from .metrics_service import UPSTREAM_SECONDS, UPSTREAM_ERRORS
+from .tracing_service import span
+from .executor_service import run_cpu, b64encode
+
 SD_URL = os.getenv("SD_URL")
 
+
+def _image_payload(b64: bytes, **fields) -> bytes:
+    """JSON-тело с изображением: base64 вставляется как есть, большая строка не проходит через json.dumps"""
+    rest = json.dumps(fields)[1:-1].encode()
+    return b'{"image": "data:image/png;base64,' + b64 + b'", ' + rest + b'}'
+
+
 async def interrogate_deepbooru(image_bytes: bytes) -> Tuple[List[str], str]:
     """
     Отправляем в SD WebUI interrogate-модели: deepdanbooru → deepbooru → clip → interrogate
@@ -15,14 +26,15 @@ async def interrogate_deepbooru(image_bytes: bytes) -> Tuple[List[str], str]:
     logger.info(f"🔍 Пытаемся получить теги через SD WebUI: {SD_URL}")
     
     try:
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
+        b64 = await run_cpu(b64encode, image_bytes)
         for model_name in ["deepdanbooru", "deepbooru", "clip", "interrogate"]:
             logger.info(f"🔮 Пробуем модель: {model_name}")
-            payload = {"image": f"data:image/png;base64,{b64}", "model": model_name}
-            async with aiohttp.ClientSession() as session:
+            payload = _image_payload(b64, model=model_name)
+            async with span("sd.interrogate", series=UPSTREAM_SECONDS.labels("sd", model_name), model=model_name,
+                            bytes=len(image_bytes)), aiohttp.ClientSession() as session:
                 async with session.post(
                     f"{SD_URL}/sdapi/v1/interrogate",
-                    json=payload,
+                    data=payload,
                     headers={"Content-Type": "application/json"},
                     timeout=aiohttp.ClientTimeout(total=120)
                 ) as resp:
@@ -30,9 +42,9 @@ async def interrogate_deepbooru(image_bytes: bytes) -> Tuple[List[str], str]:
                     if resp.status == 200:
                         data = await resp.json()
                         caption = data.get("caption", "")
-                        logger.info(f"📡 SD API ответ: {data}")
-                        logger.info(f"📝 Полная caption: '{caption}'")
-                        logger.info(f"📝 Получена caption: {caption[:100]}...")
+                        # Полный ответ — только на DEBUG и без форматирования на горячем пути
+                        logger.debug("📡 SD API ответ: %s", data)
+                        logger.info("📝 Получена caption: %s...", caption[:100])
                         
                         # Правильно парсим теги - SD может возвращать теги через запятую
                         if "," in caption:
@@ -45,12 +57,14 @@ async def interrogate_deepbooru(image_bytes: bytes) -> Tuple[List[str], str]:
                             logger.warning(f"⚠️ SD WebUI вернул ошибку или пустые теги: '{caption}'")
                             continue  # Пробуем следующую модель
                         
-                        logger.info(f"🏷️ Распарсили {len(tags)} тегов: {tags[:10]}")
-                        logger.info(f"🔍 Все теги: {tags}")
+                        logger.info("🏷️ Распарсили %d тегов: %s", len(tags), tags[:10])
+                        logger.debug("🔍 Все теги: %s", tags)
                         return tags, model_name
                     else:
+                        UPSTREAM_ERRORS.labels("sd").inc()
                         logger.warning(f"❌ Модель {model_name} не сработала: {resp.status}")
     except Exception as e:
+        UPSTREAM_ERRORS.labels("sd").inc()
         logger.error(f"❌ interrogate_deepbooru error: {e}")
     
     logger.warning("🚫 SD WebUI не дал тегов, возвращаем пустой список")
@@ -63,12 +77,13 @@ async def interrogate_with_tagger(image_bytes: bytes) -> Tuple[List[str], str]:
     Возвращаем (теги, "tagger_extension") или ([], reason)
     """
     try:
-        b64 = base64.b64encode(image_bytes).decode("utf-8")
-        payload = {"image": f"data:image/png;base64,{b64}", "threshold": 0.35}
-        async with aiohttp.ClientSession() as session:
+        payload = _image_payload(await run_cpu(b64encode, image_bytes), threshold=0.35)
+        async with span("sd.tagger", series=UPSTREAM_SECONDS.labels("sd", "tagger"),
+                        bytes=len(image_bytes)), aiohttp.ClientSession() as session:
             async with session.post(
                 f"{SD_URL}/tagger/v1/interrogate",
-                json=payload,
+                data=payload,
+                headers={"Content-Type": "application/json"},
                 timeout=aiohttp.ClientTimeout(total=60)
             ) as resp:
                 if resp.status == 200:
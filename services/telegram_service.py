@@ -1,349 +1,496 @@
 import os
+import asyncio
 import logging
-from telegram import Bot, InputMediaPhoto
+from telegram import Bot, InputFile, InputMediaPhoto
+from telegram.error import BadRequest
 from io import BytesIO
-from typing import List, Dict
-from PIL import Image
+from typing import List, Dict, Optional
+from datetime import datetime
+
+from .metrics_service import UPSTREAM_SECONDS, UPSTREAM_ERRORS, UPLOADED_BYTES, CACHE_REQUESTS
+from .tracing_service import span
+from .media_service import prepare_media, digest_media, digest_media_file
+from .db_service import (get_telegram_file_ids, save_telegram_file_ids, forget_telegram_file_ids, open_scheduled_media,
+                         get_scheduled_post_media, load_scheduled_post_media)
+from .dispatch_service import dispatch, PRIORITY_DUE, PRIORITY_NORMAL, PRIORITY_PREFETCH
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
-bot = Bot(token=BOT_TOKEN)
+# Адрес Bot API переопределяется для локального сервера Bot API и стендов бенчмарка (bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+bot = Bot(token=BOT_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+# Приватный чат для предварительной загрузки медиа (preupload_photo); не задан — предзагрузка выключена
+CACHE_CHAT_ID = os.getenv("TELEGRAM_CACHE_CHAT_ID")
 
 # Создаем логгер для telegram_service
 logger = logging.getLogger('telegram_service')
-logger.setLevel(logging.DEBUG)
 
-# Константы для сжатия изображений
-MAX_FILE_SIZE_MB = 10  # максимальный размер файла для Telegram фото
-MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+# Медиа, уже загруженное в Telegram, отправляется повторно по file_id (таблица telegram_media_cache):
+# ретраи, перепланирование и send_scheduled_post не загружают байты заново.
+# Ключ — sha256 исходника (media_digest, как в scheduled_posts.media_digest) и тип отправки.
+# Все отправки идут через dispatch_service: лимиты Telegram, паузы по RetryAfter, приоритеты
+# Видео и GIF загружаются потоком (InputFile с read_file_handle=False): httpx читает файл или BLOB
+# частями по 64 КБ, в памяти не держится весь файл
+PHOTO_TIMEOUTS = {"read_timeout": 120, "write_timeout": 120, "connect_timeout": 60}
+FILE_TIMEOUTS = {"read_timeout": 300, "write_timeout": 300, "connect_timeout": 60}
+MEDIA_GROUP_LIMIT = 10          # Telegram: от 2 до 10 элементов в альбоме
+ALBUM_PREPARE_CONCURRENCY = 4   # изображений галереи готовится одновременно (исходники в памяти)
+
+
+def _warn_not_scheduled(schedule_date: Optional[datetime]):
+    # В Bot API нет отложенных сообщений: schedule_date принимается для совместимости
+    # с USER API (telegram_service_pyrogram), сообщение уходит сразу
+    if schedule_date is not None:
+        logger.warning(f"⚠️ Bot API не поддерживает отложку, отправляем сразу (планировалось на {schedule_date})")
+
+
+async def check_channel_access() -> bool:
+    """Проверяет, что бот видит канал"""
+    try:
+        chat = await bot.get_chat(chat_id=CHANNEL_ID)
+        logger.info(f"✅ Доступ к каналу есть: {chat.title or chat.id}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Нет доступа к каналу {CHANNEL_ID}: {e}")
+        return False
+
+
+def _file_ids(message, kind: str) -> tuple:
+    """(file_id, file_unique_id) медиа отправленного сообщения; у фото — самый большой размер"""
+    media = getattr(message, kind)
+    if kind == "photo":
+        media = media[-1]
+    return media.file_id, media.file_unique_id
 
 
-def validate_image_dimensions(image_bytes: bytes) -> tuple[bool, str]:
-    """Проверяет размеры изображения на соответствие ограничениям Telegram"""
+async def _remember_file_id(kind: str, digest: str, message):
     try:
-        bio = BytesIO(image_bytes)
-        with Image.open(bio) as img:
-            width, height = img.size
-            
-            # Ограничения Telegram
-            max_resolution = 10000
-            max_total_size = 10000
-            
-            if width > max_resolution or height > max_resolution:
-                return False, f"Разрешение {width}x{height} превышает максимум {max_resolution}x{max_resolution}"
-            
-            if width + height > max_total_size:
-                return False, f"Общий размер {width + height} превышает лимит {max_total_size}"
-            
-            return True, f"Размеры {width}x{height} корректны"
-            
+        await save_telegram_file_ids(kind, [(digest, *_file_ids(message, kind))])
     except Exception as e:
-        return False, f"Ошибка при проверке размеров: {e}"
+        # Не мешает отправке: в худшем случае следующий раз медиа загрузится заново
+        logger.warning(f"⚠️ Не удалось сохранить file_id: {e}")
 
 
-def compress_image(image_bytes: bytes, max_size_mb: float = MAX_FILE_SIZE_MB) -> bytes:
+async def _send(kind: str, model: str, priority: int = PRIORITY_NORMAL, chat_id: Optional[str] = None,
+                cost: int = 1, span_attrs: Optional[dict] = None, **kwargs):
     """
-    Сжимает изображение до указанного размера в МБ
-    
-    Args:
-        image_bytes: исходные байты изображения
-        max_size_mb: максимальный размер в МБ
-        
-    Returns:
-        bytes: сжатое изображение
+    bot.send_<kind> через диспетчер. Спан и UPSTREAM_SECONDS — только сам запрос, без ожидания в очереди.
+    После RetryAfter запрос отправляется заново целиком. BytesIO (photo=bio) PTB читает с текущей позиции,
+    поэтому перед каждой попыткой он перематывается; потоки внутри InputFile перематывает сам httpx
     """
+    chat_id = chat_id or CHANNEL_ID
+    method = getattr(bot, f"send_{kind}")
+
+    async def call():
+        for value in kwargs.values():
+            if hasattr(value, "seek"):
+                value.seek(0)
+        with span(f"telegram.{model.removesuffix('_file_id')}", series=UPSTREAM_SECONDS.labels("telegram", model), **(span_attrs or {})):
+            return await method(chat_id=chat_id, **kwargs)
+
+    return await dispatch(call, chat_id, priority, cost, label=model)
+
+
+async def _resend(kind: str, digest: str, priority: int = PRIORITY_NORMAL, **kwargs):
+    """
+    Отправка уже загруженного медиа по file_id. None — file_id неизвестен или Telegram его
+    больше не принимает (другой бот, файл удален): запись удаляется, медиа нужно загрузить заново
+    """
+    file_id = (await get_telegram_file_ids(kind, [digest])).get(digest)
+    CACHE_REQUESTS.labels("telegram_file_id", "hit" if file_id else "miss").inc()
+    if not file_id:
+        return None
+
     try:
-        max_size_bytes = max_size_mb * 1024 * 1024
-        
-        # Если изображение уже меньше лимита, возвращаем как есть
-        if len(image_bytes) <= max_size_bytes:
-            logger.debug(f"📏 Изображение уже подходящего размера: {len(image_bytes) / 1024 / 1024:.2f} МБ")
-            return image_bytes
-        
-        logger.info(f"🗜️ Начинаем сжатие изображения: {len(image_bytes) / 1024 / 1024:.2f} МБ -> {max_size_mb} МБ")
-        
-        bio = BytesIO(image_bytes)
-        with Image.open(bio) as img:
-            # Конвертируем в RGB если необходимо
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-            
-            # Сохраняем оригинальные размеры
-            original_width, original_height = img.size
-            
-            # Начальное качество
-            quality = 85
-            
-            while quality > 5:
-                # Создаем копию изображения для сжатия
-                temp_img = img.copy()
-                
-                # Если качество меньше 70, начинаем уменьшать разрешение более агрессивно
-                if quality < 70:
-                    scale_factor = quality / 85  # Изменили базу для более агрессивного сжатия
-                    new_width = int(original_width * scale_factor)
-                    new_height = int(original_height * scale_factor)
-                    temp_img = temp_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # Сжимаем
-                output = BytesIO()
-                temp_img.save(output, format='JPEG', quality=quality, optimize=True)
-                compressed_bytes = output.getvalue()
-                
-                current_size_mb = len(compressed_bytes) / 1024 / 1024
-                logger.debug(f"   🎛️ Качество {quality}%, размер: {current_size_mb:.2f} МБ")
-                
-                # Если размер подходит, возвращаем результат
-                if len(compressed_bytes) <= max_size_bytes:
-                    logger.info(f"✅ Изображение сжато: {len(image_bytes) / 1024 / 1024:.2f} МБ -> {current_size_mb:.2f} МБ (качество {quality}%)")
-                    return compressed_bytes
-                
-                # Уменьшаем качество более агрессивно
-                if quality > 50:
-                    quality -= 10
-                elif quality > 20:
-                    quality -= 5
-                else:
-                    quality -= 2
-            
-            # Если даже минимальное качество не помогло, возвращаем что есть
-            logger.warning(f"⚠️ Не удалось сжать изображение до {max_size_mb} МБ, возвращаем с минимальным качеством")
-            return compressed_bytes
-            
+        return await _send(kind, f"send_{kind}_file_id", priority, span_attrs={"file_id": True},
+                           **{kind: file_id}, **kwargs)
+    except BadRequest as e:
+        logger.warning(f"⚠️ file_id не принят ({e}), загружаем заново")
+        await forget_telegram_file_ids(kind, [digest])
+        return None
     except Exception as e:
-        logger.error(f"❌ Ошибка при сжатии изображения: {e}")
-        return image_bytes
+        UPSTREAM_ERRORS.labels("telegram").inc()
+        logger.error(f"❌ Ошибка при отправке по file_id: {e}")
+        raise
+
+
+async def _photo_upload(image_bytes: bytes, digest: str, name: str = "image.jpg") -> BytesIO:
+    """Фото для загрузки: поворот, уменьшение и сжатие за один проход (вне потока event loop), повторно — из кеша"""
+    prepared = await prepare_media(image_bytes, digest=digest)
+    if prepared.error:
+        logger.error(f"❌ Изображение не прошло проверку: {prepared.error}")
+        raise ValueError(f"Invalid image dimensions: {prepared.error}")
+    logger.info(f"📏 Размеры {prepared.width}x{prepared.height} корректны")
 
+    bio = BytesIO(prepared.data)
+    bio.name = name  # jpg, так как сжимаем в JPEG
+    return bio
 
-async def send_photo(image_bytes: bytes, caption: str = None):
-    """Отправляет одиночное фото в канал"""
+
+async def send_photo(image_bytes: bytes, caption: str = None, schedule_date: Optional[datetime] = None):
+    """Отправляет одиночное фото в канал; уже загруженное — по file_id"""
+    _warn_not_scheduled(schedule_date)
     logger.info(f"📤 Начинаем отправку фото, размер: {len(image_bytes) / 1024 / 1024:.2f} МБ")
-    
-    # Сжимаем изображение если необходимо
-    compressed_bytes = compress_image(image_bytes)
-    
-    # Проверяем размеры изображения
-    is_valid, validation_msg = validate_image_dimensions(compressed_bytes)
-    logger.info(f"📏 {validation_msg}")
-    
-    if not is_valid:
-        logger.error(f"❌ Изображение не прошло проверку: {validation_msg}")
-        raise ValueError(f"Invalid image dimensions: {validation_msg}")
-    
-    bio = BytesIO(compressed_bytes)
-    bio.name = "image.jpg"  # Изменили на jpg так как сжимаем в JPEG
-    bio.seek(0)
+    caption = caption[:1024] if caption else None
+
+    digest = await digest_media(image_bytes)
+    message = await _resend("photo", digest, caption=caption, **PHOTO_TIMEOUTS)
+    if message is not None:
+        logger.info(f"✅ Фото отправлено по file_id (message_id: {message.message_id})")
+        return message
+
+    bio = await _photo_upload(image_bytes, digest)
+    upload_size = len(bio.getbuffer())
 
     try:
-        message = await bot.send_photo(
-            chat_id=CHANNEL_ID,
-            photo=bio,
-            caption=caption[:1024] if caption else None,
-            read_timeout=120,
-            write_timeout=120,
-            connect_timeout=60
-        )
-        
+        message = await _send("photo", "send_photo", span_attrs={"bytes": upload_size},
+                              photo=bio, caption=caption, **PHOTO_TIMEOUTS)
+        UPLOADED_BYTES.labels("image").inc(upload_size)
+        await _remember_file_id("photo", digest, message)
+
         logger.info(f"✅ Фото успешно отправлено (message_id: {message.message_id})")
         return message
     except Exception as e:
+        UPSTREAM_ERRORS.labels("telegram").inc()
         logger.error(f"❌ Ошибка при отправке фото: {e}")
         raise
 
 
-async def send_video(file_path: str):
-    """Отправляет видео в канал"""
+async def preupload_photo(image_bytes: bytes) -> bool:
+    """
+    Заранее загружает фото в приватный чат TELEGRAM_CACHE_CHAT_ID и запоминает file_id:
+    отправка в канал в назначенное время — без загрузки. False — чат не задан или загрузка не удалась
+    """
+    if not CACHE_CHAT_ID:
+        return False
+    digest = await digest_media(image_bytes)
+    if await get_telegram_file_ids("photo", [digest]):
+        return True
+    try:
+        bio = await _photo_upload(image_bytes, digest)
+        # Предзагрузка уступает очередь всем отправкам в канал
+        message = await _send("photo", "preupload_photo", PRIORITY_PREFETCH, chat_id=CACHE_CHAT_ID,
+                              span_attrs={"bytes": len(bio.getbuffer())},
+                              photo=bio, disable_notification=True, **PHOTO_TIMEOUTS)
+        UPLOADED_BYTES.labels("image").inc(len(bio.getbuffer()))
+        await _remember_file_id("photo", digest, message)
+        return True
+    except Exception as e:
+        UPSTREAM_ERRORS.labels("telegram").inc()
+        logger.warning(f"⚠️ Предзагрузка фото не удалась: {e}")
+        return False
+
+
+async def send_video(file_path: str, schedule_date: Optional[datetime] = None):
+    """Отправляет видео в канал; уже загруженное — по file_id"""
+    _warn_not_scheduled(schedule_date)
     logger.info(f"📤 Начинаем отправку видео: {file_path}")
 
+    digest = await digest_media_file(file_path)
+    message = await _resend("video", digest, **FILE_TIMEOUTS)
+    if message is not None:
+        logger.info(f"✅ Видео отправлено по file_id (message_id: {message.message_id})")
+        return message
+
     try:
         file_size = os.path.getsize(file_path) / 1024 / 1024  # MB
         logger.info(f"📊 Размер видео: {file_size:.2f} МБ")
 
         with open(file_path, "rb") as f:
-            message = await bot.send_video(
-                chat_id=CHANNEL_ID,
-                video=f,
-                read_timeout=300,
-                write_timeout=300,
-                connect_timeout=60
-            )
-        
+            message = await _send("video", "send_video", span_attrs={"bytes": os.path.getsize(file_path)},
+                                  video=InputFile(f, read_file_handle=False), **FILE_TIMEOUTS)
+        UPLOADED_BYTES.labels("video").inc(os.path.getsize(file_path))
+        await _remember_file_id("video", digest, message)
+
         logger.info(f"✅ Видео успешно отправлено (message_id: {message.message_id})")
         return message
     except Exception as e:
+        UPSTREAM_ERRORS.labels("telegram").inc()
         logger.error(f"❌ Ошибка при отправке видео: {e}")
         raise
 
 
-async def send_animation(file_path: str, caption: str = None):
-    """Отправляет GIF анимацию в канал"""
+async def send_animation(file_path: str, caption: str = None, schedule_date: Optional[datetime] = None):
+    """Отправляет GIF анимацию в канал; уже загруженную — по file_id"""
+    _warn_not_scheduled(schedule_date)
     logger.info(f"📤 Начинаем отправку анимации: {file_path}")
+    caption = caption[:1024] if caption else None
+
+    digest = await digest_media_file(file_path)
+    message = await _resend("animation", digest, caption=caption, **FILE_TIMEOUTS)
+    if message is not None:
+        logger.info(f"✅ Анимация отправлена по file_id (message_id: {message.message_id})")
+        return message
 
     try:
         file_size = os.path.getsize(file_path) / 1024 / 1024  # MB
         logger.info(f"📊 Размер анимации: {file_size:.2f} МБ")
 
         with open(file_path, "rb") as f:
-            message = await bot.send_animation(
-                chat_id=CHANNEL_ID,
-                animation=f,
-                caption=caption[:1024] if caption else None,
-                read_timeout=300,
-                write_timeout=300,
-                connect_timeout=60
-            )
-        
+            message = await _send("animation", "send_animation", span_attrs={"bytes": os.path.getsize(file_path)},
+                                  animation=InputFile(f, read_file_handle=False), caption=caption, **FILE_TIMEOUTS)
+        UPLOADED_BYTES.labels("gif").inc(os.path.getsize(file_path))
+        await _remember_file_id("animation", digest, message)
+
         logger.info(f"✅ Анимация успешно отправлена (message_id: {message.message_id})")
         return message
     except Exception as e:
+        UPSTREAM_ERRORS.labels("telegram").inc()
         logger.error(f"❌ Ошибка при отправке анимации: {e}")
         raise
 
 
-async def send_media_group(media_items: List[Dict]):
+class AlbumPartiallySentError(ValueError):
+    """Часть альбомов галереи уже в канале: повтор отправил бы их второй раз"""
+
+
+def _album_chunks(items: list) -> list:
+    """
+    Альбомы не больше MEDIA_GROUP_LIMIT элементов, поровну: 11 → 6 + 5, а не 10 + 1
+    (альбом из одного элемента Telegram не принимает)
+    """
+    count = -(-len(items) // MEDIA_GROUP_LIMIT)
+    size, extra = divmod(len(items), count)
+    chunks, start = [], 0
+    for number in range(count):
+        end = start + size + (1 if number < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+async def _item_digest(item: dict) -> str:
+    if item.get('digest'):
+        return item['digest']
+    if item.get('media') is None:
+        item['media'] = await item['load']()
+    return await digest_media(item['media'])
+
+
+async def _prepare_album(entries: list, file_ids: dict) -> list:
+    """
+    Элементы галереи [(номер, item, дайджест)]: известные — по file_id, остальные читаются (item['load'])
+    и подготавливаются одновременно, не больше ALBUM_PREPARE_CONCURRENCY исходников в памяти.
+    Возвращает [(номер, медиа, дайджест, загружаемые байты)] без не прошедших проверку, в исходном порядке
+    """
+    semaphore = asyncio.Semaphore(ALBUM_PREPARE_CONCURRENCY)
+
+    async def prepare(i: int, item: dict, digest: str):
+        if digest in file_ids:
+            logger.debug("   ♻️ Изображение #%d: по file_id", i + 1)
+            return i, file_ids[digest], digest, 0
+        async with semaphore:
+            data = item['media'] if item.get('media') is not None else await item['load']()
+            prepared = await prepare_media(data, digest=digest)
+        if prepared.error:
+            logger.warning(f"⚠️ Пропускаем изображение #{i + 1}: {prepared.error}")
+            return None
+        logger.debug("   📸 Изображение #%d: %dx%d, %.2f МБ", i + 1, prepared.width, prepared.height,
+                     len(prepared.data) / 1024 / 1024)
+        media = BytesIO(prepared.data)
+        media.name = f"image_{i}.jpg"  # jpg, так как сжимаем в JPEG
+        return i, media, digest, len(prepared.data)
+
+    results = await asyncio.gather(*(prepare(i, item, digest) for i, item, digest in entries))
+    return [result for result in results if result is not None]
+
+
+async def _send_album(items: list, caption: Optional[str], priority: int) -> list:
+    """Один альбом (или одиночное фото, если от галереи осталось одно изображение); подпись — к первому элементу"""
+    upload_size = sum(size for _, _, _, size in items)
+    span_attrs = {"bytes": upload_size, "items": len(items), "file_ids": sum(1 for *_, size in items if not size)}
+    if len(items) == 1:
+        message = await _send("photo", "send_photo", priority, span_attrs=span_attrs,
+                              photo=items[0][1], caption=caption, **PHOTO_TIMEOUTS)
+        return [message]
+    media_group = [InputMediaPhoto(media=media, caption=caption if n == 0 else None)
+                   for n, (_, media, _, _) in enumerate(items)]
+    # Альбом — по сообщению на элемент: в лимитах он стоит len(media_group) токенов
+    return await _send("media_group", "send_media_group", priority, cost=len(media_group),
+                       span_attrs=span_attrs, media=media_group, **FILE_TIMEOUTS)
+
+
+async def _send_album_chunk(chunk: list, media_items: List[Dict], caption: Optional[str], priority: int) -> tuple:
+    """Альбом с повтором без file_id, если Telegram их не принял. Возвращает (сообщения, отправленные элементы)"""
+    try:
+        return await _send_album(chunk, caption, priority), chunk
+    except BadRequest as e:
+        known = [digest for _, _, digest, size in chunk if not size]
+        if not known:
+            raise
+        # Какой из file_id не принят, Telegram не сообщает — забываем все и загружаем альбом целиком
+        logger.warning(f"⚠️ file_id в альбоме не приняты ({e}), загружаем заново")
+        await forget_telegram_file_ids("photo", known)
+        chunk = await _prepare_album([(i, media_items[i], digest) for i, _, digest, _ in chunk], {})
+        if not chunk:
+            raise
+        return await _send_album(chunk, caption, priority), chunk
+
+
+async def send_media_group(media_items: List[Dict], priority: int = PRIORITY_NORMAL,
+                           schedule_date: Optional[datetime] = None):
     """
-    Отправляет группу медиа-файлов (альбом) в канал
+    Отправляет галерею в канал альбомами до MEDIA_GROUP_LIMIT элементов; уже загруженные изображения —
+    по file_id, остальные подготавливаются одновременно. Подпись — к первому элементу первого альбома
 
     Args:
         media_items: Список словарей с ключами:
             - 'media': bytes - содержимое файла
+            - 'load': async-функция, возвращающая содержимое (вместо 'media': читается, только если нет file_id)
+            - 'digest': str - sha256 содержимого, если известен
             - 'caption': str - подпись (только для первого элемента)
+        priority: приоритет в очереди dispatch_service
+
+    Returns:
+        list: сообщения всех альбомов по порядку
     """
+    _warn_not_scheduled(schedule_date)
     logger.info(f"📤 Начинаем отправку медиа-группы из {len(media_items)} элементов")
+    caption = media_items[0].get('caption') if media_items else None
+    caption = caption[:1024] if caption else None  # Ограничение Telegram
 
+    messages = []
     try:
-        # Подготавливаем медиа для отправки
-        media_group = []
-
-        for i, item in enumerate(media_items):
-            # Сжимаем изображение если необходимо
-            compressed_media = compress_image(item['media'])
-            
-            # Проверяем размеры изображения
-            is_valid, validation_msg = validate_image_dimensions(compressed_media)
-            logger.debug(f"   📏 Изображение #{i + 1}: {validation_msg}")
-            
-            if not is_valid:
-                logger.warning(f"⚠️ Пропускаем изображение #{i + 1}: {validation_msg}")
-                continue
-            
-            bio = BytesIO(compressed_media)
-            bio.name = f"image_{i}.jpg"  # Изменили на jpg так как сжимаем в JPEG
-            bio.seek(0)
-
-            media_size = len(compressed_media) / 1024 / 1024
-            logger.debug(f"   📸 Изображение #{i + 1}: {media_size:.2f} МБ")
-
-            # Добавляем подпись только к первому элементу
-            if i == 0 and item.get('caption'):
-                media = InputMediaPhoto(
-                    media=bio,
-                    caption=item['caption'][:1024]  # Ограничение Telegram
-                )
-            else:
-                media = InputMediaPhoto(media=bio)
-
-            media_group.append(media)
-
-        # Отправляем группу
-        messages = await bot.send_media_group(
-            chat_id=CHANNEL_ID,
-            media=media_group,
-            read_timeout=300,
-            write_timeout=300,
-            connect_timeout=60
-        )
+        digests = await asyncio.gather(*(_item_digest(item) for item in media_items))
+        file_ids = await get_telegram_file_ids("photo", digests)
+        CACHE_REQUESTS.labels("telegram_file_id", "hit").inc(len(file_ids))
+        CACHE_REQUESTS.labels("telegram_file_id", "miss").inc(len(set(digests)) - len(file_ids))
+
+        items = await _prepare_album(list(zip(range(len(media_items)), media_items, digests)), file_ids)
+        if not items:
+            raise ValueError("Ни одно изображение галереи не прошло проверку")
+        chunks = _album_chunks(items)
+        if len(chunks) > 1:
+            logger.info(f"📚 Галерея из {len(items)} изображений: {len(chunks)} альбома(ов)")
+
+        for number, chunk in enumerate(chunks):
+            try:
+                sent, chunk = await _send_album_chunk(chunk, media_items, caption if number == 0 else None, priority)
+            except Exception as e:
+                if messages:
+                    raise AlbumPartiallySentError(
+                        f"Отправлено альбомов {number} из {len(chunks)}, остальные не отправлены: {e}") from e
+                raise
+            messages.extend(sent)
+            UPLOADED_BYTES.labels("gallery").inc(sum(size for *_, size in chunk))
+
+            uploaded = [(digest, *_file_ids(message, "photo")) for (_, _, digest, size), message in zip(chunk, sent)
+                        if size and message.photo]
+            if uploaded:
+                try:
+                    await save_telegram_file_ids("photo", uploaded)
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось сохранить file_id: {e}")
 
         logger.info(f"✅ Медиа-группа успешно отправлена. Сообщений: {len(messages)}")
-        logger.debug(f"   Message IDs: {[m.message_id for m in messages]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("   Message IDs: %s", [m.message_id for m in messages])
 
         return messages
 
     except Exception as e:
+        UPSTREAM_ERRORS.labels("telegram").inc()
         logger.error(f"❌ Ошибка при отправке медиа-группы: {e}")
         raise
 
 
+async def _scheduled_media(scheduled_post: dict, name: str):
+    """Медиа отложенного поста как файл: из BLOB частями (строки без media_data) или из переданных байт"""
+    if scheduled_post.get('media_data') is not None:
+        media = BytesIO(scheduled_post['media_data'])
+        media.name = name
+        return media
+    return await open_scheduled_media(scheduled_post['id'], name)
+
+
+async def _read_scheduled_media(scheduled_post: dict) -> bytes:
+    """Медиа отложенного поста целиком (изображения декодируются полностью)"""
+    media = await _scheduled_media(scheduled_post, "image")
+    try:
+        return await asyncio.to_thread(media.read)
+    finally:
+        media.close()
+
+
+async def _stream_scheduled(kind: str, scheduled_post: dict, name: str, **kwargs):
+    """Загрузка видео/GIF отложенного поста потоком, без чтения медиа в память"""
+    size = scheduled_post.get('media_size') or len(scheduled_post.get('media_data') or b"")
+    media = await _scheduled_media(scheduled_post, name)
+    try:
+        return await _send(kind, f"send_{kind}", PRIORITY_DUE, span_attrs={"bytes": size},
+                           **{kind: InputFile(media, filename=name, read_file_handle=False)}, **kwargs)
+    finally:
+        media.close()
+
+
 async def send_scheduled_post(scheduled_post: dict) -> int:
     """
-    Отправляет отложенный пост в Telegram
-    
+    Отправляет отложенный пост в Telegram; уже загруженное медиа — по file_id
+
     Args:
-        scheduled_post: словарь с данными отложенного поста
-        
+        scheduled_post: словарь с данными отложенного поста (метаданные строки scheduled_posts;
+            медиа читается из БД при отправке, если не передано в media_data)
+
     Returns:
         int: message_id отправленного сообщения
     """
     logger.info(f"📤 Отправляем отложенный пост: {scheduled_post['post_id']}")
-    
+
     media_type = scheduled_post['media_type']
-    media_data = scheduled_post['media_data']
     caption = scheduled_post.get('caption', '')
-    
+    caption = caption[:1024] if caption else None
+    digest = scheduled_post.get('media_digest')
+    if digest is None and scheduled_post.get('media_data') is not None:
+        digest = await digest_media(scheduled_post['media_data'])
+
     try:
+        # Остальные изображения галереи (первое — в самой строке); нет — отправляется одно фото
+        album = await get_scheduled_post_media(scheduled_post['id']) if media_type == 'gallery' else []
+
         if media_type == 'video':
             logger.info("🎥 Отправляем видео")
-            bio = BytesIO(media_data)
-            bio.name = "video.mp4"
-            bio.seek(0)
-            
-            message = await bot.send_video(
-                chat_id=CHANNEL_ID,
-                video=bio,
-                caption=caption[:1024] if caption else None,
-                read_timeout=300,
-                write_timeout=300,
-                connect_timeout=60
-            )
-            
+            message = await _resend("video", digest, PRIORITY_DUE, caption=caption, **FILE_TIMEOUTS)
+            if message is None:
+                message = await _stream_scheduled("video", scheduled_post, "video.mp4", caption=caption,
+                                                  **FILE_TIMEOUTS)
+                await _remember_file_id("video", digest, message)
+
         elif media_type == 'gif':
             logger.info("🎞️ Отправляем GIF")
-            bio = BytesIO(media_data)
-            bio.name = "animation.gif"
-            bio.seek(0)
-            
-            message = await bot.send_animation(
-                chat_id=CHANNEL_ID,
-                animation=bio,
-                caption=caption[:1024] if caption else None,
-                read_timeout=300,
-                write_timeout=300,
-                connect_timeout=60
-            )
-            
+            message = await _resend("animation", digest, PRIORITY_DUE, caption=caption, **FILE_TIMEOUTS)
+            if message is None:
+                message = await _stream_scheduled("animation", scheduled_post, "animation.gif", caption=caption,
+                                                  **FILE_TIMEOUTS)
+                await _remember_file_id("animation", digest, message)
+
+        elif album:
+            logger.info(f"🖼️ Отправляем галерею из {len(album) + 1} изображений")
+            messages = await send_media_group(
+                [{'load': lambda: _read_scheduled_media(scheduled_post), 'digest': digest, 'caption': caption}] +
+                [{'load': lambda position=item['position']: load_scheduled_post_media(scheduled_post['id'], position),
+                  'digest': item['media_digest']} for item in album],
+                priority=PRIORITY_DUE)
+            message = messages[0]
+
         elif media_type in ['image', 'gallery']:
             logger.info(f"🖼️ Отправляем {'галерею' if media_type == 'gallery' else 'изображение'}")
-            
-            # Сжимаем изображение если необходимо
-            compressed_bytes = compress_image(media_data)
-            
-            # Проверяем размеры изображения
-            is_valid, validation_msg = validate_image_dimensions(compressed_bytes)
-            logger.info(f"📏 {validation_msg}")
-            
-            if not is_valid:
-                logger.error(f"❌ Изображение не прошло проверку: {validation_msg}")
-                raise ValueError(f"Invalid image dimensions: {validation_msg}")
-            
-            bio = BytesIO(compressed_bytes)
-            bio.name = "image.jpg"
-            bio.seek(0)
-            
-            message = await bot.send_photo(
-                chat_id=CHANNEL_ID,
-                photo=bio,
-                caption=caption[:1024] if caption else None,
-                read_timeout=120,
-                write_timeout=120,
-                connect_timeout=60
-            )
-            
+            message = await _resend("photo", digest, PRIORITY_DUE, caption=caption, **PHOTO_TIMEOUTS)
+            if message is None:
+                # Изображение декодируется целиком, поэтому читается из БД полностью — только сейчас
+                media_data = await _read_scheduled_media(scheduled_post)
+                digest = digest or await digest_media(media_data)
+                # Тот же исходник уже готовился при планировании — результат из кеша
+                bio = await _photo_upload(media_data, digest)
+                message = await _send("photo", "send_photo", PRIORITY_DUE, span_attrs={"bytes": len(bio.getbuffer())},
+                                      photo=bio, caption=caption, **PHOTO_TIMEOUTS)
+                await _remember_file_id("photo", digest, message)
+
         else:
             raise ValueError(f"Неподдерживаемый тип медиа: {media_type}")
-            
+
         logger.info(f"✅ Отложенный пост отправлен (message_id: {message.message_id})")
         return message.message_id
-        
+
     except Exception as e:
         logger.error(f"❌ Ошибка при отправке отложенного поста: {e}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import yaml
+import logging
+import argparse
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger('tracing_service')
+
+with open("vars.yaml", encoding="utf-8") as f:
+    TRACING = yaml.load(f, Loader=yaml.FullLoader).get("tracing", {})
+
+# Трассировка батча: вложенные спаны batch → post → stage → запрос к внешнему сервису.
+# Трасса пишется одним JSON-файлом на батч в формате Chrome Trace Event
+# (открывается в chrome://tracing и ui.perfetto.dev). Вложенность в этом формате
+# задается временем внутри одного трека (tid): каждый пост получает свой трек,
+# поэтому параллельно обрабатываемые посты не перекрываются.
+# Без активной трассы span() ничего не записывает.
+
+TRACES_DIR = TRACING.get("dir", "traces")
+KEEP_TRACES = TRACING.get("keep", 100)
+
+
+class Trace:
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+        self.events = []
+        self.tracks = {0: name}
+
+    def new_track(self, name: str) -> int:
+        tid = len(self.tracks)
+        self.tracks[tid] = name
+        return tid
+
+    def add(self, name: str, category: str, started: float, duration: float, tid: int, attrs: dict):
+        self.events.append({
+            "name": name, "cat": category, "ph": "X", "pid": 1, "tid": tid,
+            "ts": round((started - self.origin) * 1e6), "dur": round(duration * 1e6),
+            "args": attrs,
+        })
+
+    def to_json(self) -> dict:
+        metadata = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": name}}
+                    for tid, name in self.tracks.items()]
+        return {
+            "traceEvents": metadata + self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"batch": self.name, "started_at": self.started_at, **self.attrs},
+        }
+
+
+# (трасса, трек) текущей задачи; asyncio копирует контекст в дочерние задачи
+_current: ContextVar[Optional[tuple]] = ContextVar("current_trace", default=None)
+
+
+class span:
+    """
+    Спан для with / async with. category — слой (batch, post, stage, upstream),
+    series — необязательная серия гистограммы metrics_service для той же длительности.
+    new_track=True открывает отдельный трек (для постов). Атрибуты можно дополнить через set()
+    """
+    __slots__ = ("name", "category", "series", "attrs", "new_track", "started", "context", "token")
+
+    def __init__(self, name: str, category: str = "upstream", series=None, new_track: bool = False, **attrs):
+        self.name = name
+        self.category = category
+        self.series = series
+        self.attrs = attrs
+        self.new_track = new_track
+        self.token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.context = _current.get()
+        if self.context is not None and self.new_track:
+            trace, _ = self.context
+            self.context = (trace, trace.new_track(str(self.attrs.get("post_id", self.name))))
+            self.token = _current.set(self.context)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        if self.series is not None:
+            self.series.observe(duration)
+        if self.context is not None:
+            if exc_type is not None:
+                self.attrs["error"] = exc_type.__name__
+            trace, tid = self.context
+            trace.add(self.name, self.category, self.started, duration, tid, self.attrs)
+        if self.token is not None:
+            _current.reset(self.token)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.__exit__(*exc)
+
+
+def record_span(name: str, category: str, started: float, **attrs):
+    """Завершенный спан от started (perf_counter) до текущего момента"""
+    context = _current.get()
+    if context is not None:
+        trace, tid = context
+        trace.add(name, category, started, time.perf_counter() - started, tid, attrs)
+
+
+class trace_batch:
+    """Трасса батча: корневой спан и запись файла traces/<name>.json при выходе"""
+
+    def __init__(self, name: str, **attrs):
+        self.trace = Trace(name, **attrs)
+        self.root = span(name, category="batch", **attrs)
+
+    def __enter__(self):
+        self.token = _current.set((self.trace, 0))
+        self.root.__enter__()
+        return self.root
+
+    def __exit__(self, *exc):
+        self.root.__exit__(*exc)
+        _current.reset(self.token)
+        try:
+            path = write_trace(self.trace)
+            logger.info(f"🧭 Трасса батча сохранена: {path}")
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить трассу: {e}")
+        return False
+
+
+def write_trace(trace: Trace) -> str:
+    os.makedirs(TRACES_DIR, exist_ok=True)
+    path = os.path.join(TRACES_DIR, f"{trace.name}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(trace.to_json(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+    if KEEP_TRACES:
+        for old in recent_traces()[KEEP_TRACES:]:
+            os.remove(old)
+    return path
+
+
+def recent_traces(limit: Optional[int] = None) -> list:
+    """Файлы трасс, новые первыми"""
+    if not os.path.isdir(TRACES_DIR):
+        return []
+    paths = [os.path.join(TRACES_DIR, name) for name in os.listdir(TRACES_DIR) if name.endswith(".json")]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return paths[:limit] if limit else paths
+
+
+def summarize(paths: list, top: int = 10) -> str:
+    """Текстовая сводка: самые медленные этапы/запросы (суммарно) и посты"""
+    by_name = {}
+    posts = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        batch = data.get("otherData", {}).get("batch", os.path.basename(path))
+        for event in data["traceEvents"]:
+            if event.get("ph") != "X":
+                continue
+            seconds = event["dur"] / 1e6
+            if event["cat"] == "post":
+                posts.append((seconds, batch, event["args"].get("post_id", event["name"]), event["args"]))
+            elif event["cat"] in ("stage", "upstream"):
+                key = (event["cat"], event["name"])
+                by_name.setdefault(key, []).append(seconds)
+
+    lines = [f"Трасс: {len(paths)}", "", "Этапы и запросы (по суммарному времени):",
+             f"{'слой':<9} {'имя':<28} {'кол-во':>7} {'всего, с':>10} {'средн., с':>10} {'p95, с':>8} {'макс., с':>9}"]
+    ranked = sorted(by_name.items(), key=lambda item: sum(item[1]), reverse=True)
+    for (category, name), values in ranked[:top]:
+        values.sort()
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        lines.append(f"{category:<9} {name[:28]:<28} {len(values):>7} {sum(values):>10.1f} "
+                     f"{sum(values) / len(values):>10.2f} {p95:>8.2f} {values[-1]:>9.2f}")
+
+    lines += ["", "Самые медленные посты:", f"{'с':>8}  {'батч':<17} пост"]
+    for seconds, batch, post_id, args in sorted(posts, key=lambda item: item[0], reverse=True)[:top]:
+        note = f"  ({args['error']})" if "error" in args else ""
+        lines.append(f"{seconds:>8.1f}  {batch:<17} {post_id}{note}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сводка по трассам батчей")
+    parser.add_argument("command", choices=["summary"])
+    parser.add_argument("--last", type=int, default=10, help="сколько последних батчей учитывать")
+    parser.add_argument("--top", type=int, default=10, help="строк в каждом рейтинге")
+    args = parser.parse_args()
+
+    paths = recent_traces(args.last)
+    if not paths:
+        print(f"Трасс в {TRACES_DIR} нет")
+    else:
+        print(summarize(paths, args.top))
@@ -1,9 +1,18 @@
 import requests
 from typing import List, Dict
 
+from .metrics_service import UPSTREAM_SECONDS, UPSTREAM_ERRORS, DOWNLOADED_BYTES
+from .tracing_service import span
+
 def fetch_images_data(api_url: str) -> List[Dict[str, object]]:
-    resp = requests.get(api_url, timeout=15)
-    resp.raise_for_status()
+    try:
+        with span("waifu.listing", series=UPSTREAM_SECONDS.labels("waifu", "listing")):
+            resp = requests.get(api_url, timeout=15)
+        resp.raise_for_status()
+    except requests.RequestException:
+        UPSTREAM_ERRORS.labels("waifu").inc()
+        raise
+    DOWNLOADED_BYTES.labels("waifu").inc(len(resp.content))
     data = resp.json().get("images", [])
     result: List[Dict[str, object]] = []
     for img in data: